@@ -0,0 +1,146 @@
+import hashlib
+import hmac
+import math
+import time
+from collections import OrderedDict
+
+import common
+
+logger = common.getLogger('admission')
+
+#camera key shared by a client's cameras beyond Admission.maxCameras. Not a valid camera id
+OTHER_CAMERAS = "*"
+
+def sign(secret, camera, timestamp):
+    """
+    HMAC-SHA256 signature of a motion request: hex digest of "<camera>:<timestamp>" keyed with secret
+    """
+    message = "{}:{}".format(camera or "", timestamp).encode("utf-8")
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+class TokenBucket(object):
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        """
+        Take a token if there is one. Returns 0 if taken, else the seconds until there is one
+        """
+        self.tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate if rate > 0 else math.inf
+
+
+class Admission(object):
+    """
+    Admission control for webhook requests, run before anything is queued.
+    Authentication (skipped when neither tokens nor secret are set): the request carries one
+    of tokens, as ?token= or an "Authorization: Bearer" header, or is signed with secret as
+    ?ts=<unix time>&sig=sign(secret, camera, ts), with ts at most maxSkew seconds off. Both
+    are compared in constant time.
+    Rate limiting: a token bucket (rate per second, burst) per client IP, or per camera of each
+    client IP, checked before authentication so a flood costs no HMAC work. A client gets at
+    most maxCameras camera buckets; the cameras it names beyond those share one more, so inventing
+    camera names does not lift its limit. At most maxClients buckets are kept, dropping the
+    least recently used.
+    check() returns None to admit, or (status, reason, retry after seconds)
+    """
+    def __init__(self, tokens=(), secret=None, maxSkew=300., rate=1., burst=5, limitBy="camera", maxClients=1024,
+            maxCameras=16):
+        self.configure(tokens, secret, maxSkew, rate, burst, limitBy, maxClients, maxCameras)
+        self._buckets = OrderedDict()
+        self._cameras = {} #camera buckets per client
+        self.stats = {"admitted":0, "rejected":0, "throttled":0}
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(**admissionSettings(config))
+
+    def applyConfig(self, old, new):
+        """
+        configStore.onChange callback
+        """
+        self.configure(**admissionSettings(new))
+
+    def configure(self, tokens=(), secret=None, maxSkew=300., rate=1., burst=5, limitBy="camera", maxClients=1024,
+            maxCameras=16):
+        self.tokens = tuple(token.encode("utf-8") for token in tokens)
+        self.secret = secret or None
+        self.maxSkew = maxSkew
+        self.rate = rate
+        self.burst = burst
+        self.limitBy = limitBy
+        self.maxClients = maxClients
+        self.maxCameras = maxCameras
+
+    def check(self, client, camera, query_components, headers, now=None):
+        now = time.monotonic() if now is None else now
+        retryAfter = self._throttle(client if self.limitBy == "ip" else self._cameraKey(client, camera), now)
+        if retryAfter: return self._throttled(client, camera, retryAfter)
+        if not self._authenticated(camera, query_components, headers):
+            self.stats["rejected"] += 1
+            logger.warning("Rejected unauthenticated request from %s (camera %s)", client, camera)
+            return 403, "Forbidden", None
+        self.stats["admitted"] += 1
+        return None
+
+    def _throttled(self, client, camera, retryAfter):
+        self.stats["throttled"] += 1
+        logger.warning("Throttled request from %s (camera %s)", client, camera)
+        return 429, "Too Many Requests", retryAfter
+
+    def _throttle(self, key, now):
+        if self.rate <= 0: return 0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            if isinstance(key, tuple): self._cameras[key[0]] = self._cameras.get(key[0], 0) + 1
+            while len(self._buckets) > self.maxClients:
+                dropped, _ = self._buckets.popitem(last=False)
+                if isinstance(dropped, tuple): self._forgetCamera(dropped[0])
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(self.rate, self.burst, now)
+
+    def _cameraKey(self, client, camera):
+        key = (client, camera)
+        if key in self._buckets or self._cameras.get(client, 0) < self.maxCameras: return key
+        return (client, OTHER_CAMERAS)
+
+    def _forgetCamera(self, client):
+        count = self._cameras.pop(client) - 1
+        if count: self._cameras[client] = count
+
+    def _authenticated(self, camera, query_components, headers):
+        if not len(self.tokens) and self.secret is None: return True
+        token = query_components.get('token', [None])[0]
+        if token is None:
+            scheme, _, credentials = headers.get("authorization", "").partition(" ")
+            if scheme.lower() == "bearer": token = credentials.strip()
+        if token is not None:
+            token = token.encode("utf-8")
+            #check every token so the time taken does not tell which one was close
+            matched = False
+            for candidate in self.tokens: matched |= hmac.compare_digest(token, candidate)
+            if matched: return True
+        signature = query_components.get('sig', [None])[0]
+        timestamp = query_components.get('ts', [None])[0]
+        if self.secret is None or signature is None or timestamp is None: return False
+        try:
+            if abs(time.time() - float(timestamp)) > self.maxSkew: return False
+        except ValueError:
+            return False
+        return hmac.compare_digest(signature.lower().encode("latin1", "replace"),
+                sign(self.secret, camera, timestamp).encode("latin1"))
+
+def admissionSettings(config):
+    return dict(tokens=config.webhookTokens, secret=config.webhookSecret, maxSkew=config.webhookMaxSkew,
+            rate=config.webhookRate, burst=config.webhookBurst, limitBy=config.webhookLimitBy,
+            maxClients=config.webhookMaxClients, maxCameras=config.webhookMaxCameras)
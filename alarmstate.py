@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import time
+
+import common
+
+logger = common.getLogger('alarmstate')
+
+class AlarmState(object):
+    """
+    Armed / disarmed / snoozed state and the notify gap set by SMS command, persisted as
+    JSON in path so it survives restarts and can be read by the other processes.
+    The writer (main) changes it through the setters; readers call refresh() to pick up
+    changes, which costs one stat() of the file when nothing changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self.armed = True
+        self.snoozeUntil = 0.
+        self.notifyGap = None #minutes, None for the configured NotifyGap
+        self.changedBy = None
+        self.changedAt = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reload the state if the file changed since it was last read
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime: return
+        try:
+            with open(self.path) as stateFile:
+                state = json.load(stateFile)
+        except (OSError, ValueError) as e:
+            logger.error("Failed to read alarm state from %s: %s", self.path, e)
+            return
+        with self._lock:
+            self._mtime = mtime
+            self.armed = bool(state.get("armed", True))
+            self.snoozeUntil = float(state.get("snoozeUntil", 0.))
+            self.notifyGap = state.get("notifyGap")
+            self.changedBy = state.get("changedBy")
+            self.changedAt = state.get("changedAt")
+
+    def isActive(self, now=None):
+        """
+        Whether motion should be notified: armed and not snoozed
+        """
+        now = time.time() if now is None else now
+        return self.armed and now >= self.snoozeUntil
+
+    def arm(self, changedBy=None):
+        self._update(changedBy, armed=True, snoozeUntil=0.)
+
+    def disarm(self, changedBy=None):
+        self._update(changedBy, armed=False)
+
+    def snooze(self, minutes, changedBy=None):
+        self._update(changedBy, snoozeUntil=time.time() + minutes * 60 if minutes > 0 else 0.)
+
+    def setNotifyGap(self, minutes, changedBy=None):
+        self._update(changedBy, notifyGap=minutes)
+
+    def describe(self, now=None):
+        now = time.time() if now is None else now
+        if not self.armed: state = "Disarmed"
+        elif now < self.snoozeUntil:
+            state = "Snoozed until {}".format(time.strftime("%H:%M", time.localtime(self.snoozeUntil)))
+        else: state = "Armed"
+        if self.changedBy is not None:
+            state += " (changed by {} on {})".format(self.changedBy, time.asctime(time.localtime(self.changedAt)))
+        return state
+
+    def _update(self, changedBy, **changes):
+        with self._lock:
+            for name, value in changes.items(): setattr(self, name, value)
+            self.changedBy = changedBy
+            self.changedAt = time.time()
+            state = {"armed":self.armed, "snoozeUntil":self.snoozeUntil, "notifyGap":self.notifyGap,
+                    "changedBy":self.changedBy, "changedAt":self.changedAt}
+            try:
+                with open(self.path + ".tmp", "w") as stateFile:
+                    json.dump(state, stateFile)
+                os.replace(self.path + ".tmp", self.path)
+                self._mtime = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                logger.error("Failed to save alarm state to %s: %s", self.path, e)
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+"""
+End-to-end latency benchmarks against the SIM800 emulator.
+
+Measures the time per AT command, the SMS send time, how quickly placeCall detects
+a call outcome (event driven and polling), and the latency from a camera webhook to
+the ATD dial command through the full main.py / web-server.py stack. Results are
+printed and can be saved as JSON tagged with the git commit; pass an earlier result
+file to --compare to see the change between commits.
+"""
+import argparse, json, logging, os, platform, socket, subprocess, sys, tempfile, time
+import urllib.request
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH)
+os.chdir(ROOT) #common reads main.conf from the working directory
+os.environ["HOMESEC_GPIO"] = "stub"
+
+import gpiostub
+import sim800
+import sim800emu
+
+BENCH_NUMBER = "+15550000001"
+
+def summarise(samples):
+    """
+    Mean and percentiles of a list of durations in seconds, reported in milliseconds
+    """
+    samples = sorted(samples)
+    if not len(samples): return {}
+    pick = lambda p: samples[min(len(samples)-1, int(len(samples) * p / 100.))]
+    return {"n":len(samples), "mean_ms":round(sum(samples) / len(samples) * 1000, 2),
+            "p50_ms":round(pick(50) * 1000, 2), "p99_ms":round(pick(99) * 1000, 2),
+            "max_ms":round(samples[-1] * 1000, 2)}
+
+def openModem(emulator):
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    gsm = sim800.SMS(emulator.port, sim800.BAUD, logger)
+    gsm.setup()
+    gsm.setEchoOff()
+    return gsm
+
+def benchATCommand(args):
+    emulator = sim800emu.SIM800Emulator(responseDelay=args.response_delay)
+    emulator.start()
+    gsm = openModem(emulator)
+    samples = []
+    for n in range(args.at_count):
+        start = time.perf_counter()
+        gsm.sendATCmdWaitResp("AT", "OK")
+        samples.append(time.perf_counter() - start)
+    gsm.close()
+    emulator.stop()
+    return summarise(samples)
+
+def benchSMS(args):
+    emulator = sim800emu.SIM800Emulator(responseDelay=args.response_delay, smsSendDelay=args.sms_delay)
+    emulator.start()
+    gsm = openModem(emulator)
+    samples = []
+    for n in range(args.sms_count):
+        start = time.perf_counter()
+        gsm.sendSMS(BENCH_NUMBER, "Benchmark message {}".format(n))
+        samples.append(time.perf_counter() - start)
+    gsm.close()
+    emulator.stop()
+    return summarise(samples)
+
+def benchCallOutcome(args, eventDriven):
+    """
+    Time from the emulator ending a call (busy or rejected) until placeCall returns
+    """
+    emulator = sim800emu.SIM800Emulator(responseDelay=args.response_delay, ringTime=.5)
+    emulator.start()
+    gsm = openModem(emulator)
+    if eventDriven: gsm.enableCallStatusReporting()
+    samples = []
+    for n in range(args.call_count):
+        emulator.setCallOutcome(sim800emu.CALL_BUSY if n % 2 else sim800emu.CALL_REJECT)
+        gsm.placeCall(BENCH_NUMBER, timeout=10)
+        returned = time.time()
+        ended = emulator.lastEvent("call ended")
+        if ended is not None: samples.append(returned - ended[0])
+    gsm.close()
+    emulator.stop()
+    return summarise(samples)
+
+def benchPowerOn(args):
+    """
+    Time for turnOn() to bring up a module that is switched off, with the emulated
+    module taking --boot-time seconds to boot after the power key pulse
+    """
+    samples = []
+    for n in range(args.power_on_count):
+        emulator = sim800emu.SIM800Emulator(responseDelay=args.response_delay, bootTime=args.boot_time, poweredOn=False)
+        emulator.attachGPIO(gpiostub, sim800.GSM_ON)
+        emulator.start()
+        logger = logging.getLogger("bench")
+        gsm = sim800.SMS(emulator.port, sim800.BAUD, logger)
+        gsm.setup()
+        start = time.perf_counter()
+        if gsm.turnOn(): samples.append(time.perf_counter() - start)
+        gsm.close()
+        emulator.stop()
+    return summarise(samples)
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class DaemonUnderTest(object):
+    """
+    main.py (with its web server and NVR watchdog) running against an emulator with a temporary
+    config. As a context manager it starts the daemon, waits until the webhook answers and stops
+    it on exit. started and ready are the wall clock times of the start and of the first answer
+    """
+    def __init__(self, emulator, runtimeMode="processes"):
+        self.emulator = emulator
+        self.runtimeMode = runtimeMode
+        self.port = freePort()
+        self.workdir = tempfile.mkdtemp(prefix="homesec-bench-")
+        self.logPath = os.path.join(self.workdir, "main.log")
+        self.process = None
+        self.started = self.ready = None
+
+    def writeConfig(self):
+        configPath = os.path.join(self.workdir, "main.conf")
+        with open(configPath, "w") as conf:
+            conf.write("[MOTION_NOTIFICATION_NUMBERS]\n{}\n\n".format(BENCH_NUMBER))
+            conf.write("[MOTION_NOTIFICATION_SETTINGS]\nRedials : 0\nNotifyGap : 0\nDedupWindow : 0\nCallTimeout : 5\n")
+            conf.write("DialStatsFile : {}\n\n".format(os.path.join(self.workdir, "dialstats.json")))
+            conf.write("[SMS_COMMANDS]\nStateFile : {}\n\n".format(os.path.join(self.workdir, "alarmstate.json")))
+            conf.write("[WEBHOOK]\nPort : {}\n\n".format(self.port))
+            conf.write("[MODEMS]\nStatusFile : {}\n\n".format(os.path.join(self.workdir, "modemstatus.json")))
+            conf.write("[RUNTIME]\nMode : {}\n\n".format(self.runtimeMode))
+            conf.write("[SERVER]\nServerMAC = 00:00:00:00:00:00\nServerIP = 127.0.0.1\nServerPort = {}\n\n".format(freePort()))
+            conf.write("[NVR_WATCHDOG]\nStatusFile : {}\n".format(os.path.join(self.workdir, "nvrstatus.json")))
+        return configPath
+
+    def __enter__(self):
+        env = dict(os.environ, HOMESEC_CONFIG=self.writeConfig(), HOMESEC_SERIAL_PORT=self.emulator.port, HOMESEC_GPIO="stub")
+        self._log = open(self.logPath, "w")
+        self.started = time.time()
+        self.process = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 60
+        while True:
+            try:
+                urllib.request.urlopen("http://127.0.0.1:{}/".format(self.port), timeout=1).read()
+                break
+            except OSError:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError("main.py did not start, see {}".format(self.logPath))
+                time.sleep(.01)
+        self.ready = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait(10)
+        self._log.close()
+
+    def log(self):
+        with open(self.logPath) as log:
+            return log.read()
+
+    def motion(self, camera):
+        """
+        Send a motion webhook and wait for the notification call to end.
+        Returns the seconds until the ATD command reached the modem, or None
+        """
+        start = time.time()
+        urllib.request.urlopen("http://127.0.0.1:{}/?motion&camera={}".format(self.port, camera), timeout=5).read()
+        while self.emulator.firstCommandAfter("ATD", start) is None and time.time() - start < 10: time.sleep(.001)
+        dialed = self.emulator.firstCommandAfter("ATD", start)
+        #let the notification run finish before the next event
+        while time.time() - start < 10:
+            ended = self.emulator.lastEvent("call ended")
+            if ended is not None and ended[0] > start: break
+            time.sleep(.01)
+        return None if dialed is None else dialed - start
+
+def benchWebhookToDial(args):
+    """
+    Latency from a camera webhook request to the ATD command reaching the modem,
+    through main.py, web-server.py, the IPC channel and the notification engine
+    """
+    emulator = sim800emu.SIM800Emulator(responseDelay=args.response_delay, ringTime=.2, answerHold=.2)
+    emulator.start()
+    samples = []
+    try:
+        with DaemonUnderTest(emulator) as daemon:
+            for n in range(args.webhook_count):
+                latency = daemon.motion("bench{}".format(n))
+                if latency is not None: samples.append(latency)
+                time.sleep(.5)
+    finally:
+        emulator.stop()
+    return summarise(samples)
+
+BENCHMARKS = {
+    "at_command": benchATCommand,
+    "sms_send": benchSMS,
+    "call_outcome_events": lambda args: benchCallOutcome(args, True),
+    "call_outcome_polling": lambda args: benchCallOutcome(args, False),
+    "webhook_to_atd": benchWebhookToDial,
+    "gsm_power_on": benchPowerOn,
+}
+
+def gitRevision():
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD", "--", "."], cwd=ROOT) != 0
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(results, previousPath):
+    with open(previousPath) as previous:
+        previous = json.load(previous)
+    print("\nChange against {} ({}):".format(previousPath, previous.get("commit")))
+    for name, metrics in results["results"].items():
+        before = previous.get("results", {}).get(name)
+        if not before or "p50_ms" not in metrics or "p50_ms" not in before: continue
+        print("  {:<22} p50 {:>9.2f} -> {:>9.2f} ms   p99 {:>9.2f} -> {:>9.2f} ms".format(
+                name, before["p50_ms"], metrics["p50_ms"], before["p99_ms"], metrics["p99_ms"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run (default: all)")
+    parser.add_argument("--response-delay", type=float, default=.005, help="emulated modem response delay in seconds")
+    parser.add_argument("--sms-delay", type=float, default=.1, help="emulated network time to send an SMS")
+    parser.add_argument("--at-count", type=int, default=200)
+    parser.add_argument("--sms-count", type=int, default=10)
+    parser.add_argument("--call-count", type=int, default=6)
+    parser.add_argument("--webhook-count", type=int, default=5)
+    parser.add_argument("--power-on-count", type=int, default=2)
+    parser.add_argument("--boot-time", type=float, default=3., help="seconds the emulated module takes to boot")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="earlier JSON result file to compare against")
+    args = parser.parse_args()
+
+    results = {"commit":gitRevision(), "time":time.strftime("%Y-%m-%dT%H:%M:%S"), "python":platform.python_version(),
+            "parameters":{k:v for k, v in vars(args).items() if k not in ("only", "output", "compare")}, "results":{}}
+    for name in sorted(args.only or BENCHMARKS):
+        results["results"][name] = BENCHMARKS[name](args)
+        print("{:<22} {}".format(name, results["results"][name]), flush=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.compare: compare(results, args.compare)
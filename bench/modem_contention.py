@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+"""
+Queue wait per priority class when alarms, incoming calls and housekeeping contend for one GSM module.
+
+A dispatcher and modem pool like the daemon's run a fixed, seeded schedule of jobs against the
+SIM800 emulator: housekeeping jobs sending a few SMS replies each (like a burst of SMS commands,
+giving the module up between messages when asked to), incoming call handling and alarm calls.
+The wait of each job is the time from its submission until it holds the module. The schedule
+runs once with the priority classes and once with every job in one class, which is the
+first come first served order without the scheduler.
+"""
+import argparse, json, logging, os, random, sys, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark
+import sim800emu
+import dispatcher
+import modempool
+
+def schedule(args):
+    """
+    (offset in seconds, priority class) of every job, in submission order
+    """
+    rng = random.Random(args.seed)
+    jobs = []
+    for priority, interval in ((dispatcher.PRIORITY_HOUSEKEEPING, args.housekeeping_interval),
+            (dispatcher.PRIORITY_CALL, args.call_interval), (dispatcher.PRIORITY_ALARM, args.alarm_interval)):
+        offset = rng.uniform(0, interval)
+        while offset < args.duration:
+            jobs.append((offset, priority))
+            offset += rng.expovariate(1. / interval)
+    return sorted(jobs)
+
+def run(args, prioritised):
+    logger = logging.getLogger("bench")
+    emulator = sim800emu.SIM800Emulator(responseDelay=args.response_delay, smsSendDelay=args.sms_delay, ringTime=args.ring_time)
+    emulator.setCallOutcome(sim800emu.CALL_BUSY)
+    emulator.start()
+    gsm = benchmark.openModem(emulator)
+    gsm.enableCallStatusReporting()
+    modem = modempool.PooledModem("gsm", gsm)
+    modem.healthy = True
+    pool = modempool.ModemPool([modem], logger)
+    workers = dispatcher.EventDispatcher("Bench", logger, workers=args.workers, capacity=1000)
+    waits = dict((priority, []) for priority in dispatcher.PRIORITIES)
+    done = threading.Semaphore(0)
+
+    def leased(priority, submitted):
+        waits[priority].append(time.time() - submitted)
+
+    def housekeeping(submitted, replies):
+        with pool.lease():
+            if submitted is not None: leased(dispatcher.PRIORITY_HOUSEKEEPING, submitted)
+            job = dispatcher.currentJob()
+            while replies > 0:
+                if job.cancelled.is_set():
+                    workers.submit(lambda: housekeeping(None, replies), priority=job.priority)
+                    return
+                gsm.sendSMS(benchmark.BENCH_NUMBER, "Reply")
+                replies -= 1
+        done.release()
+
+    def call(submitted):
+        with pool.lease():
+            leased(dispatcher.PRIORITY_CALL, submitted)
+            gsm.sendATCmdWaitReturnResp("AT+CLCC", "OK")
+        done.release()
+
+    def alarm(submitted):
+        with pool.lease():
+            leased(dispatcher.PRIORITY_ALARM, submitted)
+            gsm.placeCall(benchmark.BENCH_NUMBER, timeout=10)
+        done.release()
+
+    jobs = schedule(args)
+    start = time.time()
+    for offset, priority in jobs:
+        time.sleep(max(0, start + offset - time.time()))
+        submitted = time.time()
+        if priority == dispatcher.PRIORITY_HOUSEKEEPING: func = lambda submitted=submitted: housekeeping(submitted, args.sms_per_job)
+        elif priority == dispatcher.PRIORITY_CALL: func = lambda submitted=submitted: call(submitted)
+        else: func = lambda submitted=submitted: alarm(submitted)
+        workers.submit(func, priority=priority if prioritised else dispatcher.PRIORITY_HOUSEKEEPING)
+    for job in jobs: done.acquire()
+    workers.stop()
+    gsm.close()
+    emulator.stop()
+    results = dict((priority, benchmark.summarise(samples)) for priority, samples in waits.items())
+    results["dispatcher"] = dict((key, value) for key, value in workers.stats().items() if key in ("cancelled", "expired"))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=60., help="seconds over which jobs are submitted")
+    parser.add_argument("--housekeeping-interval", type=float, default=4., help="mean seconds between housekeeping jobs")
+    parser.add_argument("--call-interval", type=float, default=10., help="mean seconds between incoming calls")
+    parser.add_argument("--alarm-interval", type=float, default=10., help="mean seconds between alarms")
+    parser.add_argument("--sms-per-job", type=int, default=3, help="SMS sent by each housekeeping job")
+    parser.add_argument("--sms-delay", type=float, default=1., help="emulated network time to send an SMS")
+    parser.add_argument("--ring-time", type=float, default=.5, help="seconds an alarm call rings before it is busy")
+    parser.add_argument("--workers", type=int, default=1, help="dispatcher workers")
+    parser.add_argument("--response-delay", type=float, default=.005, help="emulated modem response delay in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {"commit":benchmark.gitRevision(), "time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters":{k:v for k, v in vars(args).items() if k != "output"}, "results":{}}
+    for name, prioritised in (("fifo", False), ("priority", True)):
+        results["results"][name] = run(args, prioritised)
+        for priority in dispatcher.PRIORITIES:
+            print("{:<9} {:<13} {}".format(name, priority, results["results"][name][priority]), flush=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
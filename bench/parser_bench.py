@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+"""
+Micro-benchmark of the SIM800 reply parser on recorded response lines.
+
+Every line with a registered prefix (sim800.REPLY_TYPES) is parsed the way the daemon did it
+before the parser registry (splitting on commas at each call site, csv and strptime for SMS
+headers, parseReply() for single values) and with sim800.parseResponse(). For each prefix the time per
+line of both is reported, along with the lines on which the old parsing gets a value the caller
+uses wrong, such as a USSD text cut at its first comma.
+
+A transcript is a file of response lines, one per line, or a daemon log at DEBUG level, from
+which the "Lines: [...]" responses and "MT said: ..." URCs are taken.
+"""
+import argparse, ast, csv, json, os, sys, time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark
+import sim800
+
+TRANSCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcripts", "sim800.txt")
+
+def readTranscript(path):
+    lines = []
+    with open(path, encoding="utf-8") as transcript:
+        for line in transcript:
+            line = line.rstrip("\r\n")
+            if "Lines: [" in line:
+                lines.extend(ast.literal_eval(line[line.index("Lines: [")+len("Lines: "):]))
+            elif "MT said: " in line:
+                lines.append(line[line.index("MT said: ")+len("MT said: "):])
+            elif len(line) and not line.startswith("#"):
+                lines.append(line)
+    return [line for line in lines if line.split(":", 1)[0] in sim800.REPLY_TYPES]
+
+def _parseReply(data, beginning, divider=",", index=0):
+    if not data.startswith(beginning): return None
+    data = data.replace(beginning, "").split(divider)
+    try: return data[index]
+    except IndexError: return None
+
+def _parseTimestamp(scts):
+    try:
+        quarters = int(scts[-3:])
+        return datetime.strptime(scts[:-3], "%y/%m/%d,%H:%M:%S").replace(tzinfo=timezone(timedelta(minutes=15*quarters)))
+    except ValueError:
+        return None
+
+def _splitFields(params):
+    return next(csv.reader([params], skipinitialspace=True))
+
+def _legacyCLCC(line):
+    data = line.split(",")
+    try: return int(data[2]), data[5].replace('"', '')
+    except (IndexError, ValueError): return None
+
+def _legacyCMGL(line):
+    fields = _splitFields(line[7:])
+    if len(fields) < 5: return None
+    return int(fields[0]), sim800.SMSStatus.fromStat('"{}"'.format(fields[1])), fields[2], _parseTimestamp(fields[4])
+
+def _legacyCMGR(line):
+    fields = _splitFields(line[7:])
+    if len(fields) < 4: return None
+    return sim800.SMSStatus.fromStat('"{}"'.format(fields[0])), fields[1], _parseTimestamp(fields[3])
+
+def _legacyCREG(line):
+    fields = line[len("+CREG:"):].strip().split(",")
+    if len(fields) == 1: status = fields[0]
+    else: status = _parseReply(line, "+CREG: ", index=1)
+    try: return sim800.NetworkStatus(int(status))
+    except (TypeError, ValueError): return None
+
+def _legacyCSQ(line):
+    csq = _parseReply(line, "+CSQ: ")
+    return None if csq is None else int(csq)
+
+def _legacyCUSD(line):
+    return _parseReply(line, "+CUSD: ", index=1)
+
+def _legacyCMTI(line):
+    try: return int(line.rsplit(",", 1)[1])
+    except (IndexError, ValueError): return None
+
+def _legacyCEER(line):
+    return line.split(":", 1)[-1]
+
+#(old parsing, the values callers take from the reply record) by prefix
+PARSERS = {
+    "+CLCC": (_legacyCLCC, lambda call: (call.state, call.number)),
+    "+CMGL": (_legacyCMGL, lambda listing: (listing.index, listing.status, listing.number, listing.timestamp)),
+    "+CMGR": (_legacyCMGR, lambda header: (header.status, header.number, header.timestamp)),
+    "+CREG": (_legacyCREG, lambda registration: registration.status),
+    "+CSQ": (_legacyCSQ, lambda csq: csq.rssi),
+    "+CUSD": (_legacyCUSD, lambda reply: reply.text),
+    "+CMTI": (_legacyCMTI, lambda indication: indication.index),
+    "+CEER": (_legacyCEER, lambda report: report.report),
+}
+
+def _tidy(value):
+    if isinstance(value, tuple): return tuple(_tidy(v) for v in value)
+    if isinstance(value, str): return value.strip().strip('"')
+    return value
+
+def timePerLine(parse, lines, repeat, number):
+    """
+    Best of repeat runs of number passes over lines, in microseconds per line
+    """
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for n in range(number):
+            for line in lines: parse(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / (number * len(lines)) * 1e6
+
+def run(lines, args):
+    results = {}
+    byPrefix = {}
+    for line in lines: byPrefix.setdefault(line.split(":", 1)[0], []).append(line)
+    byPrefix["all"] = lines
+    for prefix, group in byPrefix.items():
+        if prefix == "all": legacy = lambda line: PARSERS[line.split(":", 1)[0]][0](line)
+        else: legacy = PARSERS[prefix][0]
+        wrong = []
+        for line in group:
+            record = sim800.parseResponse(line)
+            expected = None if record is None else PARSERS[line.split(":", 1)[0]][1](record)
+            if _tidy(legacy(line)) != _tidy(expected): wrong.append(line)
+        results[prefix] = {"lines":len(group), "legacyUs":timePerLine(legacy, group, args.repeat, args.number),
+                "registryUs":timePerLine(sim800.parseResponse, group, args.repeat, args.number), "legacyWrong":wrong}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--transcript", action="append", help="response lines or daemon log to parse (repeatable)")
+    parser.add_argument("--number", type=int, default=2000, help="passes over the lines per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs, of which the fastest counts")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    lines = []
+    for path in args.transcript or [TRANSCRIPT]: lines.extend(readTranscript(path))
+    if not len(lines): sys.exit("No replies with a registered prefix in the transcript")
+    results = {"commit":benchmark.gitRevision(), "time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters":{k:v for k, v in vars(args).items() if k != "output"}, "results":run(lines, args)}
+    print("{:<6} {:>5} {:>10} {:>12} {:>6}".format("prefix", "lines", "old us", "registry us", "wrong"))
+    for prefix, result in results["results"].items():
+        print("{:<6} {:>5} {:>10.2f} {:>12.2f} {:>6}".format(prefix, result["lines"], result["legacyUs"], result["registryUs"],
+                len(result["legacyWrong"])))
+        for line in result["legacyWrong"]:
+            if prefix != "all": print("       old parsing wrong: {}".format(line))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+"""
+Compare the multi-process and single process runtimes ([RUNTIME] Mode).
+
+For each mode main.py is started against the SIM800 emulator several times and the script
+measures the startup time (until the daemon logs that it is armed), the memory of the whole
+process tree once started (RSS, and PSS where the kernel reports it, which splits shared
+pages fairly between the processes) and the webhook to ATD latency.
+"""
+import argparse, json, os, re, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark
+import sim800emu
+
+MODES = ("processes", "single")
+
+def processTree(pid):
+    """
+    pid and the pids of all its descendants
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit(): continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, pending = [], [pid]
+    while len(pending):
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, ()))
+    return tree
+
+def memory(pid):
+    """
+    Total RSS and PSS in MiB of a process tree. PSS is None if the kernel does not report it
+    """
+    rss, pss, pssReported = 0, 0, True
+    for member in processTree(pid):
+        try:
+            with open("/proc/{}/status".format(member)) as status:
+                rss += int(re.search(r"^VmRSS:\s+(\d+)", status.read(), re.M).group(1))
+        except (OSError, AttributeError):
+            continue #exited meanwhile
+        try:
+            with open("/proc/{}/smaps_rollup".format(member)) as rollup:
+                pss += int(re.search(r"^Pss:\s+(\d+)", rollup.read(), re.M).group(1))
+        except (OSError, AttributeError):
+            pssReported = False
+    return round(rss / 1024., 1), round(pss / 1024., 1) if pssReported else None
+
+def waitArmed(daemon, timeout=60.):
+    """
+    Seconds from starting the daemon until it logged that it is armed
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if "Armed" in daemon.log(): return time.time() - daemon.started
+        if daemon.process.poll() is not None: break
+        time.sleep(.01)
+    raise RuntimeError("main.py did not arm, see {}".format(daemon.logPath))
+
+def measure(mode, args):
+    startup, rss, pss, latency, processes = [], [], [], [], []
+    for run in range(args.runs):
+        emulator = sim800emu.SIM800Emulator(responseDelay=args.response_delay, ringTime=.2, answerHold=.2)
+        emulator.start()
+        try:
+            with benchmark.DaemonUnderTest(emulator, mode) as daemon:
+                startup.append(waitArmed(daemon))
+                time.sleep(args.settle)
+                for n in range(args.events):
+                    sample = daemon.motion("bench{}".format(n))
+                    if sample is not None: latency.append(sample)
+                    time.sleep(.2)
+                total, proportional = memory(daemon.process.pid)
+                rss.append(total)
+                if proportional is not None: pss.append(proportional)
+                processes.append(len(processTree(daemon.process.pid)))
+        finally:
+            emulator.stop()
+    mean = lambda values: round(sum(values) / len(values), 2) if len(values) else None
+    return {"processes":max(processes), "startup_s":mean(startup), "rss_mib":mean(rss), "pss_mib":mean(pss),
+            "webhook_to_atd":benchmark.summarise(latency)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="daemon starts per mode")
+    parser.add_argument("--events", type=int, default=5, help="motion events per run")
+    parser.add_argument("--settle", type=float, default=1., help="seconds to wait after arming before the events")
+    parser.add_argument("--response-delay", type=float, default=.005, help="emulated modem response delay in seconds")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {"commit":benchmark.gitRevision(), "time":time.strftime("%Y-%m-%dT%H:%M:%S"), "results":{}}
+    for mode in MODES:
+        results["results"][mode] = measure(mode, args)
+        print("{:<10} {}".format(mode, results["results"][mode]), flush=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+"""
+Scriptable SIM800 emulator serving AT commands over a pseudo-terminal.
+
+Point sim800.SMS (or main.py via HOMESEC_SERIAL_PORT, with HOMESEC_GPIO=stub) at
+SIM800Emulator.port. Response delays, call outcomes, SMS storage and unsolicited
+result codes are controlled from Python, which makes latency measurable and
+repeatable without the hardware. Run as a script to serve a port interactively.
+"""
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+CALL_ANSWER = "answer"
+CALL_BUSY = "busy"
+CALL_NO_ANSWER = "noanswer"
+CALL_REJECT = "reject"
+CALL_NO_BALANCE = "nobalance"
+CALL_OUTCOMES = (CALL_ANSWER, CALL_BUSY, CALL_NO_ANSWER, CALL_REJECT, CALL_NO_BALANCE)
+
+BOOT_URCS = ("RDY", "+CFUN: 1", "+CPIN: READY", "Call Ready", "SMS Ready")
+SMS_STATS = {"ALL":None, "REC UNREAD":"REC UNREAD", "REC READ":"REC READ", "STO UNSENT":"STO UNSENT", "STO SENT":"STO SENT"}
+
+class CommandError(Exception):
+    pass
+
+
+class SIM800Emulator(threading.Thread):
+    """
+    Emulated SIM800 module. Every command received and every URC sent is timestamped in
+    commandLog and urcLog; notable moments (e.g. call outcomes) are recorded in events.
+    """
+    def __init__(self, responseDelay=.005, callOutcome=CALL_ANSWER, dialTime=.2, ringTime=1., answerHold=1.,
+            noAnswerTimeout=30., smsSendDelay=.5, ussdReply="Your balance is 0.00", ussdDelay=.5,
+            bootTime=3., networkStatus=1, csq=20, echo=True, poweredOn=True, smsCapacity=30, simState="READY"):
+        threading.Thread.__init__(self, name="SIM800Emulator", daemon=True)
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self.responseDelay = responseDelay
+        self.callOutcome = callOutcome
+        self.callOutcomes = {} #per number overrides of callOutcome
+        self.dialTime = dialTime
+        self.ringTime = ringTime
+        self.answerHold = answerHold
+        self.noAnswerTimeout = noAnswerTimeout
+        self.smsSendDelay = smsSendDelay
+        self.ussdReply = ussdReply
+        self.ussdDelay = ussdDelay
+        self.bootTime = bootTime
+        self.networkStatus = networkStatus
+        self.csq = csq
+        self.simState = simState
+        self.echo = echo
+        self.poweredOn = poweredOn
+        self.smsCapacity = smsCapacity
+
+        self.commandLog = []
+        self.urcLog = []
+        self.events = []
+        self.sentSMS = []
+        self.storedSMS = {} #index -> dict(stat, sender, timestamp, text)
+
+        self._settings = {"clcc":0, "moring":0, "creg":0}
+        self._calls = {}
+        self._nextCallId = 1
+        self._lastRelease = "No cause information available"
+        self._smsInput = None #destination number while collecting SMS text after the prompt
+        self._messageReference = 0
+        self._lock = threading.RLock()
+        self._stopped = False
+        self._powerPinRaisedAt = None
+
+    # --- scripting API -------------------------------------------------------------
+
+    def stop(self):
+        self._stopped = True
+
+    def setCallOutcome(self, outcome, number=None):
+        if outcome not in CALL_OUTCOMES: raise ValueError("Unknown call outcome: {}".format(outcome))
+        if number is None: self.callOutcome = outcome
+        else: self.callOutcomes[number] = outcome
+
+    def setNetworkStatus(self, status):
+        """
+        Change the registration state, announced with +CREG if reporting is enabled
+        """
+        self.networkStatus = status
+        if self._settings["creg"]: self.sendURC("+CREG: {}".format(status))
+
+    def sendURC(self, line):
+        """
+        Emit an unsolicited result code
+        """
+        self.urcLog.append((time.time(), line))
+        self._write("\r\n{}\r\n".format(line))
+
+    def event(self, name, **details):
+        self.events.append((time.time(), name, details))
+
+    def lastEvent(self, name):
+        for entry in reversed(self.events):
+            if entry[1] == name: return entry
+        return None
+
+    def firstCommandAfter(self, prefix, since):
+        for timestamp, cmd in self.commandLog:
+            if timestamp >= since and cmd.upper().startswith(prefix): return timestamp
+        return None
+
+    def receiveSMS(self, sender, text):
+        """
+        Store an incoming SMS and announce it with +CMTI. Returns the storage index
+        """
+        with self._lock:
+            index = 1
+            while index in self.storedSMS: index += 1
+            if index > self.smsCapacity: return None
+            self.storedSMS[index] = {"stat":"REC UNREAD", "sender":sender, "timestamp":time.time(), "text":text}
+        self.sendURC('+CMTI: "SM",{}'.format(index))
+        return index
+
+    def ring(self, number, rings=3, interval=3.):
+        """
+        Simulate an incoming call from number that rings the given number of times
+        """
+        with self._lock:
+            call = self._newCall(number, 1, 4)
+        def run():
+            for n in range(rings):
+                with self._lock:
+                    if call["state"] != 4 or call["id"] not in self._calls: return
+                self.sendURC("RING")
+                time.sleep(interval)
+            with self._lock:
+                if call["state"] == 4: self._endCall(call, "NO CARRIER", "Normal call clearing")
+        threading.Thread(target=run, daemon=True).start()
+
+    def powerOn(self):
+        """
+        Boot the module: after bootTime the boot URCs are sent and commands are answered
+        """
+        def boot():
+            time.sleep(self.bootTime)
+            self.poweredOn = True
+            self.event("booted")
+            for urc in BOOT_URCS: self.sendURC(urc)
+        threading.Thread(target=boot, daemon=True).start()
+
+    def powerOff(self):
+        self.poweredOn = False
+        with self._lock:
+            self._calls.clear()
+        self._settings = {"clcc":0, "moring":0, "creg":0}
+        self.echo = True
+        self.event("powered off")
+
+    def attachGPIO(self, gpio, powerPin=11):
+        """
+        Follow the power key of an in-process gpiostub: a pulse of at least a second toggles power
+        """
+        def onOutput(channel, state):
+            if channel != powerPin: return
+            if state: self._powerPinRaisedAt = time.time()
+            elif self._powerPinRaisedAt is not None and time.time() - self._powerPinRaisedAt >= 1.:
+                self._powerPinRaisedAt = None
+                if self.poweredOn: self.powerOff()
+                else: self.powerOn()
+        gpio.onOutput = onOutput
+
+    # --- serial side ---------------------------------------------------------------
+
+    def _write(self, text):
+        with self._lock:
+            os.write(self._master, text.encode("latin1"))
+
+    def run(self):
+        pending = b""
+        while not self._stopped:
+            ready, _, _ = select.select([self._master], [], [], .2)
+            if not ready: continue
+            try: pending += os.read(self._master, 1024)
+            except OSError: break
+            while True:
+                if self._smsInput is not None:
+                    end = min([i for i in (pending.find(b"\x1a"), pending.find(b"\x1b")) if i >= 0], default=-1)
+                    if end < 0: break
+                    text, terminator, pending = pending[:end], pending[end:end+1], pending[end+1:]
+                    self._finishSMS(text.decode("latin1"), terminator == b"\x1a")
+                    continue
+                if b"\r" not in pending: break
+                line, pending = pending.split(b"\r", 1)
+                line = line.decode("latin1").strip()
+                if len(line): self._handleLine(line)
+
+    def _handleLine(self, line):
+        self.commandLog.append((time.time(), line))
+        if not self.poweredOn: return
+        if not line.upper().startswith("AT"): return
+        if self.echo: self._write(line + "\r")
+        time.sleep(self.responseDelay)
+        response = []
+        try:
+            for cmd in self._splitCommands(line[2:]):
+                info = self._execute(cmd)
+                if info == ">":
+                    self._write("\r\n> ")
+                    return
+                response.extend(info)
+        except CommandError:
+            response.append("ERROR")
+        else:
+            response.append("OK")
+        self._write("".join("\r\n{}\r\n".format(l) for l in response))
+
+    def _splitCommands(self, body):
+        """
+        Split a concatenated command line (AT+CMGF=1;+CSDH=1) into its commands.
+        A dial command keeps its trailing semicolon
+        """
+        if body.upper().startswith("D"): return [body]
+        commands, current, quoted = [], "", False
+        for char in body:
+            if char == '"': quoted = not quoted
+            if char == ";" and not quoted:
+                commands.append(current)
+                current = ""
+                continue
+            current += char
+        commands.append(current)
+        return [c for c in commands if len(c)] or [""]
+
+    def _execute(self, cmd):
+        upper = cmd.upper()
+        if upper == "": return []
+        if upper in ("E0", "E1"):
+            self.echo = upper == "E1"
+            return []
+        if upper.startswith("L") or upper.startswith("+CLVL") or upper.startswith("+CLTS") or upper.startswith("+CCLK="):
+            return []
+        if upper == "H":
+            self._hangUp()
+            return []
+        if upper == "A": return self._answer()
+        if upper.startswith("D"): return self._dial(cmd[1:].rstrip(";"))
+        name, _, args = cmd.partition("=")
+        name = name.upper()
+        if name == "+CLCC":
+            if args: self._settings["clcc"] = int(args)
+            return [self._clccLine(call) for call in self._calls.values()]
+        if name == "+MORING":
+            self._settings["moring"] = int(args)
+            return []
+        if name == "+CEER":
+            return [] if args else ["+CEER: {}".format(self._lastRelease)]
+        if name in ("+CMGF", "+CSDH", "+CNMI"): return []
+        if name == "+CPMS?":
+            used = len(self.storedSMS)
+            return ['+CPMS: "SM",{0},{1},"SM",{0},{1},"SM",{0},{1}'.format(used, self.smsCapacity)]
+        if name == "+CMGR": return self._readSMS(int(args))
+        if name == "+CMGL": return self._listSMS(args.strip('"'))
+        if name == "+CMGD":
+            self.storedSMS.pop(int(args.split(",")[0]), None)
+            return []
+        if name == "+CMGDA":
+            self.storedSMS.clear()
+            return []
+        if name == "+CMGS":
+            self._smsInput = args.strip('"')
+            return ">"
+        if name == "+CUSD":
+            if args.strip() == "2": return [] #cancel the session
+            code = args.split(",")[1].strip('"') if "," in args else ""
+            threading.Timer(self.ussdDelay, lambda: self.sendURC('+CUSD: 0,"{}",15'.format(self.ussdReply))).start()
+            self.event("ussd", code=code)
+            return []
+        if name == "+CREG?": return ["+CREG: {},{}".format(self._settings["creg"], self.networkStatus)]
+        if name == "+CREG":
+            self._settings["creg"] = int(args)
+            return []
+        if name == "+CSQ": return ["+CSQ: {},0".format(self.csq)]
+        if name == "+CPIN?":
+            if self.simState is None: raise CommandError(cmd) #no SIM
+            return ["+CPIN: {}".format(self.simState)]
+        if name == "+GSN": return ["867856030000000"]
+        if name == "+CCID": return ["8925502000000000000F"]
+        if name == "+CGMR": return ["Revision:1418B05SIM800L24"]
+        if name == "+CCLK?": return [time.strftime('+CCLK: "%y/%m/%d,%H:%M:%S+00"', time.gmtime())]
+        raise CommandError(cmd)
+
+    # --- calls ---------------------------------------------------------------------
+
+    def _newCall(self, number, direction, state):
+        call = {"id":self._nextCallId, "number":number, "direction":direction, "state":state}
+        self._nextCallId += 1
+        self._calls[call["id"]] = call
+        self._reportCall(call)
+        return call
+
+    def _clccLine(self, call):
+        return '+CLCC: {},{},{},0,0,"{}",145,""'.format(call["id"], call["direction"], call["state"], call["number"])
+
+    def _reportCall(self, call):
+        if self._settings["clcc"]: self.sendURC(self._clccLine(call))
+
+    def _setCallState(self, call, state):
+        with self._lock:
+            if call["id"] not in self._calls: return False
+            call["state"] = state
+            self._reportCall(call)
+        return True
+
+    def _endCall(self, call, result, reason):
+        with self._lock:
+            if self._calls.pop(call["id"], None) is None: return
+            call["state"] = 6
+            self._reportCall(call)
+            self._lastRelease = reason
+        self.event("call ended", number=call["number"], result=result)
+        if result: self.sendURC(result)
+
+    def _hangUp(self):
+        with self._lock:
+            calls = list(self._calls.values())
+        for call in calls: self._endCall(call, None, "Normal call clearing")
+
+    def _answer(self):
+        with self._lock:
+            for call in self._calls.values():
+                if call["state"] == 4:
+                    self._setCallState(call, 0)
+                    self.event("call answered", number=call["number"])
+                    return []
+        raise CommandError("A")
+
+    def _dial(self, number):
+        with self._lock:
+            if len(self._calls) or self.networkStatus not in (1, 5): raise CommandError("D")
+            call = self._newCall(number, 0, 2)
+        self.event("dial", number=number)
+        threading.Thread(target=self._progressCall, args=(call, self.callOutcomes.get(number, self.callOutcome)), daemon=True).start()
+        return []
+
+    def _progressCall(self, call, outcome):
+        time.sleep(self.dialTime)
+        if outcome == CALL_NO_BALANCE:
+            if self._setCallState(call, 0): self.event("call outcome", outcome=outcome)
+            return
+        if not self._setCallState(call, 3): return
+        if self._settings["moring"]: self.sendURC("MO RING")
+        self.event("alerting")
+        time.sleep(self.ringTime if outcome != CALL_NO_ANSWER else self.noAnswerTimeout)
+        if call["id"] not in self._calls: return
+        self.event("call outcome", outcome=outcome)
+        if outcome == CALL_ANSWER:
+            if not self._setCallState(call, 0): return
+            if self._settings["moring"]: self.sendURC("MO CONNECTED")
+            time.sleep(self.answerHold)
+            self._endCall(call, "NO CARRIER", "Normal call clearing")
+        elif outcome == CALL_BUSY: self._endCall(call, "BUSY", "User busy")
+        elif outcome == CALL_REJECT: self._endCall(call, "NO CARRIER", "Call rejected")
+        elif outcome == CALL_NO_ANSWER: self._endCall(call, "NO ANSWER", "No answer")
+
+    # --- SMS -----------------------------------------------------------------------
+
+    def _finishSMS(self, text, send):
+        number, self._smsInput = self._smsInput, None
+        if not send:
+            self._write("\r\nOK\r\n")
+            return
+        def sent():
+            self._messageReference += 1
+            self.sentSMS.append((time.time(), number, text))
+            self.event("sms sent", number=number)
+            self._write("\r\n+CMGS: {}\r\n\r\nOK\r\n".format(self._messageReference))
+        threading.Timer(self.smsSendDelay, sent).start()
+
+    def _smsHeader(self, sms):
+        return '"{}","{}","","{}"'.format(sms["stat"], sms["sender"],
+                time.strftime("%y/%m/%d,%H:%M:%S+00", time.gmtime(sms["timestamp"])))
+
+    def _readSMS(self, index):
+        sms = self.storedSMS.get(index)
+        if sms is None: return []
+        lines = ["+CMGR: {},145,4,0,0,\"+447785016005\",145,{}".format(self._smsHeader(sms), len(sms["text"]))]
+        lines.extend(sms["text"].split("\n"))
+        if sms["stat"] == "REC UNREAD": sms["stat"] = "REC READ"
+        return lines
+
+    def _listSMS(self, stat):
+        if stat not in SMS_STATS: raise CommandError(stat)
+        lines = []
+        for index in sorted(self.storedSMS):
+            sms = self.storedSMS[index]
+            if SMS_STATS[stat] is not None and sms["stat"] != SMS_STATS[stat]: continue
+            lines.append("+CMGL: {},{},145,{}".format(index, self._smsHeader(sms), len(sms["text"])))
+            lines.extend(sms["text"].split("\n"))
+            if sms["stat"] == "REC UNREAD": sms["stat"] = "REC READ"
+        return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve an emulated SIM800 on a pseudo-terminal")
+    parser.add_argument("--delay", type=float, default=.005, help="seconds before each response")
+    parser.add_argument("--outcome", choices=CALL_OUTCOMES, default=CALL_ANSWER, help="outcome of outgoing calls")
+    parser.add_argument("--ring-time", type=float, default=3., help="seconds an outgoing call rings before its outcome")
+    args = parser.parse_args()
+    emulator = SIM800Emulator(responseDelay=args.delay, callOutcome=args.outcome, ringTime=args.ring_time)
+    emulator.start()
+    print("SIM800 emulator listening on {}".format(emulator.port), flush=True)
+    try:
+        while True: time.sleep(1.)
+    except KeyboardInterrupt:
+        pass
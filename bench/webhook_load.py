@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+"""
+Load benchmark for the motion webhook server.
+
+Fires a burst of concurrent keep-alive camera clients at the webhook server and reports
+requests per second and latency percentiles. The event sink simulates the IPC consumer
+with a configurable delay, so the effect of a slow consumer on the cameras is visible.
+With --legacy the single threaded http.server implementation that preceded
+webhook.WebhookServer is measured under the same load for comparison.
+"""
+import argparse, asyncio, os, sys, threading, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT) #common reads main.conf from the working directory
+
+import logging
+import common
+import webhook
+
+REQUEST = b"GET /?motion HTTP/1.1\r\nHost: bench\r\n\r\n"
+REQUEST_CLOSE = b"GET /?motion HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n"
+
+async def camera(port, requests, keepAlive, latencies):
+    reader = writer = None
+    for n in range(requests):
+        start = time.perf_counter()
+        if writer is None:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(REQUEST if keepAlive else REQUEST_CLOSE)
+        await writer.drain()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""): break
+            if line.lower().startswith(b"content-length:"): length = int(line.split(b":")[1])
+        if length: await reader.readexactly(length)
+        else: await reader.read() #legacy server closes the connection to delimit the body
+        latencies.append(time.perf_counter() - start)
+        if not keepAlive or not length:
+            writer.close()
+            reader = writer = None
+    if writer is not None: writer.close()
+
+async def burst(port, cameras, requests, keepAlive):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[camera(port, requests, keepAlive, latencies) for i in range(cameras)])
+    return time.perf_counter() - start, sorted(latencies)
+
+def percentile(values, p):
+    return values[min(len(values)-1, int(len(values) * p / 100.))]
+
+def startLegacyServer(sink):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-type", "text/html")
+            self.end_headers()
+            self.wfile.write(b"Received\r\n")
+            sink([common.MOTION_DETECTED_COMMAND])
+        def log_message(self, format, *args): pass
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    server.request_queue_size = 128
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+async def main(args):
+    received = []
+    def sink(messages):
+        time.sleep(args.sink_delay)
+        received.extend(messages)
+
+    if args.legacy:
+        port = startLegacyServer(sink)
+    else:
+        server = webhook.WebhookServer("127.0.0.1", 0, sink, queueSize=args.cameras * args.requests)
+        await server.start()
+        port = server.port
+    elapsed, latencies = await burst(port, args.cameras, args.requests, not args.legacy)
+    total = len(latencies)
+    print("server:      {}".format("legacy http.server" if args.legacy else "webhook.WebhookServer"))
+    print("requests:    {} ({} cameras x {})".format(total, args.cameras, args.requests))
+    print("throughput:  {:.0f} req/s".format(total / elapsed))
+    print("latency p50: {:.2f} ms".format(percentile(latencies, 50) * 1000))
+    print("latency p99: {:.2f} ms".format(percentile(latencies, 99) * 1000))
+    print("latency max: {:.2f} ms".format(latencies[-1] * 1000))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cameras", type=int, default=20, help="concurrent camera clients")
+    parser.add_argument("--requests", type=int, default=50, help="requests per camera")
+    parser.add_argument("--sink-delay", type=float, default=0., help="seconds the IPC consumer takes per event")
+    parser.add_argument("--legacy", action="store_true", help="measure the old single threaded http.server")
+    args = parser.parse_args()
+    common.homeSecurityLogger.setLevel(logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque, OrderedDict
+
+#key shared by the cameras beyond MotionCoalescer.maxCameras. Not a valid camera id
+OTHER_CAMERAS = "*"
+
+class MotionDecision(object):
+    """
+    Outcome of offering a motion event to the MotionCoalescer
+    """
+    def __init__(self, notify, reason, summary):
+        self.notify = notify
+        self.reason = reason
+        self.summary = summary
+
+
+class MotionCoalescer(object):
+    """
+    Decides which motion events start a notification run, keyed by camera. Thread safe.
+
+    - Repeats from a camera within dedupWindow seconds of its previous event are duplicates
+      (e.g. a camera retrying its webhook) and are not counted again. The window slides
+      with every repeat.
+    - The notify gap is kept per camera: after a camera has triggered a notification it is
+      muted for notifyGap seconds, without muting the other cameras.
+    - While a notification run is in progress, events from any camera are folded into it
+      instead of starting another run.
+    - The alert summarises the burst that triggered it: the events from all cameras in the
+      last burstWindow seconds, plus those aggregated into the run since.
+    Cameras are forgotten once their last event is past the dedup window and their last
+    notification past the notify gap. At most maxCameras are tracked at once; events from
+    further cameras share one notify gap, so a client making up camera ids cannot get
+    around it or grow the tables
+    """
+    def __init__(self, notifyGap, dedupWindow=10., burstWindow=30., maxCameras=64):
+        self.notifyGap = float(notifyGap)
+        self.dedupWindow = float(dedupWindow)
+        self.burstWindow = float(burstWindow)
+        self.maxCameras = int(maxCameras)
+        self._lock = threading.Lock()
+        self._lastEvent = OrderedDict() #camera -> time of its last event, oldest first
+        self._lastNotified = OrderedDict() #camera -> time of its last notification, oldest first
+        self._recent = deque()
+        self._runActive = False
+        self._runEvents = []
+        self.stats = {"events":0, "duplicates":0, "muted":0, "aggregated":0, "notified":0}
+
+    def offer(self, camera, timestamp=None):
+        """
+        Register a motion event from camera and decide whether it should start a notification
+        """
+        now = time.time() if timestamp is None else timestamp
+        with self._lock:
+            self.stats["events"] += 1
+            self._forget(now)
+            camera = self._key(camera)
+            lastEvent = self._lastEvent.pop(camera, None)
+            self._lastEvent[camera] = now
+            if lastEvent is not None and now - lastEvent < self.dedupWindow:
+                self.stats["duplicates"] += 1
+                return MotionDecision(False, "duplicate of an event {:.1f}s ago".format(now - lastEvent), self._summary(now))
+
+            self._recent.append((now, camera))
+            summary = self._summary(now)
+            if self._runActive:
+                self.stats["aggregated"] += 1
+                self._lastNotified.pop(camera, None)
+                self._lastNotified[camera] = now
+                self._runEvents.append((now, camera))
+                return MotionDecision(False, "aggregated into the running notification", summary)
+
+            lastNotified = self._lastNotified.get(camera)
+            if lastNotified is not None and now < lastNotified + self.notifyGap:
+                self.stats["muted"] += 1
+                return MotionDecision(False, "still within notify gap ({}m). Last notification: {}"
+                        .format(int(self.notifyGap / 60), time.asctime(time.localtime(lastNotified))), summary)
+
+            self.stats["notified"] += 1
+            self._lastNotified.pop(camera, None)
+            self._lastNotified[camera] = now
+            self._runActive = True
+            self._runEvents = list(self._recent)
+            return MotionDecision(True, "notify", summary)
+
+    def _forget(self, now):
+        while len(self._lastEvent) and next(iter(self._lastEvent.values())) <= now - self.dedupWindow:
+            self._lastEvent.popitem(last=False)
+        while len(self._lastNotified) and next(iter(self._lastNotified.values())) <= now - self.notifyGap:
+            self._lastNotified.popitem(last=False)
+
+    def _key(self, camera):
+        """
+        camera, or OTHER_CAMERAS if it is not tracked and there is no room for it
+        """
+        if camera in self._lastEvent or camera in self._lastNotified: return camera
+        tracked = set(self._lastEvent) | set(self._lastNotified)
+        if len(tracked) < self.maxCameras: return camera
+        return OTHER_CAMERAS
+
+    def runSummary(self):
+        """
+        Describe the events behind the current notification run
+        """
+        with self._lock:
+            return self._describe(self._runEvents, "since {}".format(
+                    time.strftime("%H:%M:%S", time.localtime(self._runEvents[0][0]))) if len(self._runEvents) else "")
+
+    def runFinished(self):
+        """
+        Must be called when the notification run started by a notify decision has finished
+        """
+        with self._lock:
+            self._runActive = False
+
+    def _summary(self, now):
+        while len(self._recent) and self._recent[0][0] < now - self.burstWindow:
+            self._recent.popleft()
+        return self._describe(self._recent, "in the last {}s".format(int(self.burstWindow)))
+
+    def _describe(self, events, period):
+        cameras = set(camera for _, camera in events)
+        return "{} event{} from {} camera{} {}".format(
+                len(events), "" if len(events) == 1 else "s",
+                len(cameras), "" if len(cameras) == 1 else "s", period).strip()
@@ -1,44 +1,49 @@
-import logging, sys
-import configparser
-import threading
+import logging, re, sys, os
+import logpipeline
+import settings
 
-config = configparser.ConfigParser(allow_no_value=True)
-config.read('main.conf')
+#typed snapshot of main.conf. Take configStore.current() once per unit of work; the snapshot
+#is swapped on SIGHUP (see configStore.requestReload) or when the file changes
+CONFIG_PATH = os.environ.get('HOMESEC_CONFIG', 'main.conf')
+configStore = settings.ConfigStore(CONFIG_PATH)
 
-#notifying phone numbers
-nums = []
-for number in config['MOTION_NOTIFICATION_NUMBERS']: nums.append(number)
-NOTIFY_GSM_NUMBERS = tuple(nums)
-
-#retry attempts
-REDIAL_COUNT = config['MOTION_NOTIFICATION_SETTINGS']['Redials']
-
-#notification settings
-NOTIFY_GAP = config['MOTION_NOTIFICATION_SETTINGS']['NotifyGap']
-
-#meye nvr server info
-NVR_SERVER_MAC_ADDRESS = config['SERVER']['ServerMAC']
-NVR_SERVER_IP_ADDRESS = config['SERVER']['ServerIP']
-NVR_SERVER_PORT = config['SERVER']['ServerPort']
-
-#logging settings
+#logging settings. Records go through a queue to a background writer, so slow log storage
+#never holds up the serial or notification path
 homeSecurityLogger = logging.getLogger('MAINLOG')
 handler=logging.StreamHandler(sys.stdout)
 handler.setFormatter(logging.Formatter("%(asctime)s %(filename)-12.12s %(levelname)-8s: %(message)s"))
-homeSecurityLogger.addHandler(handler)
-homeSecurityLogger.setLevel(logging.DEBUG)
+logConfig = configStore.current()
+logpipeline.startLogging(homeSecurityLogger, handler, logConfig.logLevel, logConfig.logModuleLevels,
+        queueSize=logConfig.logQueueSize, repeatBurst=logConfig.logRepeatBurst, repeatInterval=logConfig.logRepeatInterval)
 
-#named pipe for IPC
-FIFO = 'homesecpipe'
+def applyLogSettings(old, new):
+    logpipeline.setLevels(homeSecurityLogger, new.logLevel, new.logModuleLevels, old.logModuleLevels)
+    logpipeline.setRepeatLimit(homeSecurityLogger, new.logRepeatBurst, new.logRepeatInterval)
+configStore.onChange(applyLogSettings)
 
-#ports
-WEBSERVER_PORT=9090
+def getLogger(module):
+    """
+    Logger for a module, a child of homeSecurityLogger whose level can be set in [LOGGING]
+    """
+    return homeSecurityLogger.getChild(module)
+
+#unix domain socket for IPC
+IPC_SOCKET = 'homesecsock'
 
 #some IPC commands
 MOTION_DETECTED_COMMAND = 'MOTIONDETECT'
 WEBSERVER_READY_COMMAND = 'HTTPREADY'
 WEBSERVER_FAIL_COMMAND = 'HTTPFAIL'
 
+#camera ids accepted in motion and snapshot requests. They end up in SMS alerts and log lines
+CAMERA_ID = re.compile(r'[A-Za-z0-9_.-]{1,32}\Z')
+
+def validCamera(camera):
+    """
+    True if camera is None (a request naming no camera) or a well formed camera id
+    """
+    return camera is None or CAMERA_ID.match(camera) is not None
+
 #kill flag. once set, all processes and threads should respect it and gracefully terminate
 KILL_FLAG = False
 
@@ -0,0 +1,111 @@
+import json
+import math
+import os
+import threading
+import time
+
+import common
+
+logger = common.getLogger('dialstats')
+
+BUCKET_HOURS = 4 #time of day buckets: 0-4h, 4-8h, ...
+MAX_RING_TIMES = 50 #ring times kept per number and bucket
+PRIOR_ANSWER_RATE = .5 #assumed for a number without history
+PRIOR_WEIGHT = 2. #in attempts; how quickly history outweighs the prior
+MIN_RING_SAMPLES = 5 #answered calls needed before the ring time percentile is used
+
+def bucketOf(when):
+    return str(time.localtime(when).tm_hour // BUCKET_HOURS)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(math.ceil(len(values) * p / 100.)) - 1)]
+
+
+class DialStats(object):
+    """
+    Per number call history by time of day: attempts, answers and the ring times of answered
+    calls, persisted as JSON in path. NotificationRun records every attempt that rang to the
+    end (calls hung up because somebody else answered, or that could not be dialled, are left
+    out) and saves once per run.
+    order() sorts numbers to minimise the expected time to contact and ringTimeout() gives a
+    number's timeout from its 95th percentile ring time, so a number that is always answered
+    within 15s is not rung for a minute when nobody is there.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._numbers = {} #number -> bucket -> {"attempts", "answered", "ringTimes"}
+        self._dirty = False
+        try:
+            with open(path) as statsFile:
+                self._numbers = json.load(statsFile)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error("Failed to read dialing statistics from %s: %s. Starting afresh", path, e)
+
+    def record(self, number, when, answered, ringTime=None):
+        with self._lock:
+            bucket = self._numbers.setdefault(number, {}).setdefault(bucketOf(when), {"attempts":0, "answered":0, "ringTimes":[]})
+            bucket["attempts"] += 1
+            if answered:
+                bucket["answered"] += 1
+                if ringTime is not None: bucket["ringTimes"] = (bucket["ringTimes"] + [round(ringTime, 1)])[-MAX_RING_TIMES:]
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty: return
+            try:
+                with open(self.path + ".tmp", "w") as statsFile:
+                    json.dump(self._numbers, statsFile)
+                os.replace(self.path + ".tmp", self.path)
+                self._dirty = False
+            except OSError as e:
+                logger.error("Failed to save dialing statistics to %s: %s", self.path, e)
+
+    def _history(self, number, when):
+        """
+        (attempts, answered, ring times) at the time of day of when, falling back to all day
+        for the ring times when that bucket has too few
+        """
+        with self._lock:
+            buckets = self._numbers.get(number, {})
+            bucket = buckets.get(bucketOf(when), {"attempts":0, "answered":0, "ringTimes":[]})
+            ringTimes = list(bucket["ringTimes"])
+            if len(ringTimes) < MIN_RING_SAMPLES:
+                ringTimes = [ringTime for other in buckets.values() for ringTime in other["ringTimes"]]
+            return bucket["attempts"], bucket["answered"], ringTimes
+
+    def answerRate(self, number, when):
+        attempts, answered, _ = self._history(number, when)
+        return (answered + PRIOR_ANSWER_RATE * PRIOR_WEIGHT) / (attempts + PRIOR_WEIGHT)
+
+    def ringTimeout(self, number, when, default, minimum, margin=5.):
+        """
+        The p95 ring time plus margin, kept within [minimum, default]. default until the number
+        has MIN_RING_SAMPLES answered calls
+        """
+        _, _, ringTimes = self._history(number, when)
+        if len(ringTimes) < MIN_RING_SAMPLES: return default
+        return float(max(minimum, min(default, percentile(ringTimes, 95) + margin)))
+
+    def order(self, numbers, when, timeouts):
+        """
+        Sort numbers by expected time spent per chance of contact: (p * mean ring time +
+        (1 - p) * timeout) / p, lowest first, which minimises the expected time until somebody
+        answers when the attempts are tried one after the other. Ties keep the given order
+        """
+        def cost(number):
+            p = self.answerRate(number, when)
+            _, _, ringTimes = self._history(number, when)
+            timeout = timeouts.get(number)
+            meanRing = sum(ringTimes) / len(ringTimes) if len(ringTimes) else timeout / 2.
+            return (p * meanRing + (1 - p) * timeout) / p
+        return sorted(numbers, key=cost)
+
+    def describe(self, number, when):
+        attempts, answered, ringTimes = self._history(number, when)
+        return "{}/{} answered, p95 ring {}".format(answered, attempts,
+                "{:.0f}s".format(percentile(ringTimes, 95)) if len(ringTimes) else "unknown")
@@ -0,0 +1,212 @@
+import contextlib
+import threading
+import time
+from collections import deque
+
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_REJECT = "reject"
+OVERFLOW_POLICIES = (OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT)
+
+#priority classes of jobs, most urgent first
+PRIORITY_ALARM = "alarm"
+PRIORITY_CALL = "call"
+PRIORITY_HOUSEKEEPING = "housekeeping"
+PRIORITIES = (PRIORITY_ALARM, PRIORITY_CALL, PRIORITY_HOUSEKEEPING)
+
+_current = threading.local()
+
+def currentJob():
+    """
+    The Job this thread runs, or None outside a worker (see Job.adopt)
+    """
+    return getattr(_current, "job", None)
+
+def rankOf(priority):
+    return PRIORITIES.index(priority)
+
+
+class Job(object):
+    """
+    A queued unit of work. deadline is the wall clock time by which it must have started, None
+    for no limit. cancelled is set when more urgent work is waiting: a long job should then
+    give up at its next safe point (and queue whatever is left as a new job)
+    """
+    def __init__(self, func, key, onDrop, priority=PRIORITY_HOUSEKEEPING, deadline=None):
+        self.func = func
+        self.key = key
+        self.onDrop = onDrop
+        self.priority = priority
+        self.rank = rankOf(priority)
+        self.deadline = deadline
+        self.queuedAt = time.time()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def expired(self, now=None):
+        return self.deadline is not None and (time.time() if now is None else now) > self.deadline
+
+    @contextlib.contextmanager
+    def adopt(self):
+        """
+        Run the block as part of this job, e.g. in a thread the job started
+        """
+        previous = currentJob()
+        _current.job = self
+        try:
+            yield self
+        finally:
+            _current.job = previous
+
+
+class EventDispatcher(object):
+    """
+    Runs jobs on a fixed pool of worker threads fed from a bounded queue, so a storm of
+    events cannot grow the number of threads or the memory used without limit.
+    Jobs start in priority order (PRIORITIES), first come first served within a class. A job
+    still queued after its deadline is dropped. When a job arrives while every worker is busy
+    with less urgent work, the least urgent running job is cancelled (see Job).
+    When the queue is full a new job displaces the newest job of a less urgent class. If there
+    is none the overflow policy decides what happens to it:
+    - coalesce: dropped if a job with the same key is already queued, otherwise rejected
+    - drop-oldest: the oldest queued job of its class is discarded to make room
+    - reject: the new job is refused
+    """
+    def __init__(self, name, logger, workers=1, capacity=16, overflow=OVERFLOW_COALESCE):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
+        self.name = name
+        self._logger = logger
+        self._capacity = int(capacity)
+        self._overflow = overflow
+        self._queues = tuple(deque() for priority in PRIORITIES)
+        self._running = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._counters = {"submitted":0, "completed":0, "failed":0, "coalesced":0, "dropped":0, "rejected":0,
+                "expired":0, "cancelled":0}
+        self._waits = dict((priority, {"started":0, "waitTotal":0., "waitMax":0.}) for priority in PRIORITIES)
+        self._workers = []
+        for n in range(int(workers)):
+            worker = threading.Thread(target=self._work, name="{}-{}".format(name, n+1), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, func, key=None, onDrop=None, priority=PRIORITY_HOUSEKEEPING, deadline=None):
+        """
+        Queue func to run on a worker. Returns False if the job was not queued.
+        onDrop is called if the job is later discarded from the queue without running
+        """
+        job = Job(func, key, onDrop, priority, deadline)
+        with self._condition:
+            self._counters["submitted"] += 1
+            if self._depth() >= self._capacity:
+                if not self._makeRoom(job): return False
+            self._queues[job.rank].append(job)
+            self._condition.notify()
+            if len(self._running) >= len(self._workers): self._preempt(job)
+        return True
+
+    def _depth(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def _makeRoom(self, job):
+        for rank in range(len(PRIORITIES)-1, job.rank, -1):
+            if len(self._queues[rank]):
+                displaced = self._queues[rank].pop()
+                self._drop(displaced, "{} job ({}) displaced by {} job ({})".format(displaced.priority, displaced.key,
+                        job.priority, job.key))
+                return True
+        if self._overflow == OVERFLOW_DROP_OLDEST and len(self._queues[job.rank]):
+            dropped = self._queues[job.rank].popleft()
+            self._drop(dropped, "Dropped oldest job ({})".format(dropped.key))
+            return True
+        if self._overflow == OVERFLOW_COALESCE and job.key is not None and any(queued.key == job.key
+                for queue in self._queues for queued in queue):
+            self._counters["coalesced"] += 1
+            self._logger.info("%s queue full. Job (%s) coalesced with a queued one", self.name, job.key)
+            return False
+        self._counters["rejected"] += 1
+        self._logger.warning("%s queue full. Rejected job (%s)", self.name, job.key)
+        return False
+
+    def _drop(self, dropped, reason):
+        self._counters["dropped"] += 1
+        self._logger.warning("%s queue full. %s", self.name, reason)
+        if dropped.onDrop is not None: dropped.onDrop()
+
+    def _preempt(self, job):
+        """
+        Cancel the least urgent running job if it is less urgent than job and nothing is giving way yet
+        """
+        lessUrgent = [running for running in self._running if running.rank > job.rank]
+        if not len(lessUrgent) or any(running.cancelled.is_set() for running in lessUrgent): return
+        victim = max(lessUrgent, key=lambda running: running.rank)
+        self._counters["cancelled"] += 1
+        self._logger.info("%s cancelling %s job (%s) for %s job (%s)", self.name, victim.priority, victim.key, job.priority, job.key)
+        victim.cancel()
+
+    def stats(self):
+        """
+        Queue depth, job counters and queue wait times in seconds, overall and per priority class
+        """
+        with self._condition:
+            stats = dict(self._counters)
+            stats["depth"] = self._depth()
+            started = sum(waits["started"] for waits in self._waits.values())
+            stats["waitAvg"] = sum(waits["waitTotal"] for waits in self._waits.values()) / started if started else 0.
+            stats["waitMax"] = max(waits["waitMax"] for waits in self._waits.values())
+            stats["waits"] = dict((priority, {"started":waits["started"], "waitMax":waits["waitMax"],
+                    "waitAvg":waits["waitTotal"] / waits["started"] if waits["started"] else 0.})
+                    for priority, waits in self._waits.items())
+        return stats
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _next(self):
+        """
+        Take the most urgent job off the queue, dropping any past their deadline. None if empty
+        """
+        now = time.time()
+        for queue in self._queues:
+            while len(queue):
+                job = queue.popleft()
+                if not job.expired(now): return job
+                self._counters["expired"] += 1
+                self._logger.warning("%s dropped %s job (%s) not started %.1fs after its deadline",
+                        self.name, job.priority, job.key, now - job.deadline)
+                if job.onDrop is not None: job.onDrop()
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = None
+                while job is None:
+                    while not self._depth() and not self._stopped: self._condition.wait()
+                    if self._stopped: return
+                    job = self._next()
+                wait = time.time() - job.queuedAt
+                waits = self._waits[job.priority]
+                waits["started"] += 1
+                waits["waitTotal"] += wait
+                waits["waitMax"] = max(waits["waitMax"], wait)
+                self._running.append(job)
+            self._logger.debug("%s running %s job (%s) after %.2fs in queue", threading.current_thread().name,
+                    job.priority, job.key, wait)
+            try:
+                with job.adopt():
+                    job.func()
+            except Exception:
+                self._logger.exception("%s job (%s) failed", self.name, job.key)
+                outcome = "failed"
+            else:
+                outcome = "completed"
+            with self._condition:
+                self._running.remove(job)
+                self._counters[outcome] += 1
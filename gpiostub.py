@@ -0,0 +1,28 @@
+"""
+Stand-in for RPi.GPIO on machines without the Raspberry Pi GPIO header, e.g. when
+running against the SIM800 emulator. Select it with HOMESEC_GPIO=stub.
+Only the calls used by sim800 are provided; pin changes are recorded and passed to
+the optional onOutput hook.
+"""
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+
+pins = {}
+onOutput = None
+
+def setmode(mode):
+    pass
+
+def setup(channel, direction, initial=LOW):
+    pins[channel] = initial
+
+def output(channel, state):
+    pins[channel] = state
+    if onOutput is not None: onOutput(channel, state)
+
+def cleanup():
+    pins.clear()
@@ -0,0 +1,118 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import common
+
+logger = common.getLogger('ipc')
+
+def makeMessage(kind, camera=None, timestamp=None):
+    """
+    Build an IPC message: the event type, the camera it came from (if any) and when it happened
+    """
+    return {"type": kind, "camera": camera, "ts": time.time() if timestamp is None else timestamp}
+
+def encodeMessages(messages):
+    """
+    Frame messages for the channel: one JSON document per line
+    """
+    return b"".join(json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n" for message in messages)
+
+
+class IPCServer(threading.Thread):
+    """
+    Listening end of the IPC channel, a Unix domain stream socket carrying newline framed
+    JSON messages. Clients keep their connection open and may send several messages at once.
+    Every message received is passed to handler, on the reading thread of its connection.
+    """
+    def __init__(self, path, handler):
+        threading.Thread.__init__(self, name="IPCServer", daemon=True)
+        self._path = path
+        self._handler = handler
+        self._socket = None
+
+    def bind(self):
+        """
+        Create the listening socket, replacing a stale socket file. Raises OSError on failure
+        """
+        try:
+            os.remove(self._path)
+            logger.debug("A pre-existing IPC socket file was removed")
+        except FileNotFoundError:
+            pass
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self._path)
+        self._socket.listen(8)
+
+    def close(self):
+        if self._socket is not None: self._socket.close()
+        try:
+            os.remove(self._path)
+            logger.info("IPC socket deleted")
+        except OSError:
+            logger.warning("Failed to delete IPC socket.")
+
+    def run(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                break #socket closed
+            thread = threading.Thread(target=self._readConnection, args=(connection,), name="IPCConnection", daemon=True)
+            thread.start()
+
+    def _readConnection(self, connection):
+        logger.debug("IPC client connected")
+        with connection, connection.makefile("rb") as stream:
+            for line in stream:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    logger.error("Discarding malformed IPC message: %s", line)
+                    continue
+                logger.debug("IPC data received: %s", message)
+                try:
+                    self._handler(message)
+                except Exception:
+                    logger.exception("IPC message handler failed")
+        logger.debug("IPC client disconnected")
+
+
+class IPCClient(object):
+    """
+    Sending end of the IPC channel. Keeps one connection open and reconnects when it breaks.
+    """
+    def __init__(self, path, attempts=3, retryDelay=.5):
+        self._path = path
+        self._attempts = attempts
+        self._retryDelay = retryDelay
+        self._socket = None
+        self._lock = threading.Lock()
+
+    def send(self, messages):
+        """
+        Send a batch of messages in one write. Returns True if it was handed to the server
+        """
+        data = encodeMessages(messages)
+        with self._lock:
+            for attempt in range(self._attempts):
+                try:
+                    if self._socket is None:
+                        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self._socket.connect(self._path)
+                    self._socket.sendall(data)
+                    logger.debug("Sent %s message(s) over IPC", len(messages))
+                    return True
+                except OSError as e:
+                    logger.warning("IPC send failed (attempt %s): %s", attempt+1, e)
+                    self.close()
+                    time.sleep(self._retryDelay)
+        logger.critical("IPC write failed. Is the main daemon running?")
+        return False
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
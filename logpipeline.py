@@ -0,0 +1,123 @@
+import atexit
+import copy
+import logging
+import logging.handlers
+import queue
+import threading
+
+class RepeatFilter(logging.Filter):
+    """
+    Rate limits repeated log records: after burst identical records (same call site, message
+    and arguments) within interval seconds the rest are suppressed, and the first one let
+    through after the interval says how many were suppressed.
+    """
+    def __init__(self, burst=5, interval=60., maxKeys=1000):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.maxKeys = maxKeys
+        self._lock = threading.Lock()
+        self._windows = {} #key -> [window start, records in window, suppressed]
+
+    def filter(self, record):
+        if self.burst <= 0: return True
+        try:
+            key = (record.pathname, record.lineno, record.msg, record.args)
+            hash(key)
+        except TypeError:
+            key = (record.pathname, record.lineno, record.msg)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                if len(self._windows) >= self.maxKeys: self._prune(record.created)
+                self._windows[key] = [record.created, 1, 0]
+                return True
+            if record.created - window[0] >= self.interval:
+                if window[2]:
+                    record.msg = "{} ({} similar messages suppressed)".format(record.msg, window[2])
+                window[:] = [record.created, 1, 0]
+                return True
+            window[1] += 1
+            if window[1] <= self.burst: return True
+            window[2] += 1
+            return False
+
+    def _prune(self, now):
+        for key, window in list(self._windows.items()):
+            if now - window[0] >= self.interval: del self._windows[key]
+        #many distinct messages within one interval: start over rather than scan on every record
+        if len(self._windows) >= self.maxKeys: self._windows.clear()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks the logging thread: records are dropped (and counted) when
+    the queue is full, and formatting is left to the listener thread. Only the message
+    arguments are merged in the calling thread, so later changes to them do not show up.
+    """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if self.dropped: record.msg = "({} log records dropped) {}".format(self.dropped, record.msg)
+        return record
+
+    def emit(self, record):
+        if self.queue.full():
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+        else:
+            self.dropped = 0
+
+
+def startLogging(logger, handler, level=logging.DEBUG, moduleLevels=None, queueSize=10000, repeatBurst=5, repeatInterval=60.):
+    """
+    Route logger through a bounded queue to handler, which runs on a background listener thread.
+    moduleLevels maps child logger names (logger.name + "." + module) to their levels.
+    Returns the listener; it is stopped (and the queue flushed) at exit
+    """
+    logQueue = queue.Queue(queueSize)
+    queueHandler = DroppingQueueHandler(logQueue)
+    queueHandler.addFilter(RepeatFilter(repeatBurst, repeatInterval))
+    logger.addHandler(queueHandler)
+    logger.propagate = False
+    setLevels(logger, level, moduleLevels)
+    listener = logging.handlers.QueueListener(logQueue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stopLogging, listener)
+    return listener
+
+def stopLogging(listener):
+    """
+    Write out the queued records and stop the listener thread
+    """
+    if listener._thread is not None: listener.stop()
+
+def setLevels(logger, level, moduleLevels=None, previousModuleLevels=None):
+    """
+    Set the level of logger and of its module children. Modules no longer listed go back to
+    following logger
+    """
+    logger.setLevel(level)
+    moduleLevels = moduleLevels or {}
+    for module in (previousModuleLevels or {}):
+        if module not in moduleLevels: logger.getChild(module).setLevel(logging.NOTSET)
+    for module, moduleLevel in moduleLevels.items():
+        logger.getChild(module).setLevel(moduleLevel)
+
+def setRepeatLimit(logger, burst, interval):
+    for handler in logger.handlers:
+        for logFilter in handler.filters:
+            if isinstance(logFilter, RepeatFilter):
+                logFilter.burst = burst
+                logFilter.interval = interval
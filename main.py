@@ -1,24 +1,49 @@
 #!/usr/bin/python3
 
-import os, subprocess
+import subprocess
 import atexit
 import types
 import threading
 import time
 import signal
+import logging
 
 #project imports
 import common
 import sim800 
+import notification
+import ipc
+import coalescing
+import dispatcher
+import modempool
+import alarmstate
+import smscommands
+import dialstats
+import services
 
-FIFO = common.FIFO
-logger = common.homeSecurityLogger
-gsmLock = threading.Lock()
+logger = common.getLogger('main')
+ringLocks = {}
+
+def handle_sighup(a, b):
+    logger.info("Received SIGHUP. Reloading configuration")
+    common.configStore.requestReload()
+    #the subprocesses (if any) watch the file too, but should not wait for their next check
+    for process in (httpprocess, watchdogprocess):
+        if isinstance(process, subprocess.Popen) and process.poll() is None: process.send_signal(signal.SIGHUP)
+
+def applySettings(old, new):
+    """
+    Apply a reloaded configuration. Notification runs in progress keep the plan they started with
+    """
+    commandEngine.configure(new.notifyNumbers, new.smsCommandMaxAge*60)
+    coalescer.dedupWindow = new.dedupWindow
+    coalescer.burstWindow = new.burstWindow
+    if alarmState.notifyGap is None: setNotifyGap(new.notifyGap)
 
 def handle_sigterm(a, b):
     logger.info("Received SIGTERM. Performing cleanup...")
     common.KILL_FLAG = True
-    gsm.interruptMTDataWait()
+    modemPool.close()
     exit(0)
 
 @atexit.register
@@ -32,146 +57,301 @@ def exit_handler():
         killprocess = item["process"]
         if isinstance(killprocess, subprocess.Popen):
             if killprocess.poll() is None:
-                logger.debug("Terminating {} subprocess".format(processname))
+                logger.debug("Terminating %s subprocess", processname)
                 killprocess.terminate()
                 try:
                    killprocess.wait(killtimeout)
                 except subprocess.TimeoutExpired:
-                    logger.warning("{} subprocess did not terminate within {} seconds".format(processname, killtimeout))
+                    logger.warning("%s subprocess did not terminate within %s seconds", processname, killtimeout)
                 else:
-                    logger.info("{} terminated successfully".format(processname))
+                    logger.info("%s terminated successfully", processname)
             else:
-                logger.info("{} process is already dead".format(processname))
+                logger.info("%s process is already dead", processname)
+
+    if serviceLoop is not None: serviceLoop.stop()
+    if ipcServer is not None: ipcServer.close()
+
 
-    #attempt deleting of pipe
+def handleMotionDetection(eventTime, camera):
+    source = "" if camera is None else " by camera {}".format(camera)
+    def message():
+        return "Motion detected{} on {} ({})".format(
+                source, time.asctime(time.localtime(eventTime)), coalescer.runSummary())
+    plan = notification.NotificationPlan.fromConfig(message, common.configStore.current(), dialStats, eventTime)
+    logger.debug("Handling motion detection event. Dialing order %s, timeouts %s", plan.callNumbers, plan.callTimeouts)
     try:
-        os.remove(FIFO)
-        logger.info("FIFO pipe deleted")
-    except OSError:  
-        logger.warning("Failed to delete pipe.")
-
-
-def handleMotionDetection():
-    global lastNotifTime
-    notifyGapSeconds = float(common.NOTIFY_GAP)*60
-    nextNotifTime = lastNotifTime + notifyGapSeconds
-    if time.time() < nextNotifTime:
-        logger.info("Still within notify gap ({}m). Last event time: {}"
-                .format(int(common.NOTIFY_GAP), time.asctime(time.localtime(lastNotifTime))))
-        return
-    lastNotifTime = time.time()
-    gsm.interruptMTDataWait()
-    with gsmLock:
-        logger.debug("{} acquired GSM lock".format(threading.current_thread().name))
-        logger.debug("Handling motion detection event")
-        notifyComplete = False
-        for number in common.NOTIFY_GSM_NUMBERS:
-            attempt = 1
-            while attempt <= int(common.REDIAL_COUNT)+1 and not common.KILL_FLAG:
-                logger.debug("Attempt {} for GSM number {}".format(attempt, number))
-                callConnected = gsm.placeCall(number)
-                if callConnected: 
-                    notifyComplete = True
-                    break
-                attempt += 1
-            if notifyComplete: 
-                break
-            gsm.sendSMS(number, "Motion detected on {}".format(time.asctime(time.localtime(lastNotifTime))))
-        
+        notification.NotificationRun(plan, modemPool, common.getLogger('notification'), eventTime, dialStats).execute()
+    finally:
+        coalescer.runFinished()
+
     logger.info("Event notification complete")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("GSM modules: %s", modemPool.stats())
+        logger.debug("GSM dispatcher: %s", gsmDispatcher.stats())
+        logger.debug("GSM module leases: %s", modemPool.leaseStats())
 
-def handleMTMessage(message):
+def handleMTMessage(modem, message):
     message = message.upper()
     if message == "RING":
-        gsm.handleIncomingCall(common.NOTIFY_GSM_NUMBERS)
-
-def readFIFO():
-    with open(FIFO) as fifo:
-        while True:
-            data = fifo.read()
-            if len(data) == 0: break
-            logger.debug('IPC data received: "{0}"'.format(data))
-            return data
-
-class SIM800Thread (threading.Thread):
-    def __init__(self, func):
-        threading.Thread.__init__(self)
-        self.target = func
-
-    def run(self):
-        logger.debug("Starting {}".format(self.name))
-        self.target()
-        logger.debug("{} has finished".format(self.name))
-
-class MTDataWaitingThread (threading.Thread):
+        #RING repeats while the phone rings. Handle only one at a time per module
+        ringLock = ringLocks[modem.name]
+        if not ringLock.acquire(blocking=False):
+            logger.debug("Incoming call on %s is already being handled", modem.name)
+            return
+        try:
+            with modemPool.lease(modem) as leased:
+                if leased is None:
+                    logger.warning("Incoming call on %s not handled: GSM module busy past the deadline", modem.name)
+                    return
+                logger.debug("%s leased GSM module %s", threading.current_thread().name, modem.name)
+                modem.gsm.handleIncomingCall(common.configStore.current().notifyNumbers)
+        finally:
+            ringLock.release()
+
+def handleSMS(gsm, record):
+    """
+    Handle an SMS received by gsm, which the caller has leased. Replies go out on the same module
+    """
+    logger.info("SMS from %s received %s: %s", record.number, record.timestamp, record.text)
+    reply = commandEngine.handle(record)
+    if reply is not None and not gsm.sendSMS(record.number, reply):
+        logger.error("Failed to send reply to %s", record.number)
+
+def setNotifyGap(minutes):
+    coalescer.notifyGap = float(minutes) * 60
+
+def motionStatus():
+    stats = coalescer.stats
+    return "{} motion events, {} notified".format(stats["events"], stats["notified"])
+
+def processInbox(modem, indices=None):
+    """
+    Handle the SMS received by a module in the given storage locations (all if None), deleting each once handled.
+    When more urgent work needs the module, the messages left are queued again and the module is given up
+    """
+    with modemPool.lease(modem) as leased:
+        if leased is None:
+            logger.warning("SMS in %s on %s left for later: GSM module busy past the deadline", indices or "all locations", modem.name)
+            return
+        logger.debug("%s leased GSM module %s", threading.current_thread().name, modem.name)
+        job = dispatcher.currentJob()
+        handled = []
+        for record in modem.gsm.inbox(indices):
+            if job is not None and job.cancelled.is_set():
+                #the message just read is only deleted once handled, so it is read again later
+                left = None if indices is None else [index for index in indices if index not in handled]
+                logger.info("Giving up GSM module %s to more urgent work. SMS in %s queued again", modem.name, left or "all locations")
+                submitInbox(modem, left)
+                break
+            handleSMS(modem.gsm, record)
+            handled.append(record.index)
+
+def submitInbox(modem, indices):
+    key = "CMTI{}-{}".format(modem.name, "all" if indices is None else ",".join(str(index) for index in indices))
+    submitGSMWork(lambda: processInbox(modem, indices), key, dispatcher.PRIORITY_HOUSEKEEPING)
+
+def submitGSMWork(func, key, priority, onDrop=None):
+    """
+    Queue work for the GSM workers, with the deadline configured for its priority class
+    """
+    limit = common.configStore.current().dispatchDeadlines[priority]
+    return gsmDispatcher.submit(func, key=key, onDrop=onDrop, priority=priority,
+            deadline=None if limit is None else time.time() + limit)
+
+def onNewSMS(modem, line):
+    """
+    Handler for +CMTI. Runs on the module's serial reader thread
+    """
+    index = sim800.parseNewSMSIndication(line)
+    if index is None:
+        logger.warning("Unexpected new SMS indication: %s", line)
+        return
+    submitInbox(modem, [index])
+
+def onMTMessage(modem, message):
+    """
+    Handler for unsolicited MT data. Runs on the module's serial reader thread, so the
+    actual handling is queued for the GSM workers
+    """
+    submitGSMWork(lambda: handleMTMessage(modem, message), "{}-{}".format(message.upper(), modem.name), dispatcher.PRIORITY_CALL)
+
+def handleIPCMessage(message):
+    """
+    Handler for messages from the web server. Runs on the IPC connection's thread, or on
+    an executor thread of the service loop in the single process runtime
+    """
+    kind = message.get("type")
+    if kind == common.MOTION_DETECTED_COMMAND:
+        eventTime = message.get("ts", time.time())
+        camera = message.get("camera")
+        if not common.validCamera(camera):
+            logger.warning("Motion event with invalid camera id %r dropped", camera)
+            return
+        if not alarmState.isActive():
+            logger.info("Motion on camera %s not notified: %s", camera, alarmState.describe())
+            return
+        decision = coalescer.offer(camera, eventTime)
+        if not decision.notify:
+            logger.info("Motion on camera %s not notified: %s (%s)", camera, decision.reason, decision.summary)
+            return
+        logger.info("Motion on camera %s starts notification (%s)", camera, decision.summary)
+        if not submitGSMWork(lambda: handleMotionDetection(eventTime, camera), common.MOTION_DETECTED_COMMAND,
+                dispatcher.PRIORITY_ALARM, onDrop=coalescer.runFinished):
+            coalescer.runFinished()
+    elif kind in (common.WEBSERVER_READY_COMMAND, common.WEBSERVER_FAIL_COMMAND):
+        webServerStatus.append(kind)
+        webServerReported.set()
+    else:
+        logger.warning("Unknown IPC message type: %s", kind)
+
+class StartupTimer(object):
+    """
+    Records how long each startup phase took, relative to daemon start
+    """
     def __init__(self):
-        threading.Thread.__init__(self)
+        self._start = time.monotonic()
+        self._phases = []
+        self._lock = threading.Lock()
+
+    def begin(self):
+        return time.monotonic()
 
-    def run(self):
-        logger.debug("Started MT data waiting thread {}".format(self.name))
-        with gsmLock:
-            logger.debug("{} acquired GSM lock".format(self.name))
-            data = gsm.awaitDataFromMT() 
-            if data is not None: handleMTMessage(data)
-        logger.debug("{} has finished".format(self.name))
-        if not common.KILL_FLAG:
-            time.sleep(.5) #a little spacing before we attempt reentering the mode
-            nextWaitingThread = MTDataWaitingThread()
-            nextWaitingThread.start()
+    def end(self, name, began):
+        with self._lock:
+            self._phases.append((name, began - self._start, time.monotonic() - began))
 
+    def report(self):
+        with self._lock:
+            for name, offset, duration in sorted(self._phases, key=lambda phase: phase[1]):
+                logger.info("Startup phase %-16s started at +%.2fs and took %.2fs", name, offset, duration)
+        logger.info("Armed %.2fs after start", time.monotonic() - self._start)
 
+def initModem(gsm):
+    """
+    Switch on and configure a GSM module, then handle the SMS it received while the daemon
+    was down. The pool calls this with the module leased, at startup and when it recovers
+    a module that stopped responding. Only the first call for a module counts as startup
+    """
+    #recoveries are timed apart so they do not end up in the startup report
+    timer = StartupTimer() if gsm in startedModems else startupTimer
+    startedModems.add(gsm)
+    began = timer.begin()
+    if not gsm.turnOn(): return False
+    timer.end("gsm power on", began)
+    began = timer.begin()
+    if not gsm.setEchoOff(): return False
+    #everything in one batch; one by one only to find out what the module rejected
+    if not gsm.configure():
+        if not gsm.enableCallStatusReporting():
+            logger.warning("Call status reporting unavailable. Will poll call state instead")
+        if not gsm.enableNewSMSIndication():
+            logger.warning("New SMS indication could not be enabled")
+    timer.end("gsm configure", began)
+    #new messages are announced by +CMTI
+    began = timer.begin()
+    for record in gsm.inbox():
+        handleSMS(gsm, record)
+    timer.end("sms inbox", began)
+    return True
+
+def initGSM():
+    """
+    Bring up the GSM modules. Runs in its own thread while the other services start.
+    Each module stays leased while it is set up, so events arriving meanwhile wait for it
+    """
+    global gsmReady
+    gsmReady = modemPool.bringUp() > 0
+    if gsmReady: logger.info("GSM modules set up successfully")
+
+def handleIPCMessages(messages):
+    for message in messages: handleIPCMessage(message)
+
+httpprocess = watchdogprocess = None
+ipcServer = serviceLoop = None
 signal.signal(signal.SIGTERM, handle_sigterm)
+signal.signal(signal.SIGHUP, handle_sighup)
 logger.debug("Starting main daemon...")
+startupTimer = StartupTimer()
+startedModems = set()
+config = common.configStore.current()
+singleProcess = config.runtimeMode == "single"
 
-try:
-    os.remove(FIFO)
-    logger.debug("A pre-existing FIFO file was removed")
-except FileNotFoundError:
-    logger.info("Creating new FIFO file")
-except OSError:
-    logger.critical("Failed to remove pre-existing FIFO file {}".format(FIFO))
-    
+webServerStatus = []
+webServerReported = threading.Event()
+if not singleProcess:
+    ipcServer = ipc.IPCServer(common.IPC_SOCKET, handleIPCMessage)
+    try:
+        ipcServer.bind()
+    except OSError as oe: 
+        logger.critical("Failed to create %s as IPC socket. Error %s. Will terminate", common.IPC_SOCKET, oe.errno)
+        exit(1)
 
-try:
-    os.mkfifo(FIFO)
-except OSError as oe: 
-    logger.critical("Failed to create {} as FIFO pipe. Error {}. Will terminate".format(FIFO, oe.errno))
-    exit(1)
+gsmDispatcher = dispatcher.EventDispatcher("GSMWorker", common.getLogger('dispatcher'), workers=config.dispatchWorkers,
+        capacity=config.dispatchQueueSize, overflow=config.dispatchOverflow)
+alarmState = alarmstate.AlarmState(config.alarmStateFile)
+dialStats = dialstats.DialStats(config.dialStatsFile)
+commandEngine = smscommands.SMSCommandEngine(alarmState, config.notifyNumbers,
+        maxAge=config.smsCommandMaxAge*60, onNotifyGap=setNotifyGap, statusExtra=motionStatus)
+logger.info("Alarm state: %s", alarmState.describe())
+coalescer = coalescing.MotionCoalescer(commandEngine.notifyGap()*60,
+        dedupWindow=config.dedupWindow, burstWindow=config.burstWindow)
+common.configStore.onChange(applySettings)
+common.configStore.watch()
+modems = []
+for name, port, powerPin in config.modems or (("gsm", sim800.PORT, sim800.GSM_ON),):
+    gsm = sim800.SMS(port, sim800.BAUD, common.getLogger('sim800'), powerPin=powerPin or sim800.GSM_ON)
+    modem = modempool.PooledModem(name, gsm)
+    gsm.setup()
+    gsm.registerURCHandler("+CMTI:", lambda line, modem=modem: onNewSMS(modem, line))
+    ringLocks[name] = threading.Lock()
+    modems.append(modem)
+modemPool = modempool.ModemPool(modems, common.getLogger('modempool'), initModem, config.modemStatusFile)
+gsmReady = False
+gsmInitThread = threading.Thread(target=initGSM, name="GSMInit")
+gsmInitThread.start()
+#the handlers use everything above, so messages are only taken from here on
+if not singleProcess: ipcServer.start()
+
+began = startupTimer.begin()
+if singleProcess:
+    logger.debug("Starting web server and nvr server watchdog on the service loop and waiting for ready message")
+    serviceLoop = services.ServiceLoop(handleIPCMessages, alarmState, common.configStore)
+    serviceLoop.start()
+else:
+    logger.debug("Starting web server in subprocess and waiting for ready message")
+    cmd = ['./web-server.py']
+    httpprocess = subprocess.Popen(cmd)
 
-lastNotifTime = 0
-gsm = sim800.SMS(sim800.PORT, sim800.BAUD, logger)
-gsm.setup()
-if not gsm.turnOn(): exit(1)
-if not gsm.setEchoOff: exit(1)
-logger.info("GSM module set up successfully")
-gsm.deleteAllSMS()
-
-logger.debug("Starting web server in subprocess and waiting for ready message")
-cmd = ['./web-server.py']
-httpprocess = subprocess.Popen(cmd)
-status = readFIFO()
+    logger.debug("Starting nvr server watchdog in subprocess")
+    cmd = ['./nvr-watchdog.py']
+    watchdogprocess = subprocess.Popen(cmd)
+
+if not webServerReported.wait(30.):
+    logger.critical("Web server did not report its state. Script has to exit")
+    exit(1)
+status = webServerStatus[0]
 if status == common.WEBSERVER_READY_COMMAND:
-    logger.info("Web server subprocess reported ready")
+    logger.info("Web server reported ready")
+    startupTimer.end("web server", began)
 elif status == common.WEBSERVER_FAIL_COMMAND:
-    logger.critical("Web server subprocess reported failure. Script has to exit")
+    logger.critical("Web server reported failure. Script has to exit")
     exit(1)
 
-logger.debug("Starting nvr server watchdog in subprocess")
-cmd = ['./nvr-watchdog.py']
-watchdogprocess = subprocess.Popen(cmd)
-
-mtDataThread = MTDataWaitingThread()
-mtDataThread.start()
+gsmInitThread.join()
+if not gsmReady:
+    logger.critical("No GSM module could be set up. Script has to exit")
+    exit(1)
+for modem in modems: modem.gsm.registerURCHandler("RING", lambda line, modem=modem: onMTMessage(modem, line))
+modemPool.startHealthMonitor(config.modemHealthInterval)
+startupTimer.report()
 
-logger.debug("Starting mainloop for reading IPC pipe")
+logger.debug("Serving events")
 try:
-    while True:
-        data = readFIFO()
-        if data == common.MOTION_DETECTED_COMMAND:
-            thread = SIM800Thread(handleMotionDetection)
-            thread.start()
+    server = serviceLoop if singleProcess else ipcServer
+    while server.is_alive():
+        server.join(1.)
 except KeyboardInterrupt:
     print("")
     common.KILL_FLAG = True
-    gsm.interruptMTDataWait()
+    modemPool.close()
 
@@ -0,0 +1,451 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+import dispatcher
+import sim800
+
+REGISTERED = (sim800.NetworkStatus.RegisteredHome, sim800.NetworkStatus.RegisteredRoaming)
+
+class ModemHealth(object):
+    """
+    Last sampled state of a module's link: whether it answers, its network registration
+    (also updated from +CREG URCs), signal quality (raw AT+CSQ) and SIM state, each with
+    the time it was read. Reading it costs no serial traffic
+    """
+    def __init__(self):
+        self.responsive = None
+        self.registration = None
+        self.csq = None
+        self.sim = None
+        self.sampledAt = None
+        self.registrationAt = None
+
+    def usable(self):
+        return self.responsive is not False and self.reason() is None
+
+    def reason(self):
+        """
+        Why the link cannot carry calls, or None
+        """
+        if self.responsive is False: return "not responding"
+        if self.sim is not None and self.sim != "READY": return "SIM not ready ({})".format(self.sim)
+        if self.registration is None: return "registration unknown"
+        if self.registration not in REGISTERED: return "not registered ({})".format(self.registration.name)
+        if self.csq == 99: return "no signal"
+        return None
+
+    def asDict(self):
+        return {"responsive":self.responsive, "registration":None if self.registration is None else self.registration.name,
+                "csq":self.csq, "bars":None if self.csq is None else int(sim800.RSSI.fromCSQ(self.csq)),
+                "sim":self.sim, "sampledAt":self.sampledAt, "registrationAt":self.registrationAt,
+                "usable":self.usable(), "reason":self.reason()}
+
+
+class PooledModem(object):
+    """
+    A GSM module in the pool, with its health and usage counters
+    """
+    def __init__(self, name, gsm):
+        self.name = name
+        self.gsm = gsm
+        self.healthy = False
+        self.health = ModemHealth()
+        self.busy = False
+        self.holder = None #dispatcher.Job holding the lease, if any
+        self.holderRank = None
+        self.lastCheck = None
+        self.stats = {"calls":0, "sms":0, "failures":0, "recoveries":0, "skipped":0}
+
+    def __repr__(self):
+        return "PooledModem({})".format(self.name)
+
+
+class _Waiter(object):
+    __slots__ = ("rank", "seq", "modem", "exclude", "job", "granted")
+
+    def __init__(self, rank, seq, modem, exclude, job):
+        self.rank = rank
+        self.seq = seq
+        self.modem = modem
+        self.exclude = exclude
+        self.job = job
+        self.granted = None
+
+
+class ModemPool(object):
+    """
+    Shares several GSM modules (sim800.SMS instances, each on its own serial port with its own
+    reader thread) between the notification, incoming call and SMS work.
+    Work leases an idle module, preferring healthy ones in the configured order. placeCall and
+    sendSMS have the same signature as on a single SMS instance and fail over to another module
+    when the one used cannot dial or send and turns out not to respond or not to be registered.
+    parallelCalls tells the notification engine how many recipients it can ring at once.
+    Each module's ModemHealth is sampled when it is idle (see startHealthMonitor) and kept up
+    to date from +CREG URCs. A module whose cached health says it cannot carry a call is
+    sampled again on the spot (a few AT commands) instead of being dialled blindly into a
+    full call timeout, and skipped if it is still unusable. The health of all modules is
+    written to statusFile as JSON for the web server's /status.
+    Leases are granted in the priority order of the dispatcher job asking (dispatcher.currentJob();
+    work outside a job counts as housekeeping), first come first served within a class, and
+    waits end at the job's deadline. A waiter that outranks the job holding a module it could
+    use cancels that job, which gives the module up at its next safe point.
+    """
+    def __init__(self, modems, logger, initModem=None, statusFile=None):
+        self.modems = list(modems)
+        self._logger = logger
+        self._initModem = initModem
+        self.statusFile = statusFile
+        self._condition = threading.Condition()
+        self._monitor = None
+        self._stopMonitor = threading.Event()
+        self._statusChanged = threading.Event()
+        self._local = threading.local()
+        self._recovering = set()
+        self._waiters = [] #in grant order
+        self._seq = 0
+        self._waits = dict((priority, {"leases":0, "waitTotal":0., "waitMax":0., "timedOut":0})
+                for priority in dispatcher.PRIORITIES)
+        self.preemptions = 0
+        for modem in self.modems:
+            modem.gsm.registerURCHandler("+CREG:", lambda line, modem=modem: self._onRegistration(modem, line))
+
+    def __len__(self):
+        return len(self.modems)
+
+    @property
+    def lastDialError(self):
+        """
+        Like sim800.SMS.lastDialError: the dial error of the last placeCall in this thread, if
+        no module could dial
+        """
+        return getattr(self._local, "dialError", None)
+
+    @property
+    def parallelCalls(self):
+        return max(1, sum(1 for modem in self.modems if modem.healthy))
+
+    @contextlib.contextmanager
+    def lease(self, modem=None, exclude=(), timeout=None):
+        """
+        Context manager giving exclusive use of an idle module, or of the given one. Waits
+        while all candidates are busy, for at most timeout seconds if set and not past the
+        deadline of the current job. Yields None if no module is available
+        """
+        job = dispatcher.currentJob()
+        priority = dispatcher.PRIORITY_HOUSEKEEPING if job is None else job.priority
+        began = time.time()
+        deadline = None if timeout is None else began + timeout
+        if job is not None and job.deadline is not None: deadline = job.deadline if deadline is None else min(deadline, job.deadline)
+        with self._condition:
+            self._seq += 1
+            waiter = _Waiter(dispatcher.rankOf(priority), self._seq, modem, exclude, job)
+            self._waiters.append(waiter)
+            self._waiters.sort(key=lambda waiter: (waiter.rank, waiter.seq))
+            try:
+                while True:
+                    self._grant()
+                    if waiter.granted is not None or not self._anyCandidate(modem, exclude): break
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0: break
+                    self._preempt(waiter)
+                    self._condition.wait(remaining)
+            except BaseException:
+                if waiter.granted is not None: self._release(waiter.granted)
+                raise
+            finally:
+                self._waiters.remove(waiter)
+            leased = waiter.granted
+            waits = self._waits[priority]
+            if leased is None: waits["timedOut"] += 1
+            else:
+                waits["leases"] += 1
+                waits["waitTotal"] += time.time() - began
+                waits["waitMax"] = max(waits["waitMax"], time.time() - began)
+        try:
+            yield leased
+        finally:
+            if leased is not None:
+                with self._condition: self._release(leased)
+
+    def _grant(self):
+        """
+        Hand idle modules to the waiters in grant order. A waiter is only passed over for a
+        module it cannot use
+        """
+        granted = False
+        for waiter in self._waiters:
+            if waiter.granted is not None: continue
+            leased = self._pick(waiter.modem, waiter.exclude)
+            if leased is None: continue
+            leased.busy = True
+            leased.holder, leased.holderRank = waiter.job, waiter.rank
+            waiter.granted = leased
+            granted = True
+        if granted: self._condition.notify_all()
+
+    def _release(self, modem):
+        modem.busy = False
+        modem.holder = modem.holderRank = None
+        self._condition.notify_all()
+
+    def _preempt(self, waiter):
+        """
+        Cancel the least urgent job holding a module waiter could use, if it is less urgent
+        than waiter and none of them is giving its module up yet
+        """
+        holders = [m for m in self._candidates(waiter.modem, waiter.exclude)
+                if m.busy and m.holder is not None and m.holderRank > waiter.rank]
+        if not len(holders) or any(m.holder.cancelled.is_set() for m in holders): return
+        victim = max(holders, key=lambda m: m.holderRank)
+        self.preemptions += 1
+        self._logger.info("Asking %s job (%s) to give up GSM module %s for %s work", victim.holder.priority,
+                victim.holder.key, victim.name, dispatcher.PRIORITIES[waiter.rank])
+        victim.holder.cancel()
+
+    def _candidates(self, modem, exclude):
+        if modem is not None: return [modem]
+        candidates = [m for m in self.modems if m not in exclude]
+        #unhealthy modules are a last resort, better than not trying at all
+        healthy = [m for m in candidates if m.healthy]
+        return healthy if len(healthy) else candidates
+
+    def _anyCandidate(self, modem, exclude):
+        return len(self._candidates(modem, exclude)) > 0
+
+    def _pick(self, modem, exclude):
+        for candidate in self._candidates(modem, exclude):
+            if not candidate.busy: return candidate
+        return None
+
+    def bringUp(self):
+        """
+        Initialise all modules concurrently with initModem(gsm), which returns True on success.
+        Returns the number of modules that came up. They may not be registered on the network yet;
+        +CREG reports when they are
+        """
+        threads = [threading.Thread(target=self._bringUp, args=(modem,), name="GSMInit-{}".format(modem.name))
+                for modem in self.modems]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return sum(1 for modem in self.modems if modem.health.responsive)
+
+    def _bringUp(self, modem):
+        with self.lease(modem):
+            try:
+                up = bool(self._initModem(modem.gsm)) if self._initModem is not None else modem.gsm.turnOn()
+                if up and not modem.gsm.enableRegistrationReporting():
+                    self._logger.warning("GSM module %s cannot report registration changes", modem.name)
+                modem.health.responsive = up
+                modem.healthy = up and self._sample(modem)
+            except Exception:
+                self._logger.exception("Failed to initialise GSM module %s", modem.name)
+                modem.health.responsive = False
+                modem.healthy = False
+            modem.lastCheck = time.time()
+        if modem.healthy: self._logger.info("GSM module %s is up", modem.name)
+        elif modem.health.responsive: self._logger.warning("GSM module %s is up but not usable yet: %s", modem.name, modem.health.reason())
+        else: self._logger.error("GSM module %s could not be set up", modem.name)
+        self.writeStatus()
+
+    def _sample(self, modem):
+        """
+        Read a leased, responsive module's SIM state, registration and signal into its health cache
+        """
+        health = modem.health
+        health.responsive = True
+        health.sim, health.registration, health.csq = modem.gsm.getRadioStatus()
+        health.sampledAt = health.registrationAt = time.time()
+        return health.usable()
+
+    def _onRegistration(self, modem, line):
+        """
+        +CREG URC handler. Runs on the module's serial reader thread, so only updates the cache
+        """
+        status = sim800.parseRegistrationIndication(line)
+        if status is None: return
+        modem.health.registration = status
+        modem.health.registrationAt = time.time()
+        healthy = modem.health.usable()
+        if healthy != modem.healthy:
+            modem.healthy = healthy
+            if healthy: self._logger.info("GSM module %s registered on the network", modem.name)
+            else: self._logger.warning("GSM module %s lost its network: %s", modem.name, modem.health.reason())
+        self._statusChanged.set()
+
+    def checkHealth(self, modem, recover=True):
+        """
+        Check a leased module answers, has its SIM ready and is registered on the network with a
+        signal. A module that does not answer is switched on and initialised again if recover is
+        set; one that answers but has rebooted since it was configured is initialised again in
+        any case. Returns the module's health
+        """
+        gsm = modem.gsm
+        wasHealthy = modem.healthy
+        if not gsm.isResponsive():
+            modem.health.responsive = False
+            modem.health.sampledAt = time.time()
+            if not recover:
+                self._logger.warning("GSM module %s is not responding", modem.name)
+                healthy = False
+            else:
+                self._logger.warning("GSM module %s is not responding. Trying to bring it back", modem.name)
+                healthy = gsm.turnOn() and self._reinitialise(modem)
+        elif gsm.needsConfigure:
+            #still answers AT, but with echo on and none of the URCs the daemon relies on
+            self._logger.warning("GSM module %s has restarted. Initialising it again", modem.name)
+            healthy = self._reinitialise(modem)
+        else:
+            healthy = self._sample(modem)
+            if not healthy and wasHealthy: self._logger.warning("GSM module %s is unusable: %s", modem.name, modem.health.reason())
+        modem.healthy = healthy
+        modem.lastCheck = time.time()
+        if healthy and not wasHealthy: self._logger.info("GSM module %s is healthy again", modem.name)
+        self._statusChanged.set()
+        return healthy
+
+    def _reinitialise(self, modem):
+        #initModem turns the module on, which is quick when it already answers
+        if self._initModem is not None: initialised = bool(self._initModem(modem.gsm))
+        else: initialised = modem.gsm.setEchoOff() and modem.gsm.configure()
+        if not initialised: return False
+        modem.stats["recoveries"] += 1
+        modem.gsm.enableRegistrationReporting()
+        return self._sample(modem)
+
+    def _usable(self, modem):
+        """
+        Whether a leased module can carry a call or SMS. Trusts a good cached health; a bad one
+        is sampled again, which takes milliseconds rather than a call timeout. So is a module
+        that rebooted, to configure it again
+        """
+        if modem.health.usable() and not modem.gsm.needsConfigure: return True
+        if self.checkHealth(modem, recover=False): return True
+        modem.stats["skipped"] += 1
+        self._logger.warning("Skipping GSM module %s: %s", modem.name, modem.health.reason())
+        if modem.health.responsive is False: self._startRecovery(modem)
+        return False
+
+    def placeCall(self, number, timeout=60, onConnected=None, cancel=None):
+        """
+        Call number on an idle module. Returns True if the call was answered
+        """
+        tried = []
+        self._local.dialError = None
+        while True:
+            with self.lease(exclude=tried) as modem:
+                if modem is None:
+                    self._logger.error("No GSM module left to call %s", number)
+                    if self._local.dialError is None: self._local.dialError = "no usable GSM module"
+                    return False
+                if not self._usable(modem):
+                    tried.append(modem)
+                    continue
+                modem.stats["calls"] += 1
+                answered = modem.gsm.placeCall(number, timeout=timeout, onConnected=onConnected, cancel=cancel)
+                if answered or modem.gsm.lastDialError is None: return answered
+                self._local.dialError = modem.gsm.lastDialError
+                self._failed(modem, "could not dial {}".format(number))
+                tried.append(modem)
+
+    def sendSMS(self, number, text):
+        """
+        Send an SMS from an idle module. Returns True if it was sent
+        """
+        tried = []
+        while True:
+            with self.lease(exclude=tried) as modem:
+                if modem is None:
+                    self._logger.error("No GSM module left to send an SMS to %s", number)
+                    return False
+                if not self._usable(modem):
+                    tried.append(modem)
+                    continue
+                modem.stats["sms"] += 1
+                if modem.gsm.sendSMS(number, text): return True
+                self._failed(modem, "could not send an SMS to {}".format(number))
+                tried.append(modem)
+
+    def _failed(self, modem, reason):
+        #a power cycle takes many seconds, so fail over first and bring the module back in the background
+        modem.stats["failures"] += 1
+        healthy = self.checkHealth(modem, recover=False)
+        if len(self.modems) > 1:
+            self._logger.warning("GSM module %s %s (%s). Failing over", modem.name, reason, "healthy" if healthy else "unhealthy")
+        if not healthy: self._startRecovery(modem)
+
+    def _startRecovery(self, modem):
+        with self._condition:
+            if modem.name in self._recovering: return
+            self._recovering.add(modem.name)
+        threading.Thread(target=self._recover, args=(modem,), name="GSMRecover-{}".format(modem.name), daemon=True).start()
+
+    def _recover(self, modem):
+        try:
+            with self.lease(modem):
+                self.checkHealth(modem)
+        except Exception:
+            self._logger.exception("Recovery of GSM module %s failed", modem.name)
+        finally:
+            with self._condition: self._recovering.discard(modem.name)
+
+    def startHealthMonitor(self, interval=60.):
+        """
+        Check idle modules every interval seconds in a daemon thread
+        """
+        self._monitor = threading.Thread(target=self._monitorHealth, args=(interval,), name="GSMHealth", daemon=True)
+        self._monitor.start()
+
+    def _monitorHealth(self, interval):
+        nextSample = time.time() + interval
+        while not self._stopMonitor.is_set():
+            #wake early to write out changes reported by URCs
+            self._statusChanged.wait(max(0, nextSample - time.time()))
+            if self._stopMonitor.is_set(): break
+            if time.time() >= nextSample:
+                nextSample = time.time() + interval
+                for modem in self.modems:
+                    with self.lease(modem, timeout=0) as leased:
+                        if leased is None: continue #busy, so evidently working
+                        try: self.checkHealth(leased)
+                        except Exception: self._logger.exception("Health check of GSM module %s failed", modem.name)
+            self.writeStatus()
+
+    def status(self):
+        """
+        Cached health of every module, without serial traffic
+        """
+        return dict((modem.name, dict(modem.health.asDict(), healthy=modem.healthy, busy=modem.busy,
+                lastCheck=modem.lastCheck)) for modem in self.modems)
+
+    def writeStatus(self):
+        self._statusChanged.clear()
+        if self.statusFile is None: return
+        try:
+            with open(self.statusFile + ".tmp", "w") as statusFile:
+                json.dump({"updated":time.time(), "modems":self.status()}, statusFile)
+            os.replace(self.statusFile + ".tmp", self.statusFile)
+        except OSError as e:
+            self._logger.error("Failed to write GSM module status to %s: %s", self.statusFile, e)
+
+    def leaseStats(self):
+        """
+        Leases, lease waits in seconds and leases given up at the deadline per priority class,
+        and the number of jobs asked to give up a module
+        """
+        with self._condition:
+            waits = dict((priority, {"leases":waits["leases"], "timedOut":waits["timedOut"], "waitMax":waits["waitMax"],
+                    "waitAvg":waits["waitTotal"] / waits["leases"] if waits["leases"] else 0.})
+                    for priority, waits in self._waits.items())
+            return {"waits":waits, "preemptions":self.preemptions}
+
+    def stats(self):
+        return dict((modem.name, dict(modem.stats, healthy=modem.healthy, busy=modem.busy, health=modem.health.reason(),
+                cache=modem.gsm.getSettingsCacheStats())) for modem in self.modems)
+
+    def close(self):
+        self._stopMonitor.set()
+        self._statusChanged.set()
+        for modem in self.modems: modem.gsm.close()
@@ -0,0 +1,189 @@
+import threading
+import time
+
+import common
+import dispatcher
+
+class NotificationPlan(object):
+    """
+    Describes how a single event is notified: the numbers to call in order, how often
+    each is redialled, who receives an SMS alert and how SMS alerts are interleaved
+    with the call attempts. callTimeouts overrides callTimeout for the first attempt to
+    some numbers; redials always ring for callTimeout, so somebody who is slower to answer
+    than usual still gets the full time (and the learned ring times are not only ever cut short).
+    """
+    def __init__(self, callNumbers, message, smsNumbers=None, redials=1, callTimeout=60,
+            smsFirst=False, smsBetweenCalls=1, callTimeouts=None):
+        self.callNumbers = tuple(callNumbers)
+        self.smsNumbers = tuple(callNumbers if smsNumbers is None else smsNumbers)
+        self.message = message
+        self.redials = int(redials)
+        self.callTimeout = float(callTimeout)
+        self.callTimeouts = dict(callTimeouts or {})
+        self.smsFirst = bool(smsFirst)
+        self.smsBetweenCalls = int(smsBetweenCalls)
+
+    def messageText(self):
+        """
+        The SMS alert text. message may be a callable so the text is built when the SMS
+        is sent, e.g. to include events that arrived while the run was in progress
+        """
+        if callable(self.message): return self.message()
+        return self.message
+
+    def timeoutFor(self, number, attempt=1):
+        if attempt > 1: return self.callTimeout
+        return self.callTimeouts.get(number, self.callTimeout)
+
+    @classmethod
+    def fromConfig(cls, message, config=None, dialStats=None, when=None):
+        """
+        Build the default plan from a settings snapshot (the current one if None). With a
+        dialstats.DialStats the numbers are called in the order and with the timeouts learned
+        from earlier calls at this time of day, as DialOrder and AdaptiveTimeout allow.
+        SMS alerts keep the configured order
+        """
+        if config is None: config = common.configStore.current()
+        when = time.time() if when is None else when
+        numbers = config.notifyNumbers
+        timeouts = {}
+        if dialStats is not None and config.adaptiveTimeout:
+            timeouts = dict((number, dialStats.ringTimeout(number, when, config.callTimeout, config.minCallTimeout))
+                    for number in numbers)
+        if dialStats is not None and config.dialOrder == "adaptive":
+            numbers = dialStats.order(numbers, when, dict((number, timeouts.get(number, config.callTimeout)) for number in numbers))
+        return cls(numbers, message,
+                smsNumbers=config.notifyNumbers,
+                redials=config.redials,
+                callTimeout=config.callTimeout,
+                smsFirst=config.smsFirst,
+                smsBetweenCalls=config.smsBetweenCalls,
+                callTimeouts=timeouts)
+
+    def callAttempts(self):
+        """
+        Generates (number, attempt) pairs in escalation order
+        """
+        for number in self.callNumbers:
+            for attempt in range(1, self.redials+2):
+                yield number, attempt
+
+
+class NotificationRun(object):
+    """
+    Executes a NotificationPlan on a GSM module. SMS alerts to every recipient are queued
+    at the start and sent in the gaps between call attempts, so nobody waits for the whole
+    voice escalation to fail before hearing about the event. Everything stops as soon
+    as a call is answered.
+    gsm is a sim800.SMS or a modempool.ModemPool. A pool with several modules rings up to
+    parallelCalls different numbers at once, in escalation order, and hangs up on the
+    others as soon as one answers. The calls run as part of the dispatcher job running the plan,
+    if any, so they lease modules with its priority.
+    Each attempt's outcome is recorded in dialStats (a dialstats.DialStats), if given.
+    """
+    def __init__(self, plan, gsm, logger, eventTime=None, dialStats=None):
+        self.plan = plan
+        self.eventTime = eventTime if eventTime is not None else time.time()
+        self._gsm = gsm
+        self._logger = logger
+        self._dialStats = dialStats
+        self._pendingSMS = list(plan.smsNumbers)
+        self._lock = threading.Lock()
+
+        self.callAttempts = 0
+        self.answeredBy = None
+        self.answeredAfter = None
+        self.smsSent = []
+        self.firstSMSAfter = None
+
+    def timeToFirstContact(self):
+        """
+        Seconds from the event to the first answered call or sent SMS, None if nobody was reached
+        """
+        times = [t for t in (self.answeredAfter, self.firstSMSAfter) if t is not None]
+        if not len(times): return None
+        return min(times)
+
+    def execute(self):
+        """
+        Run the plan. Returns True if a call was answered
+        """
+        if self.plan.smsFirst: self._sendPendingSMS(self.plan.smsBetweenCalls)
+        attempts = list(self.plan.callAttempts())
+        while len(attempts) and not common.KILL_FLAG:
+            wave = self._nextWave(attempts, getattr(self._gsm, "parallelCalls", 1))
+            if self._callWave(wave): break
+            self._sendPendingSMS(self.plan.smsBetweenCalls * len(wave))
+        if self.answeredBy is None and not common.KILL_FLAG:
+            self._sendPendingSMS(len(self._pendingSMS))
+        if self._dialStats is not None: self._dialStats.save()
+        self._logSummary()
+        return self.answeredBy is not None
+
+    def _nextWave(self, attempts, size):
+        """
+        Take up to size attempts to different numbers off the front of attempts
+        """
+        wave = []
+        for number, attempt in list(attempts):
+            if len(wave) >= size: break
+            if any(number == waveNumber for waveNumber, _ in wave): continue
+            wave.append((number, attempt))
+            attempts.remove((number, attempt))
+        return wave
+
+    def _callWave(self, wave):
+        if len(wave) == 1: return self._call(*wave[0])
+        answered = threading.Event()
+        job = dispatcher.currentJob()
+        def call(number, attempt):
+            if job is None: return self._call(number, attempt, answered)
+            with job.adopt(): self._call(number, attempt, answered)
+        calls = [threading.Thread(target=call, args=(number, attempt), name="Call-{}".format(number))
+                for number, attempt in wave]
+        for call in calls: call.start()
+        for call in calls: call.join()
+        return self.answeredBy is not None
+
+    def _call(self, number, attempt, answered=None):
+        timeout = self.plan.timeoutFor(number, attempt)
+        self._logger.debug("Attempt %s for GSM number %s (timeout %ss)", attempt, number, timeout)
+        with self._lock:
+            self.callAttempts += 1
+        connectedAt = []
+
+        def onConnected():
+            connectedAt.append(time.time())
+            with self._lock:
+                if self.answeredBy is not None: return
+                self.answeredBy = number
+                self.answeredAfter = time.time() - self.eventTime
+            self._logger.info("Call answered by %s %.1fs after the event", number, self.answeredAfter)
+            if answered is not None: answered.set() #hang up on the numbers still ringing
+
+        dialed = time.time()
+        if answered is None: result = self._gsm.placeCall(number, timeout=timeout, onConnected=onConnected)
+        else: result = self._gsm.placeCall(number, timeout=timeout, onConnected=onConnected, cancel=answered)
+        if self._dialStats is not None:
+            if len(connectedAt): self._dialStats.record(number, self.eventTime, True, connectedAt[0] - dialed)
+            elif not (answered is not None and answered.is_set()) and getattr(self._gsm, "lastDialError", None) is None:
+                self._dialStats.record(number, self.eventTime, False)
+        return result
+
+    def _sendPendingSMS(self, count):
+        while count > 0 and len(self._pendingSMS) and not common.KILL_FLAG:
+            number = self._pendingSMS.pop(0)
+            count -= 1
+            if not self._gsm.sendSMS(number, self.plan.messageText()):
+                self._logger.error("Failed to send SMS alert to %s", number)
+                continue
+            self.smsSent.append(number)
+            if self.firstSMSAfter is None: self.firstSMSAfter = time.time() - self.eventTime
+
+    def _logSummary(self):
+        firstContact = self.timeToFirstContact()
+        if firstContact is None:
+            self._logger.warning("Nobody could be notified after %s call attempts", self.callAttempts)
+            return
+        self._logger.info("Time to first contact: %.1fs (call attempts: %s, answered by: %s, SMS sent: %s)",
+                firstContact, self.callAttempts, self.answeredBy, len(self.smsSent))
@@ -1,50 +1,23 @@
 #!/usr/bin/python3
 
-try :
-    import httplib
-except:
-    import http.client as httplib
-import os
-import subprocess
-from time import sleep
+import asyncio
+import signal
 import common
+import watchdog
 
-FIFO = common.FIFO
-logger = common.homeSecurityLogger
-serverMAC = common.NVR_SERVER_MAC_ADDRESS
-serverIP = common.NVR_SERVER_IP_ADDRESS
-serverPort = common.NVR_SERVER_PORT
-nvrHost = "{}:{}".format(serverIP, serverPort)
-
-def nvr_online():
-    conn = httplib.HTTPConnection(nvrHost, timeout=5)
-    try:
-        conn.request("HEAD", "/")
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(str(e))
-        conn.close()
-        return False
+logger = common.getLogger('nvrwatchdog')
 
+async def runWatchdog(nvrWatchdog):
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, common.configStore.requestReload)
+    await nvrWatchdog.run()
 
 if __name__ == "__main__":
     logger.info("Starting motioneye (NVR) server watchdog")
-    logger.info("Server MAC Address: {}".format(serverMAC))
-    logger.info("Server Host: {}".format(nvrHost))
+    nvrWatchdog = watchdog.NVRWatchdog.fromConfig(common.configStore.current())
+    common.configStore.onChange(nvrWatchdog.applyConfig)
+    common.configStore.watch()
 
     try:
-        while True:
-            logger.info("Pinging NVR server")
-            nextSleepInterval = 120.
-            if not nvr_online():
-                logger.info("Ping failed, sending Wake-on-LAN")
-                subprocess.call(["wakeonlan", serverMAC])
-                nextSleepInterval = 30. #if server does not respond, check again sooner after sending WoL
-            else:
-                logger.info("Server is online")
-            
-            logger.debug("Will ping again after {} seconds".format(int(nextSleepInterval)))
-            sleep(nextSleepInterval)
+        asyncio.run(runWatchdog(nvrWatchdog))
     except KeyboardInterrupt:
         pass
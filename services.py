@@ -0,0 +1,83 @@
+import asyncio
+import threading
+
+import admission
+import common
+import ipc
+import snapshots
+import watchdog
+import webhook
+
+logger = common.getLogger('services')
+
+class ServiceLoop(threading.Thread):
+    """
+    Single process runtime: runs the webhook server and the NVR watchdog as tasks on one
+    asyncio event loop in a thread of the main daemon, instead of in the web-server.py and
+    nvr-watchdog.py subprocesses. Events are handed to sink (called with a list of IPC
+    messages, in an executor thread) without going through the IPC socket, and the web
+    server's ready or fail message is passed to sink the same way.
+    The GSM modules keep their own reader threads and the dispatcher workers, which do the
+    blocking serial I/O, so the loop only ever waits on sockets.
+    """
+    def __init__(self, sink, alarmState, configStore):
+        threading.Thread.__init__(self, name="ServiceLoop", daemon=True)
+        self._sink = sink
+        self._alarmState = alarmState
+        self._configStore = configStore
+        self._loop = None
+        self._stopped = None
+        self._finished = threading.Event()
+        self.webServer = None
+        self.snapshots = None
+        self.admission = None
+        self.nvrWatchdog = None
+
+    def run(self):
+        try:
+            asyncio.run(self._serve())
+        except Exception:
+            logger.exception("Service loop failed")
+        finally:
+            self._finished.set()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        config = self._configStore.current()
+        self.snapshots = snapshots.SnapshotFetcher.fromConfig(config)
+        self._configStore.onChange(self.snapshots.applyConfig)
+        self.admission = admission.Admission.fromConfig(config)
+        self._configStore.onChange(self.admission.applyConfig)
+        self.webServer = webhook.WebhookServer("", config.webhookPort, self._sink, alarmState=self._alarmState,
+                snapshots=self.snapshots, admission=self.admission,
+                statusFiles=lambda: webhook.statusFiles(self._configStore.current()))
+        try:
+            await self.webServer.start()
+        except Exception as e:
+            logger.critical("Exception was raised while starting server: %s", str(e))
+            self._sink([ipc.makeMessage(common.WEBSERVER_FAIL_COMMAND)])
+            return
+        logger.info("Web Server Starts - :%s", self.webServer.port)
+        self._sink([ipc.makeMessage(common.WEBSERVER_READY_COMMAND)])
+
+        logger.info("Starting motioneye (NVR) server watchdog")
+        self.nvrWatchdog = watchdog.NVRWatchdog.fromConfig(config)
+        self._configStore.onChange(self.nvrWatchdog.applyConfig)
+        tasks = [asyncio.ensure_future(self.webServer.serveForever()), asyncio.ensure_future(self.nvrWatchdog.run())]
+        await self._stopped.wait()
+        for task in tasks: task.cancel()
+        await self.webServer.stop()
+        logger.info("Web Server Stops - :%s", self.webServer.port)
+
+    def stop(self):
+        """
+        Stop the services and wait for the loop to finish. Thread safe
+        """
+        #not is_alive()/join(): they can be wrong after a join in the main thread was interrupted by a signal
+        if self._finished.is_set() or self._stopped is None: return
+        try:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+        except RuntimeError:
+            return #loop already closed
+        self._finished.wait(5.)
@@ -0,0 +1,262 @@
+import configparser
+import logging
+import os
+import threading
+import types
+
+import dispatcher
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+LOG_SETTINGS = ("level", "queuesize", "repeatburst", "repeatinterval")
+RUNTIME_MODES = ("processes", "single")
+WEBHOOK_LIMIT_BY = ("ip", "camera")
+DIAL_ORDERS = ("file", "adaptive")
+
+#settings that are only read at startup; changing them needs a restart
+RESTART_REQUIRED = ("dispatchWorkers", "dispatchQueueSize", "dispatchOverflow", "webhookPort", "alarmStateFile", "dialStatsFile", "modemStatusFile",
+        "logQueueSize", "modems", "runtimeMode")
+MODEM_SETTINGS = ("healthinterval", "statusfile")
+
+class ConfigError(ValueError):
+    pass
+
+
+class Settings(object):
+    """
+    Immutable, typed snapshot of main.conf. Build one with Settings.load(path); a bad value
+    raises ConfigError naming the section and key
+    """
+    def __init__(self, path, mtime, **values):
+        self.__dict__.update(values, path=path, mtime=mtime)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are read-only")
+
+    def changes(self, other):
+        """
+        Names of the settings that differ from another snapshot
+        """
+        return sorted(name for name, value in self.__dict__.items()
+                if name not in ("path", "mtime") and getattr(other, name, None) != value)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            raise ConfigError("Cannot read {}: {}".format(path, e))
+        config = configparser.ConfigParser(allow_no_value=True)
+        try:
+            config.read(path)
+        except configparser.Error as e:
+            raise ConfigError("Cannot parse {}: {}".format(path, e))
+        reader = _Reader(config)
+
+        numbers = tuple(config['MOTION_NOTIFICATION_NUMBERS']) if config.has_section('MOTION_NOTIFICATION_NUMBERS') else ()
+        if not len(numbers): raise ConfigError("[MOTION_NOTIFICATION_NUMBERS] lists no numbers")
+        for number in numbers:
+            if not number.lstrip("+").isdigit(): raise ConfigError("Invalid notification number: {}".format(number))
+
+        serverHost = ('nvr', reader.str('SERVER', 'ServerIP'), reader.int('SERVER', 'ServerPort', minimum=1),
+                reader.str('SERVER', 'ServerMAC'))
+        hosts = [serverHost]
+        if config.has_section('NVR_HOSTS'):
+            for name, value in config['NVR_HOSTS'].items():
+                address, _, mac = (value or '').strip().partition(' ')
+                ip, _, port = address.partition(':')
+                if not ip or not (port or '80').isdigit():
+                    raise ConfigError("[NVR_HOSTS] {}: expected ip:port [mac], got {!r}".format(name, value))
+                hosts.append((name, ip, int(port or 80), mac.strip() or None))
+
+        #(name, serial port, power key pin or None). Empty for the single default module
+        modems = []
+        if config.has_section('MODEMS'):
+            for name, value in config['MODEMS'].items():
+                if name in MODEM_SETTINGS: continue
+                port, _, pin = (value or '').strip().partition(' ')
+                if not port or (pin.strip() and not pin.strip().isdigit()):
+                    raise ConfigError("[MODEMS] {}: expected <serial port> [power pin], got {!r}".format(name, value))
+                modems.append((name, port, int(pin) if pin.strip() else None))
+
+        logLevel = reader.choice('LOGGING', 'Level', LOG_LEVELS, 'DEBUG', upper=True)
+        moduleLevels = {}
+        if config.has_section('LOGGING'):
+            for module in config['LOGGING']:
+                if module in LOG_SETTINGS: continue
+                moduleLevels[module] = reader.choice('LOGGING', module, LOG_LEVELS, None, upper=True)
+
+        snapshotUrl = reader.str('SNAPSHOTS', 'Url', 'http://{host}:{port}/picture/{camera}/current/')
+        try: snapshotUrl.format(host="", port=0, camera="")
+        except (KeyError, IndexError, ValueError): raise ConfigError("[SNAPSHOTS] Url: {!r} may only use {{host}}, {{port}} and {{camera}}".format(snapshotUrl))
+
+        section = 'MOTION_NOTIFICATION_SETTINGS'
+        return cls(path, mtime,
+                notifyNumbers=numbers,
+                redials=reader.int(section, 'Redials', minimum=0),
+                notifyGap=reader.float(section, 'NotifyGap', minimum=0),
+                callTimeout=reader.int(section, 'CallTimeout', 60, minimum=1),
+                smsFirst=reader.bool(section, 'SMSFirst', False),
+                smsBetweenCalls=reader.int(section, 'SMSBetweenCalls', 1, minimum=0),
+                dedupWindow=reader.float(section, 'DedupWindow', 10, minimum=0),
+                burstWindow=reader.float(section, 'BurstWindow', 30, minimum=0),
+                dialOrder=reader.choice(section, 'DialOrder', DIAL_ORDERS, 'adaptive'),
+                adaptiveTimeout=reader.bool(section, 'AdaptiveTimeout', True),
+                minCallTimeout=reader.int(section, 'MinCallTimeout', 20, minimum=1),
+                dialStatsFile=reader.str(section, 'DialStatsFile', 'dialstats.json'),
+                alarmStateFile=reader.str('SMS_COMMANDS', 'StateFile', 'alarmstate.json'),
+                smsCommandMaxAge=reader.float('SMS_COMMANDS', 'MaxAge', 60, minimum=0),
+                dispatchWorkers=reader.int('DISPATCHER', 'Workers', 1, minimum=1),
+                dispatchQueueSize=reader.int('DISPATCHER', 'QueueSize', 16, minimum=1),
+                dispatchOverflow=reader.choice('DISPATCHER', 'Overflow', dispatcher.OVERFLOW_POLICIES, 'coalesce'),
+                dispatchDeadlines=types.MappingProxyType(dict((priority,
+                        reader.float('DISPATCHER', '{}Deadline'.format(priority.capitalize()), default, minimum=0) or None)
+                        for priority, default in zip(dispatcher.PRIORITIES, (0, 30, 0)))),
+                webhookPort=reader.int('WEBHOOK', 'Port', 9090, minimum=0),
+                webhookTokens=tuple(token for token in reader.str('WEBHOOK', 'Tokens', '').replace(',', ' ').split()),
+                webhookSecret=reader.str('WEBHOOK', 'Secret', '') or None,
+                webhookMaxSkew=reader.float('WEBHOOK', 'MaxSkew', 300, minimum=0),
+                webhookRate=reader.float('WEBHOOK', 'Rate', 1, minimum=0),
+                webhookBurst=reader.int('WEBHOOK', 'Burst', 5, minimum=1),
+                webhookLimitBy=reader.choice('WEBHOOK', 'LimitBy', WEBHOOK_LIMIT_BY, 'camera'),
+                webhookMaxClients=reader.int('WEBHOOK', 'MaxClients', 1024, minimum=1),
+                webhookMaxCameras=reader.int('WEBHOOK', 'MaxCameras', 16, minimum=1),
+                snapshotUrl=snapshotUrl,
+                snapshotFrames=reader.int('SNAPSHOTS', 'Frames', 5, minimum=1),
+                snapshotMemory=int(reader.float('SNAPSHOTS', 'MemoryLimit', 8, minimum=0) * 1024 * 1024),
+                snapshotMaxFrameSize=int(reader.float('SNAPSHOTS', 'MaxFrameSize', 1024, minimum=1) * 1024),
+                snapshotTimeout=reader.float('SNAPSHOTS', 'Timeout', 5, minimum=.1),
+                snapshotMaxFetches=reader.int('SNAPSHOTS', 'MaxFetches', 4, minimum=1),
+                runtimeMode=reader.choice('RUNTIME', 'Mode', RUNTIME_MODES, 'processes'),
+                modems=tuple(modems),
+                modemHealthInterval=reader.float('MODEMS', 'HealthInterval', 60, minimum=1),
+                modemStatusFile=reader.str('MODEMS', 'StatusFile', 'modemstatus.json'),
+                nvrHosts=tuple(hosts),
+                nvrUpInterval=reader.float('NVR_WATCHDOG', 'UpInterval', 120, minimum=1),
+                nvrDownInterval=reader.float('NVR_WATCHDOG', 'DownInterval', 30, minimum=1),
+                nvrBackoffMax=reader.float('NVR_WATCHDOG', 'BackoffMax', 600, minimum=1),
+                nvrBootPollInterval=reader.float('NVR_WATCHDOG', 'BootPollInterval', 5, minimum=.1),
+                nvrBootWatch=reader.float('NVR_WATCHDOG', 'BootWatch', 180, minimum=0),
+                nvrBroadcast=reader.str('NVR_WATCHDOG', 'Broadcast', '255.255.255.255'),
+                nvrStatusFile=reader.str('NVR_WATCHDOG', 'StatusFile', 'nvrstatus.json'),
+                logLevel=logLevel,
+                logModuleLevels=types.MappingProxyType(moduleLevels),
+                logQueueSize=reader.int('LOGGING', 'QueueSize', 10000, minimum=1),
+                logRepeatBurst=reader.int('LOGGING', 'RepeatBurst', 5, minimum=0),
+                logRepeatInterval=reader.float('LOGGING', 'RepeatInterval', 60, minimum=0))
+
+
+class _Reader(object):
+    """
+    Typed, validated access to configparser values
+    """
+    def __init__(self, config):
+        self._config = config
+
+    def _raw(self, section, key, default):
+        value = self._config.get(section, key, fallback=None)
+        if value is None:
+            if default is None: raise ConfigError("[{}] {} is missing".format(section, key))
+            return default
+        return value.strip()
+
+    def str(self, section, key, default=None):
+        return str(self._raw(section, key, default))
+
+    def int(self, section, key, default=None, minimum=None):
+        return self._number(int, section, key, default, minimum)
+
+    def float(self, section, key, default=None, minimum=None):
+        return self._number(float, section, key, default, minimum)
+
+    def _number(self, kind, section, key, default, minimum):
+        value = self._raw(section, key, default)
+        try: value = kind(value)
+        except ValueError: raise ConfigError("[{}] {}: {!r} is not a valid {}".format(section, key, value, kind.__name__))
+        if minimum is not None and value < minimum:
+            raise ConfigError("[{}] {}: {} is below the minimum of {}".format(section, key, value, minimum))
+        return value
+
+    def bool(self, section, key, default=None):
+        value = self._raw(section, key, default)
+        if isinstance(value, bool): return value
+        if value.lower() in ("yes", "true", "on", "1"): return True
+        if value.lower() in ("no", "false", "off", "0"): return False
+        raise ConfigError("[{}] {}: {!r} is not yes or no".format(section, key, value))
+
+    def choice(self, section, key, choices, default=None, upper=False):
+        value = self._raw(section, key, default)
+        if upper: value = value.upper()
+        if value not in choices: raise ConfigError("[{}] {}: {!r} is not one of {}".format(section, key, value, ", ".join(choices)))
+        return value
+
+
+class ConfigStore(object):
+    """
+    Holds the current Settings snapshot. reload() builds a new snapshot and swaps it in, or
+    keeps the current one if the file is invalid. Readers take current() once per unit of
+    work (e.g. per event), so a change never alters work already in progress.
+    Callbacks registered with onChange(callback) get (old, new) after every swap.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._current = Settings.load(path)
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._reloadRequested = threading.Event()
+        self._watcher = None
+        self._seenMtime = self._current.mtime
+        self._logger = logging.getLogger('MAINLOG.settings')
+
+    def current(self):
+        return self._current
+
+    def onChange(self, callback):
+        self._callbacks.append(callback)
+
+    def reload(self):
+        """
+        Returns True if a new snapshot was swapped in
+        """
+        with self._lock:
+            old = self._current
+            try:
+                new = Settings.load(self.path)
+            except ConfigError as e:
+                self._logger.error("Keeping the current configuration. %s", e)
+                return False
+            changes = new.changes(old)
+            self._current = new
+        if not len(changes):
+            self._logger.debug("Configuration reloaded without changes")
+            return True
+        self._logger.info("Configuration reloaded. Changed: %s", ", ".join(changes))
+        needRestart = [name for name in changes if name in RESTART_REQUIRED]
+        if len(needRestart): self._logger.warning("Changes to %s take effect after a restart", ", ".join(needRestart))
+        for callback in list(self._callbacks):
+            try: callback(old, new)
+            except Exception: self._logger.exception("Configuration change handler failed")
+        return True
+
+    def requestReload(self):
+        """
+        Ask the watcher thread to reload. Safe to call from a signal handler
+        """
+        self._reloadRequested.set()
+
+    def watch(self, interval=5.):
+        """
+        Start a daemon thread that reloads on requestReload() or when the file's mtime changes
+        """
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="ConfigWatcher", daemon=True)
+        self._watcher.start()
+
+    def _watch(self, interval):
+        while True:
+            requested = self._reloadRequested.wait(interval)
+            self._reloadRequested.clear()
+            if not requested:
+                try: mtime = os.stat(self.path).st_mtime_ns
+                except OSError: continue
+                if mtime == self._seenMtime: continue
+                self._seenMtime = mtime
+            self.reload()
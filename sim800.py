@@ -1,12 +1,17 @@
 #!/usr/bin/python3
 from serial import Serial
-import RPi.GPIO as IO, atexit, logging, sys
+import atexit, functools, logging, sys, os
+if os.environ.get("HOMESEC_GPIO")=="stub": import gpiostub as IO
+else: import RPi.GPIO as IO
 from time import sleep
 import time
+import threading
+import queue
 from enum import IntEnum
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import re
 
-PORT="/dev/ttyAMA0"
+PORT=os.environ.get("HOMESEC_SERIAL_PORT", "/dev/ttyAMA0")
 BAUD=9600
 GSM_ON=11
 GSM_RESET=12
@@ -18,6 +23,29 @@ APN_PASSWORD="" # Leave blank
 
 BALANCE_USSD="*100#"
 
+#result codes that terminate the response to an AT command
+FINAL_RESPONSES=("OK", "ERROR", "NO CARRIER", "BUSY", "NO ANSWER", "NO DIALTONE")
+FINAL_RESPONSE_PREFIXES=("+CME ERROR", "+CMS ERROR")
+PROMPT=">"
+
+#control characters that would end (Ctrl-Z) or abort (Esc) SMS text input early, or garble it.
+#Line feeds are kept
+SMS_TEXT_CONTROL=re.compile(r'[\x00-\x09\x0b-\x1f\x7f]')
+
+#start of each message in an AT+CMGL listing
+CMGL_HEADER=re.compile(r'\+CMGL: \d+,"')
+
+#unsolicited result codes (URCs) the MT may send at any time
+URC_PREFIXES=("RDY", "Call Ready", "SMS Ready", "RING", "+CMTI:", "+CLCC:", "NO CARRIER", "BUSY", "NO ANSWER", "MO RING", "MO CONNECTED", "+CUSD:",
+        "+CREG:", "+CPIN:")
+
+#URCs the MT sends once it has booted
+BOOT_READY_URCS=("RDY", "Call Ready", "SMS Ready")
+
+#unsolicited call result codes that end a call, and all URCs that report call progress
+CALL_END_RESPONSES=("NO CARRIER", "BUSY", "NO ANSWER")
+CALL_EVENT_PREFIXES=("+CLCC:", "MO RING", "MO CONNECTED")+CALL_END_RESPONSES
+
 # Balance: *100*7#
 # Remaining Credit: *100#
 # Voicemail: 443 (costs 8p!)
@@ -55,11 +83,12 @@ class SMSStatus(IntEnum):
 
     @classmethod
     def fromStat(cls, stat):
-        if stat=='"REC UNREAD"': return cls.Unread
-        elif stat=='"REC READ"': return cls.Read
-        elif stat=='"STO UNSENT"': return cls.Unsent
-        elif stat=='"STO SENT"': return cls.Sent
-        elif stat=='"ALL"': return cls.All
+        stat=stat.strip('"')
+        if stat=="REC UNREAD": return cls.Unread
+        elif stat=="REC READ": return cls.Read
+        elif stat=="STO UNSENT": return cls.Unsent
+        elif stat=="STO SENT": return cls.Sent
+        elif stat=="ALL": return cls.All
 
     @classmethod
     def toStat(cls, stat):
@@ -107,14 +136,29 @@ class NetworkStatus(IntEnum):
 def cleanup(): IO.cleanup()
 
 class SMS(object):
-    def __init__(self, port, baud, logger=None, loglevel=logging.WARNING):
+    def __init__(self, port, baud, logger=None, loglevel=logging.WARNING, powerPin=GSM_ON, resetPin=GSM_RESET):
         self._port=port
         self._baud=baud
+        self._powerPin=powerPin
+        self._resetPin=resetPin
+        self.lastDialError=None #result of the ATD command if the last placeCall could not dial
 
         self._ready=False
         self._serial=None
 
-        self._interruptMTDataWait = False #flag variable for controlling exiting of MT data wait mode
+        self._reader=None
+        self._stopReader=False
+        self._commandLock=threading.Lock() #only one command may be awaiting its response at a time
+        self._pendingCommand=None
+        self._urcHandlers=[]
+        self._callStatusReporting=False
+        self.needsConfigure=False #set when the MT reports it has (re)booted, until configure() runs again
+
+        #shadow copy of MT configuration so redundant settings are not re-sent
+        self._settings={}
+        self._settingsStats={"skippedSets":0, "savedRoundTrips":0, "invalidations":0}
+        for prefix in BOOT_READY_URCS: self.registerURCHandler(prefix, self._onBoot)
+        self._mtDataQueue=None #queue used by awaitDataFromMT() while it is waiting
 
         if logger: self._logger=logger
         else:
@@ -130,100 +174,310 @@ class SMS(object):
         """
         self._logger.debug("Setup")
         IO.setmode(IO.BOARD)
-        IO.setup(GSM_ON, IO.OUT, initial=IO.LOW)
-        IO.setup(GSM_RESET, IO.OUT, initial=IO.LOW)
-        self._serial=Serial(self._port, self._baud)
+        IO.setup(self._powerPin, IO.OUT, initial=IO.LOW)
+        IO.setup(self._resetPin, IO.OUT, initial=IO.LOW)
+        self._serial=Serial(self._port, self._baud, timeout=.5)
+        self._reader=threading.Thread(target=self._readSerial, name="SIM800Reader-{}".format(os.path.basename(self._port)), daemon=True)
+        self._reader.start()
 
-    def reset(self):
+    def close(self):
         """
-        Reset (turn on) the SIM800 module by taking the power line for >1s
-        and then wait 15s for the module to boot.
+        Stop the serial reader thread and close the serial port.
         """
-        self._logger.debug("Reset (duration ~16.2s)")
-        IO.output(GSM_ON, IO.HIGH)
-        sleep(1.2)
-        IO.output(GSM_ON, IO.LOW)
-        sleep(15.)
+        self._stopReader=True
+        if self._reader is not None: self._reader.join(2.)
+        if self._serial is not None: self._serial.close()
+
+    def reset(self, timeout=15.):
+        """
+        Reset (turn on) the SIM800 module by taking the power line for >1s and then
+        wait for the module to report it has booted (RDY, Call Ready or SMS Ready),
+        for at most timeout seconds. Returns True if the module reported in time.
+        """
+        self._logger.debug("Reset (at most %ss)", 1.2+timeout)
+        self.invalidateSettingsCache("reset")
+        booted=threading.Event()
+        onBoot=lambda line: booted.set()
+        for prefix in BOOT_READY_URCS: self.registerURCHandler(prefix, onBoot)
+        try:
+            start=time.time()
+            IO.output(self._powerPin, IO.HIGH)
+            sleep(1.2)
+            IO.output(self._powerPin, IO.LOW)
+            ready=booted.wait(timeout)
+        finally:
+            for prefix in BOOT_READY_URCS: self.unregisterURCHandler(prefix, onBoot)
+        if ready: self._logger.debug("GSM module booted after %.1fs", time.time()-start)
+        else: self._logger.warning("GSM module did not report booting within %ss", timeout)
+        return ready
+
+    def _decodeLine(self, raw):
+        try: return raw.decode('utf-8').strip()
+        except UnicodeDecodeError: return raw.decode('latin1').strip()
+
+    def _isFinalResponse(self, line, response):
+        """
+        Check whether a response line terminates the current command. The caller's
+        expected response always counts as final, as do the standard result codes.
+        """
+        if line==response or line==PROMPT or line in FINAL_RESPONSES: return True
+        return line.startswith(FINAL_RESPONSE_PREFIXES)
 
-    def sendATCmdWaitResp(self, cmd, response, timeout=.5, interByteTimeout=.1, attempts=1, addCR=False):
+    def _isURC(self, line, cmd):
+        """
+        Check whether a line is an unsolicited result code rather than part of the
+        response to cmd. Information responses to cmd itself (e.g. +CLCC lines for AT+CLCC)
+        and call result codes for ATD/ATA are not treated as URCs. A +CREG URC is told from
+        the AT+CREG? response by its form, as either may arrive while AT+CREG? is pending.
+        """
+        if not line.startswith(URC_PREFIXES): return False
+        if cmd is None: return True
+        if line.startswith("+CREG:") and parseRegistrationIndication(line) is not None: return True
+        cmd=cmd.upper()
+        if line.startswith("+"):
+            #a batch (AT+CMGF=1;+CMGR=1) may answer for any of its commands
+            name=line.split(":",1)[0]
+            return not cmd.startswith("AT") or not any(part.startswith(name) for part in cmd[2:].split(";"))
+        if line in CALL_END_RESPONSES: return not cmd.startswith(("ATD","ATA"))
+        return True
+
+    def _readSerial(self):
+        """
+        Serial reader thread. Owns all reads from the port, passes lines to the command
+        awaiting its response and dispatches unsolicited result codes to their handlers.
+        """
+        pending=b''
+        while not self._stopReader:
+            try: chunk=self._serial.read(max(1, self._serial.in_waiting))
+            except Exception as e:
+                if self._stopReader: break
+                self._logger.error("Serial read failed: %s", e)
+                sleep(.5)
+                continue
+            if not len(chunk): continue
+            pending+=chunk
+            *complete,pending=pending.split(b'\n')
+            for raw in complete:
+                line=self._decodeLine(raw)
+                if len(line): self._routeLine(line)
+            #the SMS input prompt is not followed by a line break
+            if pending.strip()==PROMPT.encode():
+                pending=b''
+                self._routeLine(PROMPT)
+
+    def _routeLine(self, line):
+        command=self._pendingCommand
+        if command is not None and not self._isURC(line, command.cmd):
+            command.lines.put(line)
+        elif line!=PROMPT:
+            self._dispatchURC(line)
+
+    def _dispatchURC(self, line):
+        self._logger.info("MT said: %s", line)
+        handled=False
+        for prefix,handler in list(self._urcHandlers):
+            if not line.startswith(prefix): continue
+            handled=True
+            try:
+                if hasattr(handler, "put"): handler.put(line)
+                else: handler(line)
+            except Exception:
+                self._logger.exception("URC handler failed for: %s", line)
+        mtDataQueue=self._mtDataQueue
+        if mtDataQueue is not None: mtDataQueue.put(line)
+        elif not handled: self._logger.debug("No handler for MT data: %s", line)
+
+    def registerURCHandler(self, prefix, handler):
+        """
+        Register a handler for unsolicited result codes starting with prefix. The handler
+        is either a callable taking the line or a queue the line is put on. Callables run
+        on the serial reader thread, so they must return quickly and must not send AT
+        commands themselves; hand such work off to another thread.
+        """
+        self._urcHandlers.append((prefix, handler))
+
+    def unregisterURCHandler(self, prefix, handler):
+        try: self._urcHandlers.remove((prefix, handler))
+        except ValueError: pass
+
+    def _transact(self, data, cmd, response, timeout):
+        """
+        Write data to the MT and collect the response lines until a final result code
+        arrives or timeout seconds have passed.
+        """
+        with self._commandLock:
+            command=_PendingCommand(cmd)
+            self._pendingCommand=command
+            try:
+                self._serial.write(data)
+                self._serial.flush()
+                lines=self._readResponse(command, response, timeout)
+            finally:
+                self._pendingCommand=None
+        #after an error we can no longer be sure what state the MT is in
+        if not len(lines) or lines[-1]!=response: self.invalidateSettingsCache("error response to {}".format(cmd))
+        return lines
+
+    def _onBoot(self, line):
+        """
+        Boot URC handler. A module that restarted has lost its configuration: echo is back on
+        and no call status, SMS or registration URCs are sent until configure() runs again
+        """
+        self.invalidateSettingsCache("power on")
+        self._callStatusReporting=False
+        self.needsConfigure=True
+
+    def invalidateSettingsCache(self, reason):
+        """
+        Forget the shadowed MT configuration so the next setting calls are sent again.
+        """
+        if not len(self._settings): return
+        self._logger.debug("Invalidating settings cache: %s", reason)
+        self._settings={}
+        self._settingsStats["invalidations"]+=1
+
+    def getSettingsCacheStats(self):
+        """
+        Counters for the settings cache: sets skipped, round trips saved and cache invalidations.
+        """
+        return dict(self._settingsStats)
+
+    def _setCached(self, key, value, cmds):
+        """
+        Send the setting commands in cmds unless the shadow cache shows the MT already has
+        key set to value. Several commands go out as one batch. Returns the status of the
+        batch, OK on a cache hit.
+        """
+        status,_=self.sendATBatch([], settings=[(key, value, cmds)])
+        return status
+
+    def _readResponse(self, command, response, timeout):
+        """
+        Collect response lines from the reader thread until a final result code (or the
+        expected response) arrives. The timeout is only an upper bound for the whole
+        response; this returns as soon as the modem terminates its answer.
+        """
+        deadline=time.time()+timeout
+        lines=[]
+        while True:
+            remaining=deadline-time.time()
+            if remaining<=0: break
+            try: line=command.lines.get(timeout=remaining)
+            except queue.Empty: break
+            lines.append(line)
+            if self._isFinalResponse(line, response): return lines
+        self._logger.debug("No final response within %s seconds", timeout)
+        return lines
+
+    def sendATCmdWaitResp(self, cmd, response, timeout=.5, attempts=1, addCR=False):
         """
         This function is designed to check for simple one line responses, e.g. 'OK'.
         """
-        self._logger.debug("Send AT Command: {}".format(cmd))
-        self._serial.timeout=timeout
-        self._serial.inter_byte_timeout=interByteTimeout
+        self._logger.debug("Send AT Command: %s", cmd)
 
         status=ATResp.ErrorNoResponse
         for i in range(attempts):
             bcmd=cmd.encode('utf-8')+b'\r'
             if addCR: bcmd+=b'\n'
 
-            self._logger.debug("Attempt {}, ({})".format(i+1, bcmd))
-            #self._serial.write(cmd.encode('utf-8')+b'\r')
-            self._serial.write(bcmd)
-            self._serial.flush()
-
-            lines=self._serial.readlines()
-            lines=[l.decode('utf-8').strip() for l in lines]
-            lines=[l for l in lines if len(l) and not l.isspace()]
-            self._logger.debug("Lines: {}".format(lines))
+            self._logger.debug("Attempt %s, (%s)", i+1, bcmd)
+            lines=self._transact(bcmd, cmd, response, timeout)
+            self._logger.debug("Lines: %s", lines)
             if len(lines)<1: continue
             line=lines[-1]
-            self._logger.debug("Line: {}".format(line))
+            self._logger.debug("Line: %s", line)
 
-            if not len(line) or line.isspace(): continue
-            elif line==response: return ATResp.OK            
+            if line==response: return ATResp.OK
             else: return ATResp.ErrorDifferentResponse
         return status
 
-    def sendATCmdWaitReturnResp(self, cmd, response, timeout=.5, interByteTimeout=.1):
+    def sendATCmdWaitReturnResp(self, cmd, response, timeout=.5):
         """
         This function is designed to return data and check for a final response, e.g. 'OK'
         """        
-        self._logger.debug("Send AT Command: {}".format(cmd))
-        self._serial.timeout=timeout
-        self._serial.inter_byte_timeout=interByteTimeout
-
-        self._serial.write(cmd.encode('utf-8')+b'\r')
-        self._serial.flush()
-        lines=self._serial.readlines()
-        for n in range(len(lines)):
-            try: lines[n]=lines[n].decode('utf-8').strip()
-            except UnicodeDecodeError: lines[n]=lines[n].decode('latin1').strip()
+        self._logger.debug("Send AT Command: %s", cmd)
 
-        lines=[l for l in lines if len(l) and not l.isspace()]        
-        self._logger.debug("Lines: {}".format(lines))
+        lines=self._transact(cmd.encode('utf-8')+b'\r', cmd, response, timeout)
+        self._logger.debug("Lines: %s", lines)
 
         if not len(lines): return (ATResp.ErrorNoResponse, None)
 
         _response=lines.pop(-1)
-        self._logger.debug("Response: {}".format(_response))
-        if not len(_response) or _response.isspace(): return (ATResp.ErrorNoResponse, None)
-        elif response==_response: return (ATResp.OK, lines)
+        self._logger.debug("Response: %s", _response)
+        if response==_response: return (ATResp.OK, lines)
         return (ATResp.ErrorDifferentResponse, None)
 
+    def sendATBatch(self, cmds, timeout=.5, settings=()):
+        """
+        Send several commands in one round trip as a concatenated command line, e.g.
+        ["AT+CLVL=100", "ATL9"] as AT+CLVL=100;L9, and split the information response back by
+        command. Returns (status, results), where results has the response lines of each
+        command in cmds, or (status, None) if the batch failed. The MT stops at the first
+        command that fails and answers ERROR for the whole line, so the commands before it
+        have taken effect but it cannot be told which one failed.
+        Lines are matched to commands by their +NAME: prefix and a line without one belongs to
+        the command of the line before, so only the first command may answer with bare lines.
+        Commands that prompt for input (AT+CMGS) or dial cannot be batched.
+        settings are (key, value, commands) as for _setCached: the commands of those the shadow
+        cache does not show as set are sent in front of cmds and cached when the batch succeeds.
+        They must not answer with information lines.
+        """
+        pending=[]
+        for key,value,setting in settings:
+            if key in self._settings and self._settings[key]==value: self._settingsStats["skippedSets"]+=1
+            else: pending.append((key, value, setting))
+        batch=[cmd for _,_,setting in pending for cmd in setting]+list(cmds)
+        if not len(batch):
+            self._settingsStats["savedRoundTrips"]+=1
+            return (ATResp.OK, [])
+
+        line=batch[0]+"".join(";"+cmd[2:] for cmd in batch[1:])
+        self._logger.debug("Send AT Batch: %s", line)
+        lines=self._transact(line.encode('utf-8')+b'\r', line, "OK", timeout)
+        self._logger.debug("Lines: %s", lines)
+
+        if not len(lines): return (ATResp.ErrorNoResponse, None)
+        if lines.pop(-1)!="OK": return (ATResp.ErrorDifferentResponse, None)
+        for key,value,_ in pending: self._settings[key]=value
+        return (ATResp.OK, _splitBatchResponse(list(cmds), lines))
+
     def parseReply(self, data, beginning, divider=',', index=0):
         """
         Parse an AT response line by checking the reply starts with the expected prefix,
         splitting the reply into its parts by the specified divider and then return the 
         element of the response specified by index.
         """
-        self._logger.debug("Parse Reply: {}, {}, {}, {}".format(data, beginning, divider, index))
+        self._logger.debug("Parse Reply: %s, %s, %s, %s", data, beginning, divider, index)
         if not data.startswith(beginning): return False, None
-        data=data.replace(beginning,"")
-        data=data.split(divider)
+        data=data[len(beginning):].split(divider)
         try: return True,data[index]
         except IndexError: return False, None
 
-    def getSingleResponse(self, cmd, response, beginning, divider=",", index=0, timeout=.5, interByteTimeout=.1):
+    def getSingleResponse(self, cmd, response, beginning, divider=",", index=0, timeout=.5):
         """
         Run a command, get a single line response and the parse using the
         specified parameters.
         """
-        status,data=self.sendATCmdWaitReturnResp(cmd,response,timeout=timeout,interByteTimeout=interByteTimeout)
+        status,data=self.sendATCmdWaitReturnResp(cmd,response,timeout=timeout)
         if status!=ATResp.OK: return None
-        if len(data)!=1: return None
-        ok,data=self.parseReply(data[0], beginning, divider, index)
+        return self._parseSingleReply(data, beginning, divider, index)
+
+    def queryReply(self, cmd, replyType, timeout=.5):
+        """
+        Run a query and return the reply record (see parseResponse) of its only response line,
+        or None if it fails or does not parse
+        """
+        status,lines=self.sendATCmdWaitReturnResp(cmd,"OK",timeout=timeout)
+        if status!=ATResp.OK: return None
+        return _singleReply(lines, replyType)
+
+    def _parseSingleReply(self, lines, beginning, divider=",", index=0):
+        """
+        parseReply() the only line of a command's response. None if there is not exactly one
+        or it does not parse
+        """
+        if len(lines)!=1: return None
+        ok,data=self.parseReply(lines[0], beginning, divider, index)
         if not ok: return None
         return data
 
@@ -234,7 +488,9 @@ class SMS(object):
         """
         self._logger.debug("Turn On")
         for i in range(2):
-            status=self.sendATCmdWaitResp("AT", "OK", attempts=5)
+            #a module that is on answers within milliseconds, so the first probe is kept short
+            if i==0: status=self.sendATCmdWaitResp("AT", "OK", timeout=.3, attempts=2)
+            else: status=self.sendATCmdWaitResp("AT", "OK", attempts=5)
             if status==ATResp.OK:
                 self._logger.debug("GSM module ready.")
                 self._ready=True
@@ -247,14 +503,27 @@ class SMS(object):
             else: self._logger.error("GSM module failed to respond after reset!")
         return False
 
+    def isResponsive(self):
+        """
+        Quick check that the module answers AT commands, without resetting it
+        """
+        return self.sendATCmdWaitResp("AT", "OK", timeout=.3, attempts=2)==ATResp.OK
+
     def setEchoOff(self):
         """
         Switch off command echoing to simplify response parsing.
         """
         self._logger.debug("Set and Test Echo Off")
+        if self._settings.get("echo")==False:
+            self._settingsStats["skippedSets"]+=1
+            self._settingsStats["savedRoundTrips"]+=2
+            return True
         self.sendATCmdWaitResp("ATE0", "OK")
         status,lines=self.sendATCmdWaitReturnResp("ATE0", "OK")
-        return status==ATResp.OK and not len(lines)
+        if status==ATResp.OK and not len(lines):
+            self._settings["echo"]=False
+            return True
+        return False
     '''
     Old function replaced by ISO M.CodD
     def setEchoOff(self):
@@ -306,19 +575,58 @@ class SMS(object):
         Get the current network connection status.
         """
         self._logger.debug("Get Network Status")
-        status=self.getSingleResponse("AT+CREG?","OK","+CREG: ",index=1)
-        if status is None: return status
-        return NetworkStatus(int(status))
+        registration=self.queryReply("AT+CREG?", Registration)
+        if registration is None: return None
+        return registration.status
+
+    def enableRegistrationReporting(self):
+        """
+        Have the MT announce network registration changes with a +CREG URC
+        (see parseRegistrationIndication)
+        """
+        status=self._setCached("creg", 1, ["AT+CREG=1"])
+        return status==ATResp.OK
+
+    def getSignalQuality(self):
+        """
+        Get the raw AT+CSQ signal quality: 0-31, or 99 if unknown or not detectable
+        """
+        self._logger.debug("Get Signal Quality")
+        csq=self.queryReply("AT+CSQ", SignalQuality)
+        if csq is None: return None
+        return csq.rssi
 
     def getRSSI(self):
         """
         Get the current signal strength in 'bars'
         """
         self._logger.debug("Get Received Signal Strength Indication (RSSI)")
-        csq=self.getSingleResponse("AT+CSQ","OK","+CSQ: ")
+        csq=self.getSignalQuality()
         if csq is None: return csq
         return RSSI.fromCSQ(csq)
 
+    def getSIMStatus(self):
+        """
+        Get the SIM state reported by AT+CPIN?, e.g. READY or SIM PIN. None if the query
+        fails, which is what a missing SIM gives
+        """
+        self._logger.debug("Get SIM Status")
+        return self.getSingleResponse("AT+CPIN?","OK","+CPIN: ")
+
+    def getRadioStatus(self):
+        """
+        (SIM state, NetworkStatus, signal quality) as getSIMStatus(), getNetworkStatus() and
+        getSignalQuality() return them, in one round trip. Falls back to one query each if the
+        batch fails, as it does without a SIM, so the other two still get through
+        """
+        self._logger.debug("Get Radio Status")
+        status,results=self.sendATBatch(["AT+CPIN?", "AT+CREG?", "AT+CSQ"], timeout=1.)
+        if status!=ATResp.OK: return self.getSIMStatus(), self.getNetworkStatus(), self.getSignalQuality()
+        sim=self._parseSingleReply(results[0], "+CPIN: ")
+        registration=_singleReply(results[1], Registration)
+        csq=_singleReply(results[2], SignalQuality)
+        return sim, None if registration is None else registration.status, None if csq is None else csq.rssi
+
     def enableNetworkTimeSync(self, enable):
         self._logger.debug("Enable network time synchronisation")
         status=self.sendATCmdWaitResp("AT+CLTS={}".format(int(enable)),"OK")
@@ -336,7 +644,7 @@ class SMS(object):
     def setTime(self, time):
         """
         """
-        self._logger.debug("Set the current time: {}".format(time))
+        self._logger.debug("Set the current time: %s", time)
         time=datetime.strftime(time, DATE_FMT)
         if time[-4]!="+": time=time[:-1]+'+00"'
         status=self.sendATCmdWaitResp("AT+CCLK={}".format(time),"OK")
@@ -346,11 +654,11 @@ class SMS(object):
         """
         Set the SMS message format either as PDU or text.
         """
-        status=self.sendATCmdWaitResp("AT+CMGF={}".format(format), "OK")
+        status=self._setCached(*_messageFormatSetting(format))
         return status==ATResp.OK
 
     def setSMSTextMode(self, mode):
-        status=self.sendATCmdWaitResp("AT+CSDH={}".format(mode), "OK")
+        status=self._setCached(*_textModeSetting(mode))
         return status==ATResp.OK
 
     def getNumSMS(self):
@@ -358,91 +666,99 @@ class SMS(object):
         Get the number of SMS on SIM card
         """
         self._logger.debug("Get Number of SMS")
-        if not self.setSMSMessageFormat(SMSMessageFormat.Text):
-            self._logger.error("Failed to set SMS Message Format!")
-            return False
-
-        if not self.setSMSTextMode(SMSTextMode.Show):
-            self._logger.error("Failed to set SMS Text Mode!")
-            return False
-
-        num=self.getSingleResponse('AT+CPMS?', "OK", "+CPMS: ", divider='"SM",', index=1)
+        status,results=self.sendATBatch(['AT+CPMS?'], settings=self._smsTextSettings())
+        if status!=ATResp.OK: return None
+        num=self._parseSingleReply(results[0], "+CPMS: ", divider='"SM",', index=1)
         if num is None: return num
         n,t,*_=num.split(',')
         return int(n),int(t)
 
     def readSMS(self, number):
         """
-        Returns status, phone number, date/time and message in location specified by 'number'.
+        Returns the SMSRecord in location specified by 'number', or None if it is empty or cannot be read.
         """
-        self._logger.debug("Read SMS: {}".format(number))
-        if not self.setSMSMessageFormat(SMSMessageFormat.Text):
-            self._logger.error("Failed to set SMS Message Format!")
-            return None
-
-        if not self.setSMSTextMode(SMSTextMode.Show):
-            self._logger.error("Failed to set SMS Text Mode!")
+        self._logger.debug("Read SMS: %s", number)
+        status,results=self.sendATBatch(["AT+CMGR={}".format(number)], settings=self._smsTextSettings())
+        if status!=ATResp.OK: return None
+        lines=results[0]
+        if not len(lines) or not lines[0].startswith("+CMGR: "): return None
+        #the message body that follows the header may span several lines
+        header=parseResponse(lines[0], SMSHeader)
+        if header is None:
+            self._logger.error("Unexpected SMS header: %s", lines[0])
             return None
-
-        status,(params,msg)=self.sendATCmdWaitReturnResp("AT+CMGR={}".format(number),"OK")
-        if status!=ATResp.OK or not params.startswith("+CMGR: "): return None
-
-        # stat   : message status = "REC UNREAD", "REC READ", "STO UNSENT", "STO SENT", "ALL"
-        # oa     : originating address
-        # alpha  : string of "oa" or "da"
-        # scts   : service center timestamp "YY/MM/DD,HH:MM:SS+ZZ"
-        # tooa   : originating address type
-        # fo     : 
-        # pid    : protocol ID
-        # dcs    : data coding scheme
-        # sca    : 
-        # tosca  : 
-        # length : length of the message body
-        stat,oa,alpha,scts1,scts2,tooa,fo,pid,dcs,sca,tosca,length=params[7:].split(',')
-
-        scts=scts1+','+scts2
-        tz=scts[-2:]
-        scts=scts[:-1]+'00"'
-        scts=datetime.strptime(scts, DATE_FMT)
-        return SMSStatus.fromStat(stat),oa[1:-1],scts,msg
+        return SMSRecord(int(number), header.status, header.number, header.timestamp, "\n".join(lines[1:]))
 
     def readAllSMS(self, status=SMSStatus.All):
+        """
+        Generator of SMSRecords for the messages with the given status, in storage order
+        """
         self._logger.debug("Read All SMS")
-        if not self.setSMSMessageFormat(SMSMessageFormat.Text):
-            self._logger.error("Failed to set SMS Message Format!")
-            return None
+        response,results=self.sendATBatch(['AT+CMGL="{}"'.format(SMSStatus.toStat(status))], timeout=5.,
+                settings=self._smsTextSettings())
+        if response!=ATResp.OK: return
+        lines=results[0]
+        #each header is followed by the message body, which may span several lines
+        header,body=None,[]
+        for line in lines+[None]:
+            if line is not None and not CMGL_HEADER.match(line):
+                if header is not None: body.append(line)
+                continue
+            if header is not None:
+                listing=parseResponse(header, SMSListing)
+                if listing is not None:
+                    yield SMSRecord(listing.index, listing.status, listing.number, listing.timestamp, "\n".join(body))
+                else: self._logger.error("Unexpected SMS header: %s", header)
+            header,body=line,[]
+
+    def inbox(self, indices=None):
+        """
+        Generator of the received SMSRecords stored in the given locations, or in all
+        locations if indices is None. Each message is deleted from storage once the
+        consumer asks for the next one (or the loop ends), so a message whose
+        processing raised stays on the SIM and is picked up again on the next full scan.
+        """
+        if indices is None: records=self.readAllSMS(SMSStatus.All)
+        else: records=(self.readSMS(index) for index in indices)
+        for record in records:
+            if record is None: continue
+            if record.status not in (SMSStatus.Unread, SMSStatus.Read): continue
+            yield record
+            if not self.deleteSMS(record.index):
+                self._logger.error("Failed to delete SMS in location %s", record.index)
+
+    def enableNewSMSIndication(self):
+        """
+        Have the MT announce each received SMS with a +CMTI URC carrying its storage location
+        """
+        status=self._setCached("cnmi", (2,1), ["AT+CNMI=2,1"])
+        return status==ATResp.OK
 
-        if not self.setSMSTextMode(SMSTextMode.Show):
-            self._logger.error("Failed to set SMS Text Mode!")
-            return None
+    def _smsTextSettings(self):
+        """
+        Text mode with the full header, which reading SMS relies on, as sendATBatch settings
+        """
+        return [_messageFormatSetting(SMSMessageFormat.Text), _textModeSetting(SMSTextMode.Show)]
 
-        status,msgs=self.sendATCmdWaitReturnResp('AT+CMGL="{}"'.format(SMSStatus.toStat(status)), "OK")
-        if status!=ATResp.OK: return None
-        if len(msgs)==0: return None
-        if not msgs[0].startswith("+CMGL: ") or len(msgs)%2!=0: return None
-
-        formatted=[]
-        for n in range(0, len(msgs), 2):
-            params,msg=msgs[n:n+2]
-            if n==0: params=params[7:]
-            print(params)
-            loc,stat,oa,alpha,scts1,scts2,tooa,fo,pid,dcs,sca,tosca,length=params.split(',')
-            scts=scts1+','+scts2
-            tz=scts[-2:]
-            scts=scts[:-1]+'00"'
-            scts=datetime.strptime(scts, DATE_FMT)
-            formatted.append((loc,SMSStatus.fromStat(stat),oa[1:-1],scts,msg))
-        return formatted
+    def configure(self):
+        """
+        Set up the MT for the daemon in one round trip: call status reporting, new SMS and
+        registration indications, and the SMS text format. Returns False if the MT rejected
+        any of it; enableCallStatusReporting() and friends then tell which
+        """
+        self._logger.debug("Configure")
+        self.needsConfigure=False
+        status,_=self.sendATBatch(["AT+CLCC=1", "AT+MORING=1"], timeout=2.,
+                settings=[("cnmi", (2,1), ["AT+CNMI=2,1"]), ("creg", 1, ["AT+CREG=1"])]+self._smsTextSettings())
+        self._callStatusReporting=status==ATResp.OK
+        return status==ATResp.OK
 
     def deleteSMS(self, number):
         """
         Delete the SMS in location specified by 'number'.
         """
-        self._logger.debug("Delete SMS: {}".format(number))
-        if not self.setSMSMessageFormat(SMSMessageFormat.Text):
-            self._logger.error("Failed to set SMS Message Format!")
-            return False        
-        status=self.sendATCmdWaitResp("AT+CMGD={:03d}".format(number), "OK")
+        self._logger.debug("Delete SMS: %s", number)
+        status,_=self.sendATBatch(["AT+CMGD={:03d}".format(number)], settings=[_messageFormatSetting(SMSMessageFormat.Text)])
         return status==ATResp.OK
     
     def deleteAllSMS(self, timeOut=None):
@@ -463,105 +779,194 @@ class SMS(object):
 
     def sendSMS(self, phoneNumber, msg):
         """
-        Send the specified message text to the provided phone number.
+        Send the specified message text to the provided phone number. Control characters other
+        than line feeds are removed, so the text cannot end the input early and smuggle in a command
         """
-        self._logger.debug("Send SMS: {} '{}'".format(phoneNumber, msg))
+        self._logger.debug("Send SMS: %s '%s'", phoneNumber, msg)
+        text=SMS_TEXT_CONTROL.sub("", msg)
+        if text!=msg:
+            self._logger.warning("Removed %s control characters from SMS text to %s", len(msg)-len(text), phoneNumber)
+            msg=text
         if not self.setSMSMessageFormat(SMSMessageFormat.Text):
             self._logger.error("Failed to set SMS Message Format!")
             return False
 
         status=self.sendATCmdWaitResp('AT+CMGS="{}"'.format(phoneNumber), ">", addCR=True)
         if status!=ATResp.OK:
-            self._logger.error("Failed to send CMGS command part 1! {}".format(status))
+            self._logger.error("Failed to send CMGS command part 1! %s", status)
             return False
 
-        cmgs=self.getSingleResponse(msg+"\x1a", "OK", "+", divider=":", timeout=11., interByteTimeout=1.2)
+        cmgs=self.getSingleResponse(msg+"\x1a", "OK", "+", divider=":", timeout=11.)
         return cmgs=="CMGS"
 
-    def sendUSSD(self, ussd):
+    def sendUSSD(self, ussd, cancel=None):
+        """
+        Send Unstructured Supplementary Service Data message. Setting cancel (a threading.Event)
+        while the network reply is awaited ends the USSD session and returns None at once
+        """
+        self._logger.debug("Send USSD: %s", ussd)
+        #the network reply normally arrives as a URC after the OK
+        replies=queue.Queue()
+        self.registerURCHandler("+CUSD:", replies)
+        try:
+            deadline=time.time()+11.
+            status,lines=self.sendATCmdWaitReturnResp('AT+CUSD=1,"{}"'.format(ussd), "OK", timeout=11.)
+            if status!=ATResp.OK: return None
+            lines=[l for l in lines if l.startswith("+CUSD: ")]
+            if len(lines): reply=lines[0]
+            else:
+                reply=None
+                while reply is None:
+                    remaining=deadline-time.time()
+                    if remaining<=0: return None
+                    if cancel is not None and cancel.is_set():
+                        self._logger.debug("USSD session cancelled")
+                        self.sendATCmdWaitResp("AT+CUSD=2","OK")
+                        return None
+                    try: reply=replies.get(timeout=remaining if cancel is None else min(remaining, .1))
+                    except queue.Empty: pass
+        finally:
+            self.unregisterURCHandler("+CUSD:", replies)
+        reply=parseResponse(reply, USSDReply)
+        if reply is None: return None
+        return reply.text
+
+
+    def enableCallStatusReporting(self, enable=True):
         """
-        Send Unstructured Supplementary Service Data message
+        Switch on unsolicited call status reporting (+CLCC and MO RING/MO CONNECTED).
+        While enabled, placeCall() follows the call from the pushed events instead of
+        polling AT+CLCC, which keeps the serial line free during the call
         """
-        self._logger.debug("Send USSD: {}".format(ussd))
-        reply=self.getSingleResponse('AT+CUSD=1,"{}"'.format(ussd), "OK", "+CUSD: ", index=1, timeout=11., interByteTimeout=1.2)
-        return reply
+        self._logger.debug("Set call status reporting: %s", enable)
+        status,_=self.sendATBatch(["AT+CLCC={}".format(int(enable)), "AT+MORING={}".format(int(enable))])
+        self._callStatusReporting=enable and status==ATResp.OK
+        return status==ATResp.OK
 
+    def _parseCallState(self, line, number):
+        """
+        Return the call state from a +CLCC line if it describes the call to number, else None
+        """
+        call=parseResponse(line, CallStatus)
+        if call is None or call.number!=number: return None
+        return call.state
 
-    def placeCall(self, number, timeout=60):
+    def _pollCallState(self, number):
         """
-        Place a call. If call is not connected by the timeout in seconds terminate it
+        Query the state of the call to number with AT+CLCC. Returns None if the call is gone
         """
-        self.hangUp()
-        self._logger.debug("Place call to: {}".format(number))
-        success=self.sendATCmdWaitResp("ATD{};".format(number),"OK")
-        if success!=ATResp.OK:
-            self._logger.error("Failed to place call to {}.".format(number))
-            return False
+        sleep(1.2)
+        #get states of current calls
+        response,currentStates=self.sendATCmdWaitReturnResp("AT+CLCC","OK")
+        if response!=ATResp.OK:
+            self._logger.error("Invalid response to current call status command")
+            return None
+        if not len(currentStates):
+            self._logger.debug("No current calls found")
+            return None
 
-        self.setSpeakerVolume(0)
-        inCall=True
-        lastCallState=CallState.Disconnected
-        callWasAlerted = False
-        callWasConnected = False
-        callStartTime = time.time()
-        while inCall:
-            sleep(1.2)
-            #get states of current calls
-            response,currentStates=self.sendATCmdWaitReturnResp("AT+CLCC","OK")
-            if response!=ATResp.OK:
-                self._logger.error("Invalid response to current call status command")
-                inCall=False
-                continue
-            if not len(currentStates):
-                self._logger.debug("No current calls found")
-                inCall=False
-                continue
+        #ensure we get this call's state
+        for line in currentStates:
+            currentCallState=self._parseCallState(line, number)
+            if currentCallState is not None: return currentCallState
+        self._logger.error("Current call state  (to %s)  not found.", number)
+        return None
 
-            #ensure we get this call's state
-            foundCallState=False
-            for line in currentStates:
-                if not line.startswith("+CLCC: "): continue
-                data=line.split(",")
-                try:
-                    calledNumber = data[5]
-                    currentCallState = int(data[2])
-                except IndexError:
-                    continue
+    def _awaitCallEvent(self, number, events, lastCallState, wait):
+        """
+        Wait up to wait seconds for a pushed call status event for the call to number.
+        Returns the new call state, lastCallState if nothing changed or None if the call ended
+        """
+        deadline=time.time()+wait
+        while True:
+            try: line=events.get(timeout=max(0, deadline-time.time()))
+            except queue.Empty: return lastCallState
+            if line in CALL_END_RESPONSES:
+                self._logger.debug("Call ended: %s", line)
+                return None
+            if line=="MO RING": return CallState.Alerting
+            if line=="MO CONNECTED": return CallState.Active
+            currentCallState=self._parseCallState(line, number)
+            if currentCallState==CallState.Disconnected:
+                self._logger.debug("Reported new call state: %s", CallState.Disconnected.name)
+                return None
+            if currentCallState is not None: return currentCallState
+
+    def placeCall(self, number, timeout=60, onConnected=None, cancel=None):
+        """
+        Place a call. If call is not connected by the timeout in seconds terminate it.
+        A connected call is kept up until the other side hangs up. With call status reporting
+        enabled a failed call is detected as soon as the MT reports it, otherwise AT+CLCC is polled.
+        onConnected is called (without arguments) the moment the call is answered.
+        Setting the cancel event (a threading.Event) hangs up a call that has not been answered yet
+        """
+        self.lastDialError=None
+        self.hangUp()
+        events=None
+        if self._callStatusReporting:
+            events=queue.Queue()
+            for prefix in CALL_EVENT_PREFIXES: self.registerURCHandler(prefix, events)
+        try:
+            self._logger.debug("Place call to: %s", number)
+            success=self.sendATCmdWaitResp("ATD{};".format(number),"OK")
+            if success!=ATResp.OK:
+                self._logger.error("Failed to place call to %s.", number)
+                self.lastDialError=success
+                return False
+
+            self.setSpeakerVolume(0)
+            inCall=True
+            lastCallState=CallState.Disconnected
+            callWasAlerted = False
+            callWasConnected = False
+            callStartTime = time.time()
+            while inCall:
+                if events is None:
+                    currentCallState=self._pollCallState(number)
                 else:
-                    if calledNumber=='"{}"'.format(number):
-                        foundCallState=True
-                        break
-            if not foundCallState:
-                self._logger.error("Current call state  (to {})  not found.".format(number))
-                inCall=False
-                continue
-            if currentCallState!=lastCallState:
-                self._logger.debug("Reported new call state: {}".format(CallState(currentCallState).name))
-                lastCallState = currentCallState
-                if currentCallState==CallState.Alerting: callWasAlerted = True
-            if currentCallState==CallState.Active and callWasAlerted:
-                if not callWasConnected:
-                    self._logger.debug("Call connected.")
-                    self.setSpeakerVolume(100)
-                callWasConnected=True
-                #inCall=False
-                continue
-            if currentCallState==CallState.Active and not callWasAlerted:
-                self._logger.debug("Call connected without Alerting. Possible zero balance situation")
-                callWasConnected=False
-                inCall=False
-                continue
+                    wait=1.
+                    if timeout and not callWasConnected: wait=max(0, callStartTime + timeout - time.time())
+                    if cancel is not None and not callWasConnected: wait=min(wait, .2)
+                    currentCallState=self._awaitCallEvent(number, events, lastCallState, wait)
+                if currentCallState is None:
+                    inCall=False
+                    continue
+                if currentCallState!=lastCallState:
+                    self._logger.debug("Reported new call state: %s", CallState(currentCallState).name)
+                    lastCallState = currentCallState
+                    if currentCallState==CallState.Alerting: callWasAlerted = True
+                if currentCallState==CallState.Active and callWasAlerted:
+                    if not callWasConnected:
+                        self._logger.debug("Call connected.")
+                        if onConnected is not None: onConnected()
+                        self.setSpeakerVolume(100)
+                    callWasConnected=True
+                    continue
+                if currentCallState==CallState.Active and not callWasAlerted:
+                    self._logger.debug("Call connected without Alerting. Possible zero balance situation")
+                    callWasConnected=False
+                    inCall=False
+                    continue
 
-            #terminate the call if it has timed out
-            if timeout and int(time.time() - callStartTime) > timeout:
-                self._logger.debug("Call timeout of {} seconds has been reached. Will hang up ".format(timeout))
-                inCall = False
-                continue
-            
+                if cancel is not None and cancel.is_set():
+                    self._logger.debug("Call to %s cancelled", number)
+                    inCall = False
+                    continue
+
+                #terminate the call if it has timed out
+                if timeout and time.time() - callStartTime >= timeout:
+                    self._logger.debug("Call timeout of %s seconds has been reached. Will hang up ", timeout)
+                    inCall = False
+                    continue
+        finally:
+            if events is not None:
+                for prefix in CALL_EVENT_PREFIXES: self.unregisterURCHandler(prefix, events)
 
         self.hangUp()
-        if not callWasConnected and lastCallState in (CallState.Dialing, CallState.Alerting):
-            self._logger.debug("Reason for call release: {}".format(self.getCallErrorReport()))
+        #AT+CEER costs a serial round trip, so only ask when the answer will be logged
+        if not callWasConnected and lastCallState in (CallState.Dialing, CallState.Alerting) \
+                and self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("Reason for call release: %s", self.getCallErrorReport())
 
         return callWasConnected
 
@@ -570,27 +975,15 @@ class SMS(object):
         response,currentStates=self.sendATCmdWaitReturnResp("AT+CLCC","OK")
         if response!=ATResp.OK:
             self._logger.error("Invalid response to current call status command")
-        if not len(currentStates):
+        if not currentStates:
             self._logger.debug("No current calls found")
 
         #ensure we get this call's state. It has to be incoming
-        foundCallState=False
-        callerNumber = None
-        for line in currentStates:
-            if not line.startswith("+CLCC: "): continue
-            callData=line.split(",")
-            try:
-                currentCallState = int(callData[2])
-                callerNumber = callData[5].replace('"','')
-            except IndexError:
-                continue
-            else:
-                if currentCallState==CallState.Incoming:
-                    foundCallState=True
-                    break
+        calls=[parseResponse(line, CallStatus) for line in currentStates or ()]
+        callerNumber=next((call.number for call in calls if call is not None and call.state==CallState.Incoming), None)
 
-        if foundCallState and callerNumber is not None:
-            self._logger.info("Incoming call from {}".format(callerNumber))
+        if callerNumber is not None:
+            self._logger.info("Incoming call from %s", callerNumber)
             if callerNumber in connectNumbers:
                 self.sendATCmdWaitResp("ATA", "OK")
                 self.setSpeakerVolume(100)
@@ -618,57 +1011,254 @@ class SMS(object):
             loudness = int((percent / 100) * 9)
         if(percent > 100):
             loudness = 9
-        self.sendATCmdWaitResp("AT+CLVL={}".format(percent),"OK")
-        return self.sendATCmdWaitResp("ATL{}".format(loudness),"OK")
+        return self._setCached("speaker", percent, ["AT+CLVL={}".format(percent), "ATL{}".format(loudness)])
 
     def getCallErrorReport(self):
         """
         Gets the detailed reason for last call release/termination
         """
         self._logger.debug("Get extended error report")
-        if self.sendATCmdWaitResp("AT+CEER=0","OK") != ATResp.OK: return False
-        status,report = self.sendATCmdWaitReturnResp("AT+CEER","OK")
-        if status != ATResp.OK: return False
-        report = report[0].split(":",1)
-        return report[-1]
+        status,results = self.sendATBatch(["AT+CEER"], settings=[("ceer", 0, ["AT+CEER=0"])])
+        report = _singleReply(results[0], ErrorReport) if status == ATResp.OK else None
+        if report is None: return False
+        return report.report
 
-    def awaitDataFromMT(self, timeout=.5, interByteTimeout=.1):
+    def awaitDataFromMT(self, timeout=None):
         """
-        Enters loop to wait for data from SIM800 Mobile Terminal (MT)
-        Once data is obtained it returns the data and exits the loop
+        Wait for unsolicited data from the SIM800 Mobile Terminal (MT).
+        Returns the first line received, or None if timed out or interrupted
         """
         self._logger.debug("Entering MT data waiting mode")
-        self._serial.timeout=timeout
-        self._serial.inter_byte_timeout=interByteTimeout
-        keepWaiting = True
-        data = None
-        while (keepWaiting):
-            if (self._serial.inWaiting() > 0):
-                #data_str = self._serial.read(self._serial.inWaiting()).decode('ascii')
-                data_str = self._serial.readline()
-                data_str = data_str.decode("utf-8").strip()
-                if not len(data_str) or data_str.isspace(): #MT wrote empty line
-                    continue 
-                self._logger.info("MT said: {}".format(data_str))
-                data = data_str
-                keepWaiting = False
-            if self._interruptMTDataWait:
-                keepWaiting = False
-            if not keepWaiting:
-                self._logger.debug("Leaving MT data waiting mode")
-                pass
-            else:
-                sleep(.2) #give the CPU a break it very much deserves. 0.2 seconds is pretty realtime
-        
-        self._interruptMTDataWait = False
+        self._mtDataQueue=queue.Queue()
+        try: data=self._mtDataQueue.get(timeout=timeout)
+        except queue.Empty: data=None
+        self._mtDataQueue=None
+        self._logger.debug("Leaving MT data waiting mode")
         return data
 
     def interruptMTDataWait(self):
         """
-        Exits loop to wait for data from MT started by awaitDataFromMT()
+        Exits wait for data started by awaitDataFromMT()
         """
         self._logger.debug("Interrupting MT Data Wait mode")
-        self._interruptMTDataWait = True
+        mtDataQueue=self._mtDataQueue
+        if mtDataQueue is not None: mtDataQueue.put(None)
+
+
+#"yy/MM/dd,hh:mm:ss±zz" service centre timestamp
+SCTS=re.compile(r'(\d\d)/(\d\d)/(\d\d),(\d\d):(\d\d):(\d\d)([+-]\d\d?)$')
+
+def parseTimestamp(scts):
+    """
+    Parse a "yy/MM/dd,hh:mm:ss±zz" timestamp, where zz is the time zone in quarters of an hour
+    """
+    match=SCTS.match(scts)
+    if match is None: return None
+    year,month,day,hour,minute,second,quarters=map(int, match.groups())
+    try: return datetime(2000+year, month, day, hour, minute, second, tzinfo=_timeZone(quarters))
+    except ValueError: return None
+
+@functools.lru_cache(maxsize=None)
+def _timeZone(quarters):
+    return timezone(timedelta(minutes=15*quarters))
+
+class SMSRecord(object):
+    """
+    A received SMS: its storage location, status, sender, service centre time and text
+    """
+    __slots__=("index", "status", "number", "timestamp", "text")
+
+    def __init__(self, index, status, number, timestamp, text):
+        self.index=index
+        self.status=status
+        self.number=number
+        self.timestamp=timestamp
+        self.text=text
+
+    def __repr__(self):
+        return "SMSRecord({}, {}, {}, {}, {!r})".format(self.index, self.status.name if self.status is not None else None,
+                self.number, self.timestamp, self.text)
+
+def _enumField(enum):
+    """
+    Converter of a numeric field to its member of enum
+    """
+    return dict((str(int(member)), member) for member in enum).__getitem__
+
+#pattern groups of a quoted field, and of an optional one that is None when left out
+_Q=r'"([^"]*)"'
+_OPTQ=r'(?:"([^"]*)")?'
+
+class Reply(object):
+    """
+    An information response or URC parsed into typed fields. A subclass names its fields in
+    __slots__, in response order. Its PATTERN matches the parameters after the prefix with a
+    group per field, so quoted fields may contain commas, and FIELDS has a converter for each
+    field (None keeps the text). Optional fields that are left out are None
+    """
+    __slots__=()
+    PREFIX=None
+    PATTERN=None
+    FIELDS=()
+
+    @classmethod
+    def parse(cls, params):
+        """
+        The record for the parameters after the prefix, or None if they do not parse
+        """
+        match=cls.PATTERN.match(params)
+        if match is None: return None
+        record=cls.__new__(cls)
+        try:
+            for name,convert,value in zip(cls.__slots__, cls.FIELDS, match.groups()):
+                setattr(record, name, value if value is None or convert is None else convert(value))
+        except (KeyError, ValueError):
+            return None
+        return record
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(repr(getattr(self, name)) for name in self.__slots__))
+
+class CallStatus(Reply):
+    """
+    +CLCC: <id>,<dir>,<stat>,<mode>,<mpty>[,<number>,<type>[,<alpha>]]
+    """
+    __slots__=("id", "direction", "state", "mode", "multiparty", "number", "numberType", "alpha")
+    PREFIX="+CLCC"
+    PATTERN=re.compile(r'\s*(\d+),(\d),(\d),(\d),(\d)(?:,'+_Q+r',(\d+)(?:,'+_OPTQ+r')?)?\s*$')
+    FIELDS=(int, int, _enumField(CallState), int, int, None, int, None)
+
+class SMSListing(Reply):
+    """
+    +CMGL: <index>,<stat>,<oa>,[<alpha>],[<scts>][,<tooa>,<length>], followed by the body
+    """
+    __slots__=("index", "status", "number", "alpha", "timestamp", "numberType", "length")
+    PREFIX="+CMGL"
+    PATTERN=re.compile(r'\s*(\d+),'+_Q+','+_Q+','+_OPTQ+','+_OPTQ+r'(?:,(\d+),(\d+))?\s*$')
+    FIELDS=(int, SMSStatus.fromStat, None, None, parseTimestamp, int, int)
+
+class SMSHeader(Reply):
+    """
+    +CMGR: <stat>,<oa>,[<alpha>],<scts>[,<tooa>,<fo>,<pid>,<dcs>,<sca>,<tosca>,<length>], followed by the body
+    """
+    __slots__=("status", "number", "alpha", "timestamp", "numberType", "firstOctet", "protocol", "coding",
+            "centre", "centreType", "length")
+    PREFIX="+CMGR"
+    PATTERN=re.compile(r'\s*'+_Q+','+_Q+','+_OPTQ+','+_Q+r'(?:,(\d+),(\d+),(\d+),(\d+),'+_OPTQ+r',(\d+),(\d+))?\s*$')
+    FIELDS=(SMSStatus.fromStat, None, None, parseTimestamp, int, int, int, int, None, int, int)
+
+class Registration(Reply):
+    """
+    +CREG: [<n>,]<stat>[,<lac>,<ci>]. The URC has no reporting mode n, which the AT+CREG? response starts with
+    """
+    __slots__=("mode", "status", "lac", "cellId")
+    PREFIX="+CREG"
+    PATTERN=re.compile(r'\s*(?:(\d),)?(\d)(?:,'+_Q+','+_Q+r')?\s*$')
+    FIELDS=(int, _enumField(NetworkStatus), None, None)
+
+class SignalQuality(Reply):
+    """
+    +CSQ: <rssi>,<ber>. rssi is 0-31, or 99 if unknown or not detectable
+    """
+    __slots__=("rssi", "ber")
+    PREFIX="+CSQ"
+    PATTERN=re.compile(r'\s*(\d+)(?:,(\d+))?\s*$')
+    FIELDS=(int, int)
+
+class USSDReply(Reply):
+    """
+    +CUSD: <n>[,<str>[,<dcs>]]
+    """
+    __slots__=("status", "text", "coding")
+    PREFIX="+CUSD"
+    PATTERN=re.compile(r'\s*(\d)(?:,'+_Q+r'(?:,(\d+))?)?\s*$')
+    FIELDS=(int, None, int)
+
+class NewSMS(Reply):
+    """
+    +CMTI: <mem>,<index>
+    """
+    __slots__=("storage", "index")
+    PREFIX="+CMTI"
+    PATTERN=re.compile(r'\s*'+_Q+r',(\d+)\s*$')
+    FIELDS=(None, int)
+
+class ErrorReport(Reply):
+    """
+    +CEER: <report>, free text that may contain commas
+    """
+    __slots__=("report",)
+    PREFIX="+CEER"
+    PATTERN=re.compile(r'\s*(.*)')
+    FIELDS=(None,)
+
+#reply record type by response prefix
+REPLY_TYPES=dict((replyType.PREFIX, replyType) for replyType in (CallStatus, SMSListing, SMSHeader, Registration,
+        SignalQuality, USSDReply, NewSMS, ErrorReport))
+
+def parseResponse(line, expected=None):
+    """
+    The reply record of an information response or URC line. None if no type is registered for
+    its prefix, it is not of the expected type or it does not parse
+    """
+    prefix,colon,params=line.partition(":")
+    replyType=REPLY_TYPES.get(prefix) if colon else None
+    if replyType is None or (expected is not None and replyType is not expected): return None
+    return replyType.parse(params)
+
+def _singleReply(lines, replyType):
+    """
+    parseResponse() the only line of a command's response. None if there is not exactly one
+    """
+    if lines is None or len(lines)!=1: return None
+    return parseResponse(lines[0], replyType)
+
+def _splitBatchResponse(cmds, lines):
+    """
+    Assign the response lines of a batch to its commands by their +NAME: prefix, in order
+    """
+    names=[cmd[2:].upper().split("=",1)[0].rstrip("?") for cmd in cmds]
+    results=[[] for cmd in cmds]
+    if not len(cmds): return results
+    current=0
+    for line in lines:
+        if line.startswith("+") and ":" in line:
+            name=line.split(":",1)[0].upper()
+            current=next((i for i in range(current, len(cmds)) if names[i]==name), current)
+        results[current].append(line)
+    return results
+
+def _messageFormatSetting(format):
+    return ("cmgf", int(format), ["AT+CMGF={}".format(int(format))])
+
+def _textModeSetting(mode):
+    return ("csdh", int(mode), ["AT+CSDH={}".format(int(mode))])
+
+def parseRegistrationIndication(line):
+    """
+    The NetworkStatus announced by a +CREG URC, or None if line is not one
+    """
+    registration=parseResponse(line, Registration)
+    #the AT+CREG? response starts with the reporting mode
+    if registration is None or registration.mode is not None: return None
+    return registration.status
+
+def parseNewSMSIndication(line):
+    """
+    Return the storage location announced by a +CMTI URC, or None
+    """
+    indication=parseResponse(line, NewSMS)
+    if indication is None: return None
+    return indication.index
+
+
+class _PendingCommand(object):
+    """
+    A command awaiting its response; the reader thread puts response lines on its queue.
+    """
+    def __init__(self, cmd):
+        self.cmd=cmd
+        self.lines=queue.Queue()
 
 
 if __name__=="__main__":
@@ -700,6 +1290,6 @@ if __name__=="__main__":
     #print(s.readAllSMS())
     #s.awaitDataFromMT()
     #s.sendUSSD("*102#")
-    #s.readAllSMS()
+    #for record in s.inbox(): print(record)
     #print(s.placeCall("+255746777147"))
 
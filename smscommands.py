@@ -0,0 +1,91 @@
+import time
+from datetime import datetime, timezone
+
+import common
+
+logger = common.getLogger('smscommands')
+
+def normaliseNumber(number):
+    return "".join(c for c in number if c.isdigit())
+
+class SMSCommandEngine(object):
+    """
+    Executes commands sent by SMS from the authorised numbers and produces the reply text.
+    Commands (case insensitive, first line of the message):
+    ARM, DISARM, STATUS, SNOOZE <minutes> (0 to cancel) and GAP <minutes> (the notify gap).
+    Messages from other numbers, and messages older than maxAge seconds (e.g. left on the
+    SIM while the daemon was down), are ignored without a reply.
+    """
+    def __init__(self, alarmState, authorisedNumbers, maxAge=3600., onNotifyGap=None, statusExtra=None):
+        self.alarmState = alarmState
+        self.configure(authorisedNumbers, maxAge)
+        self._onNotifyGap = onNotifyGap
+        self._statusExtra = statusExtra
+        self._commands = {"ARM":self._arm, "DISARM":self._disarm, "STATUS":self._status,
+                "SNOOZE":self._snooze, "GAP":self._gap}
+
+    def configure(self, authorisedNumbers, maxAge):
+        self._authorised = frozenset(normaliseNumber(number) for number in authorisedNumbers)
+        self.maxAge = maxAge
+
+    def handle(self, record):
+        """
+        Execute the command in an SMSRecord. Returns the reply text, or None to send no reply
+        """
+        if normaliseNumber(record.number) not in self._authorised:
+            logger.warning("Ignoring SMS from unauthorised number %s", record.number)
+            return None
+        if record.timestamp is not None:
+            age = (datetime.now(timezone.utc) - record.timestamp).total_seconds()
+            if age > self.maxAge:
+                logger.warning("Ignoring SMS command from %s sent %.0f minutes ago", record.number, age / 60)
+                return None
+        words = record.text.strip().split("\n")[0].split()
+        if not len(words): return None
+        command = self._commands.get(words[0].upper())
+        if command is None:
+            logger.info("Unknown SMS command from %s: %s", record.number, record.text)
+            return "Unknown command. Use ARM, DISARM, STATUS, SNOOZE <minutes> or GAP <minutes>"
+        logger.info("SMS command from %s: %s", record.number, " ".join(words))
+        return command(record.number, words[1:])
+
+    def _arm(self, number, args):
+        self.alarmState.arm(number)
+        return "Armed"
+
+    def _disarm(self, number, args):
+        self.alarmState.disarm(number)
+        return "Disarmed. Motion will not be notified until ARM"
+
+    def _status(self, number, args):
+        status = "{}. Notify gap {:g} minutes".format(self.alarmState.describe(), self.notifyGap())
+        if self._statusExtra is not None: status += ". " + self._statusExtra()
+        return status
+
+    def _snooze(self, number, args):
+        minutes = self._minutes(args)
+        if minutes is None: return "Usage: SNOOZE <minutes>"
+        self.alarmState.snooze(minutes, number)
+        if not minutes: return "Snooze cancelled"
+        return "Snoozed for {} minutes, until {}".format(minutes, time.strftime("%H:%M", time.localtime(self.alarmState.snoozeUntil)))
+
+    def _gap(self, number, args):
+        minutes = self._minutes(args)
+        if minutes is None: return "Usage: GAP <minutes>"
+        self.alarmState.setNotifyGap(minutes, number)
+        if self._onNotifyGap is not None: self._onNotifyGap(minutes)
+        return "Notify gap set to {} minutes".format(minutes)
+
+    def notifyGap(self):
+        """
+        Notify gap in minutes: the one set by SMS, else the configured one
+        """
+        if self.alarmState.notifyGap is not None: return self.alarmState.notifyGap
+        return common.configStore.current().notifyGap
+
+    def _minutes(self, args):
+        try:
+            minutes = int(args[0])
+        except (IndexError, ValueError):
+            return None
+        return minutes if 0 <= minutes <= 7 * 24 * 60 else None
@@ -0,0 +1,187 @@
+import asyncio
+import time
+from collections import deque
+from urllib.parse import quote, urlsplit
+
+import common
+
+logger = common.getLogger('snapshots')
+
+class Frame(object):
+    """
+    One camera snapshot. The ETag is unique across frames and daemon restarts
+    """
+    __slots__ = ("camera", "etag", "timestamp", "contentType", "data")
+
+    def __init__(self, camera, etag, timestamp, contentType, data):
+        self.camera = camera
+        self.etag = etag
+        self.timestamp = timestamp
+        self.contentType = contentType
+        self.data = data
+
+
+class SnapshotStore(object):
+    """
+    Ring buffer of the latest frames of each camera, capped at framesPerCamera frames per
+    camera and maxBytes in total. When the total cap is reached the oldest frames of any
+    camera go first, so a storm on one camera cannot grow memory, only displace older frames.
+    Only used from the event loop thread, so there is no locking
+    """
+    def __init__(self, framesPerCamera=5, maxBytes=8*1024*1024):
+        self.framesPerCamera = framesPerCamera
+        self.maxBytes = maxBytes
+        self.size = 0
+        self._frames = {} #camera -> deque of Frames, oldest first
+        self._order = deque() #all frames, oldest first
+        self._seq = 0
+        self._epoch = "{:x}".format(int(time.time() * 1000))
+        self.stats = {"stored":0, "evicted":0}
+
+    def add(self, camera, data, contentType="image/jpeg", timestamp=None):
+        if len(data) > self.maxBytes: return None
+        self._seq += 1
+        etag = '"{}-{}"'.format(self._epoch, self._seq)
+        frame = Frame(camera, etag, time.time() if timestamp is None else timestamp, contentType, bytes(data))
+        frames = self._frames.setdefault(camera, deque())
+        frames.append(frame)
+        self._order.append(frame)
+        self.size += len(frame.data)
+        self.stats["stored"] += 1
+        while len(frames) > self.framesPerCamera: self._evict(frames[0])
+        while self.size > self.maxBytes: self._evict(self._order[0])
+        return frame
+
+    def resize(self, framesPerCamera, maxBytes):
+        """
+        Change the caps, evicting the frames over the new ones at once
+        """
+        self.framesPerCamera = framesPerCamera
+        self.maxBytes = maxBytes
+        for frames in list(self._frames.values()):
+            while len(frames) > self.framesPerCamera: self._evict(frames[0])
+        while self.size > self.maxBytes: self._evict(self._order[0])
+
+    def _evict(self, frame):
+        frames = self._frames[frame.camera]
+        frames.remove(frame)
+        if not len(frames): del self._frames[frame.camera]
+        self._order.remove(frame)
+        self.size -= len(frame.data)
+        self.stats["evicted"] += 1
+
+    def latest(self, camera, back=0):
+        """
+        The newest frame of camera, or the one back frames before it. None if there is none
+        """
+        frames = self._frames.get(camera)
+        if frames is None or back >= len(frames) or back < 0: return None
+        return frames[-1 - back]
+
+    def cameras(self):
+        return dict((camera, len(frames)) for camera, frames in self._frames.items())
+
+
+class SnapshotFetcher(object):
+    """
+    Fetches a frame from the NVR (motionEye) into a SnapshotStore when a camera reports motion.
+    fetch(camera) only schedules the download on the running loop and returns at once, so it
+    never holds up the event path. A camera already being fetched is skipped, and so is any
+    fetch beyond maxFetches in flight, which bounds the work a camera storm can cause.
+    urlTemplate may use {host}, {port} and {camera}; an empty template disables fetching.
+    loop is the event loop the fetcher and its store are used on
+    """
+    def __init__(self, store, urlTemplate, host, port, timeout=5., maxFrameSize=1024*1024, maxFetches=4, loop=None):
+        self._loop = loop
+        self.store = store
+        self.urlTemplate = urlTemplate
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.maxFrameSize = maxFrameSize
+        self.maxFetches = maxFetches
+        self._inFlight = {} #camera -> task
+        self.stats = {"fetched":0, "failed":0, "skipped":0}
+
+    @classmethod
+    def fromConfig(cls, config):
+        """
+        A fetcher for the running event loop
+        """
+        store = SnapshotStore(config.snapshotFrames, config.snapshotMemory)
+        return cls(store, config.snapshotUrl, config.nvrHosts[0][1], config.nvrHosts[0][2], loop=asyncio.get_running_loop(),
+                **fetcherSettings(config))
+
+    def applyConfig(self, old, new):
+        """
+        configStore.onChange callback. Called from the config watcher thread, so the change is
+        handed to the loop, which owns the store
+        """
+        if self._loop is None: self._configure(new)
+        else: self._loop.call_soon_threadsafe(self._configure, new)
+
+    def _configure(self, config):
+        for name, value in fetcherSettings(config).items(): setattr(self, name, value)
+        self.urlTemplate, self.host, self.port = config.snapshotUrl, config.nvrHosts[0][1], config.nvrHosts[0][2]
+        self.store.resize(config.snapshotFrames, config.snapshotMemory)
+
+    def fetch(self, camera):
+        """
+        Schedule fetching a frame of camera. Must be called on the event loop
+        """
+        if not self.urlTemplate or camera is None: return
+        if camera in self._inFlight or len(self._inFlight) >= self.maxFetches:
+            self.stats["skipped"] += 1
+            return
+        task = asyncio.ensure_future(self._fetch(camera, time.time()))
+        self._inFlight[camera] = task
+        task.add_done_callback(lambda task: self._inFlight.pop(camera, None))
+
+    async def _fetch(self, camera, timestamp):
+        url = self.urlTemplate.format(host=self.host, port=self.port, camera=quote(camera, safe=""))
+        try:
+            contentType, data = await asyncio.wait_for(self.get(url), self.timeout)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            self.stats["failed"] += 1
+            logger.warning("Failed to fetch snapshot of camera %s from %s: %s", camera, url, e or type(e).__name__)
+            return
+        self.stats["fetched"] += 1
+        self.store.add(camera, data, contentType, timestamp)
+        logger.debug("Stored %s byte snapshot of camera %s", len(data), camera)
+
+    async def get(self, url):
+        """
+        Minimal HTTP/1.0 GET. Returns (content type, body); raises ValueError on a non 200 response
+        or a body larger than maxFrameSize
+        """
+        parts = urlsplit(url)
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+            path = parts.path or "/"
+            if parts.query: path += "?" + parts.query
+            writer.write("GET {} HTTP/1.0\r\nHost: {}\r\nConnection: close\r\n\r\n".format(path, parts.netloc).encode("latin1"))
+            statusLine = (await reader.readline()).decode("latin1").split()
+            if len(statusLine) < 2 or statusLine[1] != "200":
+                raise ValueError("HTTP status {}".format(" ".join(statusLine[1:]) or "missing"))
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin1").strip()
+                if not line: break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = headers.get("content-length")
+            if length is not None:
+                if int(length) > self.maxFrameSize: raise ValueError("frame of {} bytes is too large".format(length))
+                data = await reader.readexactly(int(length))
+            else:
+                data = await reader.read(self.maxFrameSize + 1)
+                if len(data) > self.maxFrameSize: raise ValueError("frame is too large")
+            return headers.get("content-type", "image/jpeg"), data
+        except asyncio.IncompleteReadError as e:
+            raise ValueError("connection closed after {} bytes".format(len(e.partial)))
+        finally:
+            if writer is not None: writer.close()
+
+def fetcherSettings(config):
+    return dict(timeout=config.snapshotTimeout, maxFrameSize=config.snapshotMaxFrameSize, maxFetches=config.snapshotMaxFetches)
@@ -0,0 +1,222 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from collections import deque
+
+import common
+
+logger = common.getLogger('watchdog')
+
+def magicPacket(mac):
+    """
+    Wake-on-LAN magic packet: six 0xFF bytes followed by the MAC address 16 times
+    """
+    macBytes = bytes.fromhex(mac.replace(":", "").replace("-", ""))
+    if len(macBytes) != 6: raise ValueError("Invalid MAC address: {}".format(mac))
+    return b"\xff" * 6 + macBytes * 16
+
+def sendWakeOnLAN(mac, broadcast="255.255.255.255", port=9):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.sendto(magicPacket(mac), (broadcast, port))
+
+def watchdogSettings(config):
+    """
+    NVRWatchdog keyword arguments from a settings.Settings snapshot
+    """
+    return dict(upInterval=config.nvrUpInterval, bootPollInterval=config.nvrBootPollInterval,
+            bootWatch=config.nvrBootWatch, downInterval=config.nvrDownInterval, backoffMax=config.nvrBackoffMax,
+            broadcast=config.nvrBroadcast, statusFile=config.nvrStatusFile)
+
+
+class NVRHost(object):
+    """
+    Probe state and up/down history of one NVR or camera endpoint
+    """
+    def __init__(self, name, ip, port, mac=None, historySize=50):
+        self.name = name
+        self.ip = ip
+        self.port = int(port)
+        self.mac = mac
+        self.online = None
+        self.lastProbe = None
+        self.downSince = None
+        self.lastWake = None
+        self.wakeCount = 0
+        self.history = deque(maxlen=historySize) #(time, "up"/"down")
+        self.recoveries = deque(maxlen=historySize) #(time recovered, seconds down, seconds since last WoL)
+
+    def record(self, online, now):
+        """
+        Record a probe result. Returns True if the state changed
+        """
+        self.lastProbe = now
+        if online == self.online: return False
+        self.history.append((now, "up" if online else "down"))
+        if online and self.downSince is not None:
+            sinceWake = now - self.lastWake if self.lastWake is not None and self.lastWake >= self.downSince else None
+            self.recoveries.append((now, now - self.downSince, sinceWake))
+            self.downSince = None
+        elif not online:
+            self.downSince = now
+        self.online = online
+        return True
+
+    def status(self):
+        return {"name":self.name, "host":"{}:{}".format(self.ip, self.port), "online":self.online,
+                "lastProbe":self.lastProbe, "downSince":self.downSince, "wakeCount":self.wakeCount,
+                "history":list(self.history),
+                "recoveries":[{"time":t, "downFor":d, "sinceWake":w} for t, d, w in self.recoveries]}
+
+
+class NVRWatchdog(object):
+    """
+    Probes all NVR hosts concurrently with adaptive intervals. An online host is checked
+    every upInterval seconds. When a host goes down it is woken with Wake-on-LAN and then
+    polled every bootPollInterval seconds for bootWatch seconds, to catch (and time) its boot.
+    If it stays down, it is woken again with an interval that doubles up to backoffMax.
+    The host list and intervals can be changed while running with configure().
+    """
+    def __init__(self, hosts, upInterval=120., bootPollInterval=5., bootWatch=180., downInterval=30.,
+            backoffMax=600., probeTimeout=5., broadcast="255.255.255.255", statusFile=None):
+        self.hosts = hosts
+        self.upInterval = upInterval
+        self.bootPollInterval = bootPollInterval
+        self.bootWatch = bootWatch
+        self.downInterval = downInterval
+        self.backoffMax = backoffMax
+        self.probeTimeout = probeTimeout
+        self.broadcast = broadcast
+        self.statusFile = statusFile
+        self._loop = None
+        self._tasks = {}
+
+    @classmethod
+    def fromConfig(cls, config):
+        hosts = [NVRHost(name, ip, port, mac) for name, ip, port, mac in config.nvrHosts]
+        for host in hosts:
+            logger.info("Watching %s at %s:%s (MAC Address: %s)", host.name, host.ip, host.port, host.mac)
+        return cls(hosts, **watchdogSettings(config))
+
+    def applyConfig(self, old, new):
+        """
+        configStore.onChange callback
+        """
+        self.configure(new.nvrHosts, **watchdogSettings(new))
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        for host in self.hosts: self._startWatching(host)
+        while len(self._tasks):
+            await asyncio.wait(list(self._tasks.values()), timeout=1.)
+            for name, task in list(self._tasks.items()):
+                if task.done(): del self._tasks[name]
+
+    def configure(self, hosts, **intervals):
+        """
+        Apply new (name, ip, port, mac) hosts and interval settings. Thread safe; hosts keep
+        their history across changes. New intervals apply from each host's next probe
+        """
+        if self._loop is None: return
+        self._loop.call_soon_threadsafe(self._configure, hosts, intervals)
+
+    def _configure(self, hosts, intervals):
+        for name, value in intervals.items(): setattr(self, name, value)
+        current = dict((host.name, host) for host in self.hosts)
+        self.hosts = []
+        for name, ip, port, mac in hosts:
+            host = current.pop(name, None)
+            if host is None:
+                host = NVRHost(name, ip, port, mac)
+                logger.info("Watching %s at %s:%s", name, ip, port)
+                self._startWatching(host)
+            else:
+                host.ip, host.port, host.mac = ip, int(port), mac
+            self.hosts.append(host)
+        for name, host in current.items():
+            logger.info("No longer watching %s", name)
+            task = self._tasks.pop(name, None)
+            if task is not None: task.cancel()
+        self.writeStatus()
+
+    def _startWatching(self, host):
+        self._tasks[host.name] = asyncio.ensure_future(self._watch(host))
+
+    async def probe(self, host):
+        """
+        Send a HEAD request. Any HTTP response counts as online
+        """
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host.ip, host.port), self.probeTimeout)
+            writer.write("HEAD / HTTP/1.0\r\nHost: {}:{}\r\n\r\n".format(host.ip, host.port).encode("latin1"))
+            statusLine = await asyncio.wait_for(reader.readline(), self.probeTimeout)
+            return statusLine.startswith(b"HTTP/")
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug("Probe of %s failed: %s", host.name, e or type(e).__name__)
+            return False
+        finally:
+            if writer is not None: writer.close()
+
+    def wake(self, host):
+        if not host.mac:
+            logger.warning("%s is down and has no MAC address to wake", host.name)
+            return
+        logger.info("Sending Wake-on-LAN to %s (%s)", host.name, host.mac)
+        try:
+            sendWakeOnLAN(host.mac, self.broadcast)
+        except (OSError, ValueError) as e:
+            logger.error("Wake-on-LAN to %s failed: %s", host.name, e)
+            return
+        host.lastWake = time.time()
+        host.wakeCount += 1
+
+    async def _watch(self, host):
+        backoff = self.downInterval
+        nextWake = 0
+        while not common.KILL_FLAG:
+            online = await self.probe(host)
+            now = time.time()
+            if host.record(online, now):
+                self._reportChange(host)
+            if online:
+                backoff = self.downInterval
+                nextWake = 0
+                interval = self.upInterval
+            else:
+                if now >= nextWake:
+                    self.wake(host)
+                    nextWake = now + backoff
+                    backoff = min(backoff * 2, self.backoffMax)
+                if host.lastWake is not None and now - host.lastWake < self.bootWatch:
+                    interval = self.bootPollInterval #catch the end of the boot
+                else:
+                    interval = max(self.bootPollInterval, nextWake - now)
+            logger.debug("Will probe %s again after %.0f seconds", host.name, interval)
+            await asyncio.sleep(interval)
+
+    def _reportChange(self, host):
+        if host.online:
+            if len(host.recoveries) and host.recoveries[-1][0] == host.lastProbe:
+                _, downFor, sinceWake = host.recoveries[-1]
+                if sinceWake is None: logger.info("%s is back online after %.0fs down", host.name, downFor)
+                else: logger.info("%s is back online after %.0fs down (%.0fs after Wake-on-LAN)", host.name, downFor, sinceWake)
+            else:
+                logger.info("%s is online", host.name)
+        else:
+            logger.warning("%s is offline", host.name)
+        self.writeStatus()
+
+    def status(self):
+        return {"time":time.time(), "hosts":[host.status() for host in self.hosts]}
+
+    def writeStatus(self):
+        if self.statusFile is None: return
+        try:
+            with open(self.statusFile + ".tmp", "w") as statusFile:
+                json.dump(self.status(), statusFile)
+            os.replace(self.statusFile + ".tmp", self.statusFile)
+        except OSError as e:
+            logger.error("Failed to write watchdog status: %s", e)
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import math
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import common
+import ipc
+
+logger = common.getLogger('webhook')
+
+STATUS_REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+        429: "Too Many Requests", 501: "Not Implemented", 503: "Service Unavailable"}
+SNAPSHOT_PATH = "/snapshot/"
+STATS_PATH = "/stats"
+STATUS_PATH = "/status"
+
+def statusFiles(config):
+    """
+    The status files GET /status serves, by section
+    """
+    return {"modems":config.modemStatusFile, "nvr":config.nvrStatusFile}
+
+class WebhookServer(object):
+    """
+    asyncio HTTP/1.1 server receiving motion webhooks from the cameras.
+    Requests are answered immediately; events are put on an internal queue and handed
+    to sink in batches (sink is called with a list of IPC messages, in an executor thread)
+    by a single writer task, so a slow consumer never holds up a camera. Connections are
+    kept alive between requests.
+    While alarmState (an alarmstate.AlarmState) is disarmed or snoozed, motion requests are
+    answered and dropped here without reaching the daemon.
+    With a snapshots.SnapshotFetcher, each motion event passed on also starts fetching a frame
+    of the camera, after the event is queued. GET /snapshot/<camera>[?back=n] serves the newest
+    (or n-th newest) stored frame with an ETag, answering If-None-Match with 304.
+    With an admission.Admission, motion, snapshot and /stats requests must pass it first;
+    the rest get a short 403 or 429 and never reach the queue. GET /stats returns the counters.
+    GET /status returns the JSON status files named by statusFiles() (e.g. the GSM module health
+    cached by the daemon) together with the counters.
+    """
+    def __init__(self, host, port, sink, queueSize=256, keepAliveTimeout=15., alarmState=None, snapshots=None,
+            admission=None, statusFiles=None):
+        self.host = host
+        self.port = port
+        self._sink = sink
+        self._queueSize = queueSize
+        self._keepAliveTimeout = keepAliveTimeout
+        self._alarmState = alarmState
+        self._snapshots = snapshots
+        self._admission = admission
+        self._statusFiles = statusFiles
+        self._queue = None
+        self._server = None
+        self._writerTask = None
+        self.stats = {"requests":0, "events":0, "eventsDropped":0, "eventsDisarmed":0, "snapshotsServed":0, "notModified":0,
+                "badCamera":0}
+
+    async def start(self):
+        """
+        Bind the listening socket and start the event writer. Raises OSError if the port is unavailable
+        """
+        self._queue = asyncio.Queue(self._queueSize)
+        self._server = await asyncio.start_server(self._handleClient, self.host or None, self.port)
+        if not self.port: self.port = self._server.sockets[0].getsockname()[1]
+        self._writerTask = asyncio.ensure_future(self._writeEvents())
+
+    async def serveForever(self):
+        await self._server.serve_forever()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._writerTask is not None:
+            self._writerTask.cancel()
+
+    def queueEvent(self, message):
+        """
+        Hand an event to the writer task without blocking. Returns False if the queue is full
+        """
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.stats["eventsDropped"] += 1
+            logger.error("Event queue full. Dropping %s", message)
+            return False
+        self.stats["events"] += 1
+        return True
+
+    async def _writeEvents(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty(): batch.append(self._queue.get_nowait())
+            try:
+                await loop.run_in_executor(None, self._sink, batch)
+            except Exception:
+                logger.exception("Failed to pass on events %s", batch)
+
+    def handleRequest(self, method, target, headers, client):
+        """
+        Produce the response to a request as (status, content type, body, extra headers)
+        """
+        if method != "GET": return 501, "text/plain", b"Not Implemented\r\n", None
+        url = urlsplit(target)
+        query_components = parse_qs(url.query, keep_blank_values=True)
+        snapshot = url.path.startswith(SNAPSHOT_PATH)
+        motion = 'motion' in query_components and not snapshot
+        camera = unquote(url.path[len(SNAPSHOT_PATH):]) if snapshot else query_components.get('camera', [None])[0]
+        if (snapshot or motion) and not common.validCamera(camera):
+            self.stats["badCamera"] += 1
+            logger.warning("Rejected request from %s with camera id %r", client[0], camera)
+            return 400, "text/plain", b"Bad Request\r\n", None
+        if self._admission is not None and (snapshot or motion or url.path in (STATS_PATH, STATUS_PATH)):
+            refused = self._admission.check(client[0], camera, query_components, headers)
+            if refused is not None:
+                status, reason, retryAfter = refused
+                return status, "text/plain", reason.encode("latin1") + b"\r\n", \
+                        None if retryAfter is None else {"Retry-After":max(1, math.ceil(retryAfter))}
+        if snapshot: return self.handleSnapshot(camera, query_components, headers)
+        if url.path == STATS_PATH: return 200, "application/json", json.dumps(self.allStats()).encode("utf-8"), None
+        if url.path == STATUS_PATH: return 200, "application/json", json.dumps(self.status()).encode("utf-8"), None
+        if motion:
+            logger.info("Motion parameter set in request")
+            if self._alarmState is not None:
+                self._alarmState.refresh()
+                if not self._alarmState.isActive():
+                    self.stats["eventsDisarmed"] += 1
+                    logger.info("Motion from camera %s dropped: %s", camera, self._alarmState.describe())
+                    return 200, "text/html", b"Received (disarmed)\r\n", None
+            if self.queueEvent(ipc.makeMessage(common.MOTION_DETECTED_COMMAND, camera)) and self._snapshots is not None:
+                self._snapshots.fetch(camera)
+        return 200, "text/html", b"Received\r\n", None
+
+    def allStats(self):
+        stats = {"webhook":self.stats}
+        if self._admission is not None: stats["admission"] = self._admission.stats
+        if self._snapshots is not None:
+            stats["snapshots"] = dict(self._snapshots.stats, cameras=self._snapshots.store.cameras(),
+                    bytes=self._snapshots.store.size, **self._snapshots.store.stats)
+        return stats
+
+    def status(self):
+        status = {}
+        for name, path in (self._statusFiles() if self._statusFiles is not None else {}).items():
+            try:
+                with open(path) as statusFile:
+                    status[name] = json.load(statusFile)
+            except (OSError, ValueError) as e:
+                status[name] = {"error":str(e)}
+        status["stats"] = self.allStats()
+        return status
+
+    def handleSnapshot(self, camera, query_components, headers):
+        if self._snapshots is None: return 404, "text/plain", b"Snapshots are disabled\r\n", None
+        try:
+            back = int(query_components.get('back', ['0'])[0])
+        except ValueError:
+            return 400, "text/plain", b"Bad Request\r\n", None
+        frame = self._snapshots.store.latest(camera, back)
+        if frame is None: return 404, "text/plain", b"No snapshot\r\n", None
+        frameHeaders = {"ETag":frame.etag, "Cache-Control":"no-cache",
+                "Last-Modified":formatdate(frame.timestamp, usegmt=True)}
+        if frame.etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+            self.stats["notModified"] += 1
+            return 304, None, b"", frameHeaders
+        self.stats["snapshotsServed"] += 1
+        #the frame is never modified once stored, so it can be written out without a copy
+        return 200, frame.contentType, memoryview(frame.data), frameHeaders
+
+    async def _handleClient(self, reader, writer):
+        client = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while True:
+                request = await self._readRequest(reader)
+                if request is None: break
+                method, target, version, headers = request
+                self.stats["requests"] += 1
+                status, contentType, body, extraHeaders = self.handleRequest(method, target, headers, client)
+                connection = headers.get("connection", "").lower()
+                keepAlive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                head = ["{} {} {}".format(version if version in ("HTTP/1.0", "HTTP/1.1") else "HTTP/1.1",
+                        status, STATUS_REASONS.get(status, ""))]
+                if contentType is not None: head.append("Content-Type: {}".format(contentType))
+                head.append("Content-Length: {}".format(len(body)))
+                head.extend("{}: {}".format(name, value) for name, value in (extraHeaders or {}).items())
+                head.append("Connection: {}".format("keep-alive" if keepAlive else "close"))
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin1"))
+                if len(body): writer.write(body)
+                await writer.drain()
+                logger.info('Request from %s:%s - "%s %s %s" %s', client[0], client[1], method, target, version, status)
+                if not keepAlive: break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _readRequest(self, reader):
+        """
+        Read one request head (and discard any body). Returns None when the client closed the connection
+        """
+        requestLine = await asyncio.wait_for(reader.readline(), self._keepAliveTimeout)
+        if not requestLine: return None
+        method, target, version = requestLine.decode("latin1").split()
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self._keepAliveTimeout)
+            line = line.decode("latin1").strip()
+            if not line: break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length: await reader.readexactly(length)
+        return method, target, version, headers